@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of the pipeline stages on synthetic GSOD data.
+#
+# For every size, synthetic_gsod.py generates a fixed input (cached in the
+# work directory), then each stage runs as its own process exactly as it
+# would in a job: combine_data.py, mapper.py, reducer.py, process.py and
+# visualization.py --batch. Wall time, rows/s, MB/s and the stage's own peak
+# RSS (from os.wait4, so it is per process) are recorded. Glue between the
+# stages (sorting the map output, turning reducer output into
+# seasonal_temperatures.csv) is done here and not timed.
+#
+# Results go to a JSON file for trend tracking. With --baseline, every stage
+# is compared with the same stage and size there, and the run fails if any
+# of them got slower than --threshold percent.
+import os
+import re
+import csv
+import sys
+import json
+import time
+import glob
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from synthetic_gsod import generate
+from local_runner import sort_lines
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Stations per size; each size is one year of daily rows
+SIZES = {'small': 100, 'medium': 1000, 'large': 5000}
+STAGES = ['combine', 'map', 'reduce', 'process', 'visualize']
+REDUCER_LINE = re.compile(r'(\d+),(\d{4}),(Spring|Summer|Fall|Winter)\s+Average:\s*([\d\.\-]+), '
+                          r'Max:\s*([\d\.\-]+), Min:\s*([\d\.\-]+)')
+
+def script(name):
+    return os.path.join(SCRIPT_DIR, name)
+
+def run_process(command, cwd, stdin_path=None, stdout_path=None):
+    """
+    Run command and return (seconds, peak RSS in bytes or None). Raises
+    CalledProcessError if it fails; the stage's stderr (reporter: counter
+    lines, progress) is kept in a temporary file and only shown then.
+    """
+    stdin = open(stdin_path, 'rb') if stdin_path else subprocess.DEVNULL
+    stdout = open(stdout_path, 'wb') if stdout_path else subprocess.DEVNULL
+    # A file rather than a pipe: nothing drains a pipe while we block in wait4
+    stderr = tempfile.TemporaryFile()
+    env = dict(os.environ, MPLBACKEND='Agg', PYTHONPATH=SCRIPT_DIR)
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr,
+                                env=env)
+        if hasattr(os, 'wait4'):
+            # wait4 gives this child's own rusage, not the maximum over all children
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            peak = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        else:
+            proc.wait()
+            peak = None
+        seconds = time.perf_counter() - start
+        if proc.returncode:
+            stderr.seek(0)
+            output = stderr.read()
+            sys.stderr.write(output.decode('utf-8', 'replace'))
+            raise subprocess.CalledProcessError(proc.returncode, command, stderr=output)
+    finally:
+        for f in (stdin, stdout, stderr):
+            if f is not subprocess.DEVNULL:
+                f.close()
+    return seconds, peak
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+def input_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+def prepare_input(work_dir, size, seed):
+    # Synthetic archives for a size, generated once per seed
+    tar_dir = os.path.join(work_dir, f'{size}-seed{seed}', 'tars')
+    if not glob.glob(os.path.join(tar_dir, '*.tar.gz')):
+        generate(tar_dir, num_stations=SIZES[size], start_year=2020, num_years=1, seed=seed,
+                 missing=0.05, skew=0.5)
+    return tar_dir
+
+def sort_map_output(path, sorted_path):
+    with open(path, 'rb') as f:
+        lines = f.readlines()
+    with open(sorted_path, 'wb') as f:
+        f.writelines(sort_lines(lines))
+
+def reducer_to_seasonal(path, seasonal_path):
+    # What `csv saver.py` does with the job output
+    with open(path) as f:
+        matches = REDUCER_LINE.findall(f.read())
+    with open(seasonal_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["StationID", "Year", "Season", "AverageTemp", "MaxTemp", "MinTemp"])
+        writer.writerows(matches)
+
+def bench_size(work_dir, size, seed, stages, repeat=1):
+    """
+    Run the stages in order on one size. Every stage needs the previous
+    one's output, so earlier stages always run; only the selected ones are
+    reported, with the fastest of repeat runs.
+    """
+    work_dir = os.path.abspath(work_dir)
+    tar_dir = prepare_input(work_dir, size, seed)
+    run_dir = os.path.join(work_dir, f'{size}-seed{seed}', 'run')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    data_dir = os.path.join(run_dir, 'data')
+    os.makedirs(data_dir)
+
+    combined_dir = os.path.join(run_dir, 'combined')
+    combined = os.path.join(combined_dir, '2020_combined.csv')
+    map_output = os.path.join(run_dir, 'map.txt')
+    sorted_output = os.path.join(run_dir, 'map.sorted.txt')
+    reduce_output = os.path.join(run_dir, 'reduce.txt')
+    seasonal = os.path.join(data_dir, 'seasonal_temperatures.csv')
+    processed = os.path.join(data_dir, 'processed_data.csv')
+    cube_dir = os.path.join(data_dir, 'processed_cube')
+
+    results = []
+    def record(stage, inputs, rows, command, **kwargs):
+        # rows may be a function, for stages whose row count is only known afterwards
+        if stage not in stages:
+            run_process(command, run_dir, **kwargs)
+            return
+        runs = [run_process(command, run_dir, **kwargs) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        peak = max((run[1] for run in runs), default=None, key=lambda value: value or 0)
+        rows = rows() if callable(rows) else rows
+        data_bytes = input_size(inputs)
+        results.append({
+            'stage': stage, 'size': size, 'rows': rows, 'bytes': data_bytes,
+            'seconds': seconds, 'rows_per_sec': rows / seconds, 'mb_per_sec': data_bytes / 1e6 / seconds,
+            'peak_rss_bytes': peak,
+        })
+        print(f"  {size:<8}{stage:<11}{seconds:>8.2f}s{rows / seconds:>12.0f} rows/s"
+              f"{data_bytes / 1e6 / seconds:>9.1f} MB/s"
+              f"{(peak or float('nan')) / 1e6:>9.1f} MB RSS")
+
+    tars = sorted(glob.glob(os.path.join(tar_dir, '*.tar.gz')))
+    record('combine', tars, lambda: count_lines(combined) - 1,
+           # Without resume, so every repeat combines from scratch instead of skipping committed archives
+           [sys.executable, '-c', 'import sys, combine_data; '
+            'combine_data.combine_csv_from_tar_by_year(sys.argv[1], sys.argv[2], resume=False)',
+            tar_dir, combined_dir])
+
+    record('map', [combined], count_lines(combined) - 1, [sys.executable, script('mapper.py')],
+           stdin_path=combined, stdout_path=map_output)
+
+    sort_map_output(map_output, sorted_output)
+    record('reduce', [sorted_output], count_lines(sorted_output), [sys.executable, script('reducer.py')],
+           stdin_path=sorted_output, stdout_path=reduce_output)
+
+    reducer_to_seasonal(reduce_output, seasonal)
+    record('process', [seasonal], count_lines(seasonal) - 1,
+           [sys.executable, '-c', 'import sys, process; '
+            'process.build_plan(sys.argv[1], sys.argv[2], sys.argv[3]).run()', seasonal, processed, cube_dir])
+
+    record('visualize', [processed], count_lines(processed) - 1,
+           [sys.executable, script('visualization.py'), '--batch', '--force', '--no-summary', '--dpi', '100',
+            '--output-dir', os.path.join(run_dir, 'graphs')])
+    return results
+
+def compare(results, baseline, threshold):
+    # (stage, size, change in %) for every stage slower than the threshold
+    previous = {(r['stage'], r['size']): r for r in baseline['runs']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['stage'], result['size']))
+        if before is None:
+            continue
+        change = (result['seconds'] / before['seconds'] - 1) * 100
+        result['baseline_seconds'] = before['seconds']
+        result['change_percent'] = change
+        if change > threshold:
+            regressions.append((result['stage'], result['size'], change))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data")
+    parser.add_argument('--sizes', default='small,medium', help=f"comma-separated from {list(SIZES)}")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"comma-separated from {STAGES}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="runs per stage; the fastest is kept")
+    parser.add_argument('--work-dir', default=os.path.join('data', 'bench'))
+    parser.add_argument('--output', default='bench_results.json', help="JSON file for the results")
+    parser.add_argument('--baseline', default=None, help="results JSON of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help="fail when a stage is more than this many percent slower than the baseline")
+    args = parser.parse_args()
+
+    sizes = [s for s in args.sizes.split(',') if s]
+    stages = [s for s in args.stages.split(',') if s]
+    unknown = [s for s in sizes if s not in SIZES] + [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"Unknown sizes or stages: {unknown}")
+
+    print(f"{'':2}{'Size':<8}{'Stage':<11}{'Wall':>9}{'Throughput':>18}{'':>15}{'Peak':>12}")
+    results = []
+    for size in sizes:
+        results += bench_size(args.work_dir, size, args.seed, stages, args.repeat)
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'runs': results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report['baseline'] = args.baseline
+        report['threshold_percent'] = args.threshold
+        report['regressions'] = [{'stage': s, 'size': z, 'change_percent': c} for s, z, c in regressions]
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+    for stage, size, change in regressions:
+        print(f"REGRESSION: {stage} ({size}) is {change:.1f}% slower than the baseline")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,90 @@
+# Manifests of completed work units, so long jobs can resume after a crash.
+#
+# A job is cut into units (a batch of archive members in combine_data.py, a
+# map task or reduce partition in local_runner.py). Each unit writes its
+# files under a temporary name and renames them into place (write_atomic).
+# Only then is it recorded in the manifest, which is itself replaced
+# atomically. After a restart, units in the manifest are skipped, and any
+# other unit is redone from scratch, overwriting what a crashed attempt
+# left behind. No unit's output is counted twice.
+#
+# The manifest stores a fingerprint of the job's inputs and settings. If it
+# no longer matches, the old manifest is ignored, so results made from
+# other inputs or options are never reused. The code is an input too:
+# local_modules() finds the modules a script imports.
+import os
+import ast
+import json
+import threading
+
+MANIFEST = '_manifest.json'
+
+def file_identity(path):
+    # Cheap stand-in for the content: a rewritten input changes size or mtime
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+def local_imports(path, found=None):
+    # path and every module next to it that it imports, directly or through other modules
+    found = set() if found is None else found
+    found.add(path)
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules = [node.module]
+        else:
+            continue
+        for module in modules:
+            module_path = os.path.join(os.path.dirname(path), module.split('.')[0] + '.py')
+            if module_path not in found and os.path.exists(module_path):
+                local_imports(module_path, found)
+    return found
+
+def local_modules(*paths):
+    # Sorted paths of the scripts and of the local modules they import
+    found = set()
+    for path in paths:
+        local_imports(path, found)
+    return sorted(found)
+
+def write_atomic(path, write):
+    # write(f) fills a temporary file, which then replaces path in one step
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
+
+def write_json(path, data):
+    write_atomic(path, lambda f: f.write(json.dumps(data, indent=1).encode()))
+
+class Checkpoint:
+    def __init__(self, path, fingerprint, resume=True):
+        self.path = path
+        self.lock = threading.Lock()
+        # Through JSON once, so tuples compare equal to the lists read back
+        fingerprint = json.loads(json.dumps(fingerprint))
+        self.data = {'fingerprint': fingerprint, 'units': {}}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('fingerprint') == fingerprint:
+                self.data = data
+
+    @property
+    def units(self):
+        return self.data['units']
+
+    @property
+    def resumed(self):
+        return bool(self.units)
+
+    def get(self, unit):
+        # The info recorded when the unit was committed, or None if it has not been
+        return self.units.get(unit)
+
+    def commit(self, unit, info=None):
+        with self.lock:
+            self.units[unit] = info if info is not None else {}
+            write_json(self.path, self.data)
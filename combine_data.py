@@ -4,6 +4,16 @@ import tarfile
 import io
 import glob
 import re
+import shutil
+import argparse
+from metrics import Metrics, file_size
+from profiling import Profiler
+from checkpoint import MANIFEST, Checkpoint, file_identity
+from scheduler import Scheduler
+
+# Work committed so far, kept in the output directory until the run completes
+CHECKPOINT_DIR = '_checkpoint'
+MEMBERS_PER_CHECKPOINT = 1000
 
 def find_data_directory():
     """
@@ -62,7 +72,126 @@ def find_data_directory():
             
     return None
 
-def combine_csv_from_tar_by_year(tar_dir, output_dir):
+def open_checkpoint(output_dir, fingerprint, resume=True):
+    # Fresh directory unless an interrupted run of the same inputs is resumed
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR)
+    checkpoint = Checkpoint(os.path.join(checkpoint_dir, MANIFEST), fingerprint, resume)
+    if checkpoint.resumed:
+        print(f"Resuming: {len(checkpoint.units)} units done in an earlier run")
+    else:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    return checkpoint, checkpoint_dir
+
+def remove_checkpoint(output_dir):
+    shutil.rmtree(os.path.join(output_dir, CHECKPOINT_DIR), ignore_errors=True)
+
+def write_csv(df, path):
+    # Readers never see a partly written file
+    df.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+def write_batch(year_data, checkpoint_dir, prefix):
+    # One pickle per year for a batch of members, so the concat does not parse CSV again; returns {year: file name}
+    files = {}
+    for year, dfs in year_data.items():
+        name = f"{prefix}.{year}.pkl"
+        path = os.path.join(checkpoint_dir, name)
+        pd.concat(dfs, ignore_index=True).to_pickle(path + '.tmp', compression=None)
+        os.replace(path + '.tmp', path)
+        files[year] = name
+    return files
+
+def member_year(csv_file, tar_name):
+    # Extract year from the file path
+    path_parts = csv_file.split('/')
+    
+    # Look for year in path parts
+    for part in path_parts:
+        if part.isdigit() and len(part) == 4:
+            return part
+    
+    # If no year found in path, try to extract from filename
+    filename = os.path.basename(csv_file)
+    # Look for a standalone 4-digit year in filename; station
+    # ids like 01999099999.csv contain year-like digits
+    year_match = re.search(r'(?<!\d)(19|20)\d{2}(?!\d)', filename)
+    if year_match:
+        return year_match.group(0)
+    
+    # If still no year, use the tar filename
+    year_match = re.search(r'(?<!\d)(19|20)\d{2}(?!\d)', tar_name)
+    return year_match.group(0) if year_match else "unknown"
+
+def count_csv_members(tar_path):
+    with tarfile.open(tar_path, 'r:*') as tar:
+        return sum(1 for name in tar.getnames() if name.lower().endswith('.csv'))
+
+class ArchiveCursor:
+    """
+    Reads an archive's CSV members in order. A batch that starts where the
+    previous one stopped continues the same stream, so a compressed archive
+    is not decompressed again from the start.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tar = tarfile.open(path, 'r:*')
+        # CSV members passed so far
+        self.position = 0
+
+    def read(self, start, count):
+        # (name, file object or None) of CSV members start .. start + count - 1
+        if start < self.position:
+            self.close()
+            self.__init__(self.path)
+        while self.position < start + count:
+            member = self.tar.next()
+            if member is None:
+                break
+            if not member.name.lower().endswith('.csv'):
+                continue
+            self.position += 1
+            if self.position > start:
+                yield member.name, self.tar.extractfile(member)
+
+    def close(self):
+        self.tar.close()
+
+def read_batch(cursor, tar_name, start, count, attempt):
+    # {year: [df]} of one batch of members, and its row and member counts
+    year_data = {}
+    rows = members = 0
+    for csv_file, file_obj in cursor.read(start, count):
+        attempt.check()
+        try:
+            year = member_year(csv_file, tar_name)
+            
+            # Read the extracted file as df
+            if file_obj:
+                df = pd.read_csv(io.BytesIO(file_obj.read()))
+                
+                # Add to the year's df
+                year_data.setdefault(year, []).append(df)
+                rows += len(df)
+                members += 1
+            else:
+                print(f"    Error: Could not extract {csv_file}")
+        
+        except Exception as e:
+            print(f"    Error processing {csv_file}: {e}")
+    return year_data, rows, members
+
+def combine_csv_from_tar_by_year(tar_dir, output_dir, metrics=None, profiler=None, resume=True,
+                                 members_per_checkpoint=MEMBERS_PER_CHECKPOINT, workers=None, speculate=True):
+    """
+    Combine the CSV members of the tar archives into one file per year.
+    Members are read in batches that are committed to a checkpoint, so an
+    interrupted run picks up at the first unfinished batch (see checkpoint.py).
+    The batches are spread over worker threads by scheduler.py; a worker keeps
+    reading the archive it is on, and steals batches when it runs out.
+    """
+    metrics = metrics or Metrics.disabled()
+    profiler = profiler or Profiler.from_env('combine_data')
  
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
@@ -78,109 +207,142 @@ def combine_csv_from_tar_by_year(tar_dir, output_dir):
         return None
     
     print(f"Found {len(tar_files)} tar archives")
-    
-    # Dictionary to hold df by year
-    year_data = {}
-    total_files_processed = 0
-    
-    # Process each tar file
-    for tar_path in tar_files:
-        tar_name = os.path.basename(tar_path)
-        print(f"Processing archive: {tar_name}")
+    checkpoint, checkpoint_dir = open_checkpoint(
+        output_dir, {'archives': [file_identity(path) for path in tar_files],
+                     'members_per_checkpoint': members_per_checkpoint, 'batch_format': 'pickle'}, resume)
+    tar_names = [os.path.basename(path) for path in tar_files]
+    pending = [i for i, name in enumerate(tar_names) if checkpoint.get(name) is None]
+    for name in tar_names:
+        if checkpoint.get(name) is not None:
+            print(f"Skipping archive: {name} (combined in an earlier run)")
+    
+    with metrics.stage('archive_read') as stage:
+        # CSV member counts of the archives still to read, which fix the batches
+        def count_task(i, attempt):
+            counted = checkpoint.get(f"{tar_names[i]}:members")
+            if counted is not None:
+                return counted['count'], None
+            try:
+                count = count_csv_members(tar_files[i])
+            except Exception as e:
+                return None, e
+            checkpoint.commit(f"{tar_names[i]}:members", {'count': count})
+            return count, None
+        
+        scheduler = Scheduler(workers, speculate=False)
+        counts = {}
+        for i, (count, error) in zip(pending, scheduler.run(pending, count_task,
+                                                            size=lambda i: file_size(tar_files[i]))):
+            print(f"Processing archive: {tar_names[i]}")
+            if error is not None:
+                print(f"  Error opening tar file {tar_names[i]}: {error}")
+            elif count == 0:
+                print(f"  No CSV files found in {tar_names[i]}. Skipping.")
+            else:
+                print(f"  Found {count} CSV files in archive")
+                counts[i] = count
+        
+        # One unit per batch of members; an archive's batches stay with one worker unless stolen
+        units = [(i, batch_start) for i, count in counts.items()
+                 for batch_start in range(0, count, members_per_checkpoint)
+                 if checkpoint.get(f"{tar_names[i]}:{batch_start}") is None]
+        cursors = {}
+        progress = {'members': 0}
+        
+        def batch_task(unit, attempt):
+            i, batch_start = unit
+            cursor = cursors.get(attempt.worker)
+            if cursor is None or cursor.path != tar_files[i]:
+                if cursor is not None:
+                    cursor.close()
+                cursor = cursors[attempt.worker] = ArchiveCursor(tar_files[i])
+            # Profiled on the worker thread, where the member loop runs
+            with profiler.section('tar_members'):
+                year_data, rows, members = read_batch(cursor, tar_names[i], batch_start, members_per_checkpoint,
+                                                      attempt)
+            prefix = f"{i:04d}-{batch_start:07d}-{attempt.number}"
+            return {'years': write_batch(year_data, checkpoint_dir, prefix), 'members': members, 'rows': rows}
         
+        def commit_batch(unit, attempt, batch):
+            # Runs under the scheduler's lock: the batch's files are written, now record it
+            i, batch_start = unit
+            checkpoint.commit(f"{tar_names[i]}:{batch_start}", batch)
+            stage.count(rows_out=batch['rows'], members=batch['members'])
+            # Notify every 1000 files
+            before, progress['members'] = progress['members'], progress['members'] + batch['members']
+            if before // 1000 != progress['members'] // 1000:
+                print(f"    Progress: Processed {progress['members']} files in this run")
+        
+        def discard_batch(unit, attempt):
+            i, batch_start = unit
+            for path in glob.glob(os.path.join(checkpoint_dir, f"{i:04d}-{batch_start:07d}-{attempt.number}.*")):
+                os.remove(path)
+        
+        scheduler = Scheduler(workers, speculate)
         try:
-            with tarfile.open(tar_path, 'r:*') as tar:
-                # Get all csv files from the archive
-                csv_files = [f for f in tar.getnames() if f.lower().endswith('.csv')]
-                
-                if not csv_files:
-                    print(f"  No CSV files found in {tar_name}. Skipping.")
-                    continue
-                
-                print(f"  Found {len(csv_files)} CSV files in archive")
-                archive_files_processed = 0
-                
-                # Process each csv file in the tar archive
-                for csv_file in csv_files:
-                    try:
-                        # Extract year from the file path
-                        path_parts = csv_file.split('/')
-                        year = None
-                        
-                        # Look for year in path parts
-                        for part in path_parts:
-                            if part.isdigit() and len(part) == 4:
-                                year = part
-                                break
-                        
-                        # If no year found in path, try to extract from filename
-                        if not year:
-                            filename = os.path.basename(csv_file)
-                            # Look for 4-digit year in filename
-                            year_match = re.search(r'(19|20)\d{2}', filename)
-                            if year_match:
-                                year = year_match.group(0)
-                        
-                        # If still no year, use the tar filename
-                        if not year:
-                            year_match = re.search(r'(19|20)\d{2}', tar_name)
-                            if year_match:
-                                year = year_match.group(0)
-                            else:
-                                year = "unknown"
-                        
-                        # Extract file from tar and read as df
-                        file_obj = tar.extractfile(csv_file)
-                        if file_obj:
-                            content = file_obj.read()
-                            df = pd.read_csv(io.BytesIO(content))
-                            
-                            # Add to the year's df
-                            if year not in year_data:
-                                year_data[year] = []
-                            
-                            year_data[year].append(df)
-                            
-                            # Update counters
-                            archive_files_processed += 1
-                            total_files_processed += 1
-                            
-                            # Notify every 1000 files
-                            if total_files_processed % 1000 == 0:
-                                print(f"    Progress: Processed {total_files_processed} files total")
-                        else:
-                            print(f"    Error: Could not extract {csv_file}")
-                    
-                    except Exception as e:
-                        print(f"    Error processing {csv_file}: {e}")
-                
-                print(f"  Completed processing {archive_files_processed} files from {tar_name}")
+            scheduler.run(units, batch_task, commit_batch, discard_batch,
+                          size=lambda unit: min(members_per_checkpoint, counts[unit[0]] - unit[1]),
+                          affinity=lambda unit: unit[0])
+        finally:
+            for cursor in cursors.values():
+                cursor.close()
+        if units:
+            scheduler.record(metrics)
+            print(f"Read {len(units)} batches: {scheduler.summary()}")
         
-        except Exception as e:
-            print(f"  Error opening tar file {tar_name}: {e}")
+        for i, count in counts.items():
+            stage.count(bytes_in=file_size(tar_files[i]))
+            # Commit the archive as a whole, so a resumed run does not open it
+            archive_years = {}
+            archive_files_processed = 0
+            for batch_start in range(0, count, members_per_checkpoint):
+                batch = checkpoint.get(f"{tar_names[i]}:{batch_start}")
+                archive_files_processed += batch['members']
+                for year, name in batch['years'].items():
+                    archive_years.setdefault(year, []).append(name)
+            checkpoint.commit(tar_names[i], {'years': archive_years, 'members': archive_files_processed})
+            print(f"  Completed processing {archive_files_processed} files from {tar_names[i]}")
+    
+    # Batch files of each year, in archive and member order
+    year_files = {}
+    total_files_processed = 0
+    for name in tar_names:
+        done = checkpoint.get(name)
+        if done is None:
+            continue
+        for year, names in done['years'].items():
+            year_files.setdefault(year, []).extend(names)
+        total_files_processed += done['members']
     
     print(f"Total files processed across all archives: {total_files_processed}")
     
     # Combine and save data for each year
-    for year, dfs in year_data.items():
-        if not dfs:
+    for year, names in year_files.items():
+        if not names:
             print(f"No valid data found for {year}")
             continue
         
-        print(f"Combining {len(dfs)} files for year {year}...")
+        print(f"Combining {len(names)} batches for year {year}...")
         
-        # Combine all dfs for this year
-        combined_df = pd.concat(dfs, ignore_index=True)
+        # Combine all batches for this year
+        with metrics.stage('concat') as stage:
+            combined_df = pd.concat([pd.read_pickle(os.path.join(checkpoint_dir, name), compression=None)
+                                     for name in names], ignore_index=True)
+            stage.count(rows_in=len(combined_df), rows_out=len(combined_df))
         
         if not combined_df.empty:
             output_file = os.path.join(output_dir, f"{year}_combined.csv")
-            combined_df.to_csv(output_file, index=False)
+            with metrics.stage('write') as stage:
+                write_csv(combined_df, output_file)
+                stage.count(rows_out=len(combined_df), bytes_out=file_size(output_file))
             print(f"Saved combined data for {year} to {output_file}")
             print(f"  Total rows: {len(combined_df)}")
     
-    return year_data.keys() if year_data else None
+    return year_files.keys() if year_files else None
 
-def combine_csv_by_year(data_dir, output_dir):
+def combine_csv_by_year(data_dir, output_dir, metrics=None, resume=True):
+    # Each year directory is a unit; an interrupted run skips the years it finished
+    metrics = metrics or Metrics.disabled()
   
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
@@ -198,10 +360,20 @@ def combine_csv_by_year(data_dir, output_dir):
     
     print(f"Found year directories: {potential_year_dirs}")
     years_processed = []
+    year_csv_files = {year_dir: glob.glob(os.path.join(data_dir, year_dir, '*.csv'))
+                      for year_dir in potential_year_dirs}
+    checkpoint, _ = open_checkpoint(
+        output_dir, {year_dir: [file_identity(f) for f in files] for year_dir, files in year_csv_files.items()},
+        resume)
     
     for year_dir in potential_year_dirs:
         year_path = os.path.join(data_dir, year_dir)
-        csv_files = glob.glob(os.path.join(year_path, '*.csv'))
+        csv_files = year_csv_files[year_dir]
+        
+        if checkpoint.get(year_dir) is not None:
+            print(f"Skipping {year_dir} (combined in an earlier run)")
+            years_processed.append(year_dir)
+            continue
         
         if not csv_files:
             print(f"No CSV files found in {year_path}. Skipping.")
@@ -214,23 +386,29 @@ def combine_csv_by_year(data_dir, output_dir):
         files_processed = 0
         
         # Read and combine all csv files for the current year
-        for file in csv_files:
-            try:
-                df = pd.read_csv(file)
-                combined_data = pd.concat([combined_data, df], ignore_index=True)
-                files_processed += 1
-                
-                # Notify every 1000 files
-                if files_processed % 1000 == 0:
-                    print(f"  Progress: Processed {files_processed} files")
-                
-            except Exception as e:
-                print(f"  Error processing {os.path.basename(file)}: {e}")
+        with metrics.stage('concat') as stage:
+            for file in csv_files:
+                try:
+                    df = pd.read_csv(file)
+                    combined_data = pd.concat([combined_data, df], ignore_index=True)
+                    files_processed += 1
+                    stage.count(rows_in=len(df), bytes_in=file_size(file))
+                    
+                    # Notify every 1000 files
+                    if files_processed % 1000 == 0:
+                        print(f"  Progress: Processed {files_processed} files")
+                    
+                except Exception as e:
+                    print(f"  Error processing {os.path.basename(file)}: {e}")
+            stage.count(rows_out=len(combined_data))
         
         if not combined_data.empty:
             # Save the combined data
             output_file = os.path.join(output_dir, f"{year_dir}_combined.csv")
-            combined_data.to_csv(output_file, index=False)
+            with metrics.stage('write') as stage:
+                write_csv(combined_data, output_file)
+                stage.count(rows_out=len(combined_data), bytes_out=file_size(output_file))
+            checkpoint.commit(year_dir)
             print(f"Saved combined data for {year_dir} to {output_file}")
             print(f"  Total rows: {len(combined_data)}")
             years_processed.append(year_dir)
@@ -239,7 +417,8 @@ def combine_csv_by_year(data_dir, output_dir):
     
     return years_processed
 
-def combine_all_years(output_dir, years=None):
+def combine_all_years(output_dir, years=None, metrics=None):
+    metrics = metrics or Metrics.disabled()
     
     if years is None or not years:
         # Get all combined files if years not provided
@@ -260,19 +439,24 @@ def combine_all_years(output_dir, years=None):
     files_processed = 0
     
     # Read and combine all year files
-    for file in combined_files:
-        try:
-            df = pd.read_csv(file)
-            all_data = pd.concat([all_data, df], ignore_index=True)
-            files_processed += 1
-            print(f"  Added: {os.path.basename(file)}")
-        except Exception as e:
-            print(f"  Error processing {os.path.basename(file)}: {e}")
+    with metrics.stage('concat') as stage:
+        for file in combined_files:
+            try:
+                df = pd.read_csv(file)
+                all_data = pd.concat([all_data, df], ignore_index=True)
+                files_processed += 1
+                stage.count(rows_in=len(df), bytes_in=file_size(file))
+                print(f"  Added: {os.path.basename(file)}")
+            except Exception as e:
+                print(f"  Error processing {os.path.basename(file)}: {e}")
+        stage.count(rows_out=len(all_data))
     
     if not all_data.empty:
         # Save the master combined data
         output_file = os.path.join(output_dir, "all_years_combined.csv")
-        all_data.to_csv(output_file, index=False)
+        with metrics.stage('write') as stage:
+            write_csv(all_data, output_file)
+            stage.count(rows_out=len(all_data), bytes_out=file_size(output_file))
         print(f"Saved master combined data to {output_file}")
         print(f"  Total files combined: {files_processed}")
         print(f"  Total rows: {len(all_data)}")
@@ -280,10 +464,27 @@ def combine_all_years(output_dir, years=None):
         print("No valid data found to combine.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Combine the station CSV files into one file per year")
+    parser.add_argument('--data-dir', default=None, help="directory with the archives (default: auto-detect)")
+    parser.add_argument('--output-dir', default=None, help="default: combined_data next to this script")
+    parser.add_argument('--metrics', default=None, help="write a JSON metrics document for the run to this file")
+    parser.add_argument('--profile', default=None,
+                        help="write cProfile and sampled-stack output of the tar member loop to this directory")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="start over instead of skipping the work an interrupted run committed")
+    parser.add_argument('--members-per-checkpoint', type=int, default=MEMBERS_PER_CHECKPOINT,
+                        help="archive members per batch: the unit of scheduling and of checkpoint commits")
+    parser.add_argument('--workers', type=int, default=None, help="threads reading archive batches")
+    parser.add_argument('--no-speculation', action='store_true',
+                        help="do not start second attempts of straggling batches")
+    args = parser.parse_args()
+    metrics = Metrics('combine_data', enabled=bool(args.metrics))
+    profiler = Profiler.configure('combine_data', args.profile)
+
     print("Data Combiner - Auto-detecting directories...")
     
     # Auto-detect data directory
-    data_dir = find_data_directory()
+    data_dir = args.data_dir or find_data_directory()
     
     if not data_dir:
         print("Could not find data directory automatically.")
@@ -291,7 +492,7 @@ if __name__ == "__main__":
     
     # Get the script directory for output
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    combined_dir = os.path.join(script_dir, 'combined_data')
+    combined_dir = args.output_dir or os.path.join(script_dir, 'combined_data')
     
     print(f"\nData directory: {data_dir}")
     print(f"Output directory: {combined_dir}")
@@ -303,14 +504,22 @@ if __name__ == "__main__":
     
     if tar_files:
         print("\n1. Found tar files - Combining CSV files from tar archives by year...")
-        years = combine_csv_from_tar_by_year(data_dir, combined_dir)
+        with metrics.stage('combine_by_year'):
+            years = combine_csv_from_tar_by_year(data_dir, combined_dir, metrics, profiler,
+                                                 not args.no_resume, args.members_per_checkpoint,
+                                                 args.workers, not args.no_speculation)
     else:
         print("\n1. No tar files found - Looking for year directories with CSV files...")
-        years = combine_csv_by_year(data_dir, combined_dir)
+        with metrics.stage('combine_by_year'):
+            years = combine_csv_by_year(data_dir, combined_dir, metrics, not args.no_resume)
     
     if years:
         print("\n2. Creating master combined file...")
-        combine_all_years(combined_dir, years)
+        with metrics.stage('combine_all_years'):
+            combine_all_years(combined_dir, years, metrics)
+        # Kept until here so that a failure in step 2 does not redo step 1
+        remove_checkpoint(combined_dir)
         print("\nProcess completed successfully!")
     else:
-        print("\nNo data was processed. Please check your directory structure.")
\ No newline at end of file
+        print("\nNo data was processed. Please check your directory structure.")
+    metrics.save(args.metrics)
\ No newline at end of file
@@ -0,0 +1,128 @@
+# Task instrumentation over the Hadoop Streaming stderr protocol.
+#
+# A streaming task reports to the framework by writing lines to stderr:
+#   reporter:counter:<group>,<counter>,<amount>
+#   reporter:status:<message>
+# Hadoop adds the amounts up per job and shows them with the job's counters.
+# TaskReporter keeps the counts in a dict and only writes the deltas at a
+# flush (every status_interval seconds and at the end), so counting costs a
+# dict update per record rather than a write. The same stderr lines are
+# parsed by local_runner.py (JobCounters), so local runs get the same
+# counters.
+#
+# Per-record error messages are rate-limited: at most error_limit lines per
+# status interval, the rest only show up in the errors_suppressed counter.
+import sys
+import json
+import time
+import threading
+
+COUNTER_PREFIX = 'reporter:counter:'
+STATUS_PREFIX = 'reporter:status:'
+
+class TaskReporter:
+    def __init__(self, group, stream=None, status_interval=30.0, error_limit=10, check_every=10_000):
+        self.group = group
+        self.stream = stream or sys.stderr
+        self.status_interval = status_interval
+        self.error_limit = error_limit
+        self.check_every = check_every
+        self.counters = {}
+        self._reported = {}
+        self._ticks = 0
+        self.start = self._last_flush = time.perf_counter()
+        self._errors_in_window = 0
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def tick(self):
+        # Call once per input record; only looks at the clock every check_every records
+        self._ticks += 1
+        if self._ticks >= self.check_every:
+            self._ticks = 0
+            if time.perf_counter() - self._last_flush >= self.status_interval:
+                self.flush()
+                self.status(self.progress())
+
+    def progress(self):
+        elapsed = time.perf_counter() - self.start
+        records = self.counters.get('records_in', 0)
+        return (f"{self.group}: {records} records in, {self.counters.get('records_emitted', 0)} emitted, "
+                f"{records / elapsed if elapsed else 0:.0f} records/s")
+
+    def error(self, message):
+        if self._errors_in_window < self.error_limit:
+            self._errors_in_window += 1
+            self.stream.write(f"ERROR {message}\n")
+        else:
+            self.count('errors_suppressed')
+
+    def status(self, message):
+        self.stream.write(f"{STATUS_PREFIX}{message}\n")
+        self.stream.flush()
+
+    def flush(self):
+        # Counters are incremented by the amount since the last flush
+        for name, value in self.counters.items():
+            delta = value - self._reported.get(name, 0)
+            if delta:
+                self.stream.write(f"{COUNTER_PREFIX}{self.group},{name},{delta}\n")
+        self._reported = dict(self.counters)
+        self._last_flush = time.perf_counter()
+        self._errors_in_window = 0
+        self.stream.flush()
+
+    def close(self):
+        suppressed = self.counters.get('errors_suppressed', 0)
+        self.flush()
+        if suppressed:
+            self.stream.write(f"{suppressed} further errors were not logged\n")
+        self.status(self.progress() + " (done)")
+
+class JobCounters:
+    # Job-wide totals of the counters reported by local tasks; thread-safe
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def parse(self, stderr, passthrough=None):
+        """
+        Add up the counter lines in a task's stderr (bytes). Other lines,
+        except status lines, are written to passthrough.
+        """
+        other = []
+        with self.lock:
+            for line in stderr.decode(errors='replace').splitlines():
+                if line.startswith(COUNTER_PREFIX):
+                    group, name, amount = line[len(COUNTER_PREFIX):].rsplit(',', 2)
+                    key = (group, name)
+                    self.values[key] = self.values.get(key, 0) + int(amount)
+                elif not line.startswith(STATUS_PREFIX):
+                    other.append(line)
+        if other and passthrough is not None:
+            passthrough.write('\n'.join(other) + '\n')
+
+    def add(self, counts):
+        # Add totals in the as_dict() layout, e.g. those of a task finished by an earlier run
+        with self.lock:
+            for group, values in counts.items():
+                for name, value in values.items():
+                    self.values[(group, name)] = self.values.get((group, name), 0) + value
+
+    def as_dict(self):
+        result = {}
+        for (group, name), value in sorted(self.values.items()):
+            result.setdefault(group, {})[name] = value
+        return result
+
+    def print(self):
+        print("Counters:")
+        for group, values in self.as_dict().items():
+            print(f"  {group}")
+            for name, value in values.items():
+                print(f"    {name}={value}")
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
@@ -1,5 +1,8 @@
+import os
 import re
 import csv
+import glob
+import argparse
 
 # The data
 raw_data = """ 841199999,2016,Winter   Average: 81.60, Max: 81.60, Min: 81.60
@@ -1582,6 +1585,19 @@ raw_data = """ 841199999,2016,Winter   Average: 81.60, Max: 81.60, Min: 81.60
 99999994785,2025,Winter Average: 26.50, Max: 42.90, Min: 11.00
 """
 
+parser = argparse.ArgumentParser(description="Convert the reducer output into seasonal_temperatures.csv")
+parser.add_argument('--input', nargs='*', default=None,
+                    help="reducer output files, e.g. part-* (default: the raw_data pasted above)")
+parser.add_argument('--output', default=os.path.join('data', 'seasonal_temperatures.csv'))
+args = parser.parse_args()
+
+if args.input:
+    raw_data = ''
+    for pattern in args.input:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path) as f:
+                raw_data += f.read()
+
 # Extract data using regex
 pattern = r'(\d+),(\d{4}),(Spring|Summer|Fall|Winter)\s+Average:\s*([\d\.\-]+), Max:\s*([\d\.\-]+), Min:\s*([\d\.\-]+)'
 matches = re.findall(pattern, raw_data)
@@ -1590,9 +1606,9 @@ matches = re.findall(pattern, raw_data)
 print(f"Found {len(matches)} records")
 
 # Write to CSV
-with open("seasonal_temperatures.csv", "w", newline="") as file:
+with open(args.output, "w", newline="") as file:
     writer = csv.writer(file)
     writer.writerow(["StationID", "Year", "Season", "AverageTemp", "MaxTemp", "MinTemp"])
     writer.writerows(matches)
 
-print("Saved as 'seasonal_temperatures.csv'")
+print(f"Saved as '{args.output}'")
@@ -0,0 +1,126 @@
+# Dense station x year x season x metric array of the seasonal statistics.
+#
+# Stations and years are turned into category codes once and the metric
+# values are scattered into a NumPy array in a single vectorized assignment,
+# so any (station, year, season, metric) cell is one index lookup away.
+# A cube is saved as plain .npy files that can be memory-mapped, which lets
+# process.py and visualization.py share it without re-parsing CSV.
+import os
+import numpy as np
+import pandas as pd
+from keys import SEASONS, SEASON_CODES
+
+METRICS = ['AverageTemp', 'MaxTemp', 'MinTemp']
+
+def category_codes(df):
+    # Sorted station ids and a dense year range, with each row's position in them
+    station_codes, stations = pd.factorize(df['StationID'].astype('int64'), sort=True)
+    year_values = df['Year'].to_numpy(dtype='int64')
+    first_year = year_values.min() if len(year_values) else 0
+    years = np.arange(first_year, year_values.max() + 1) if len(year_values) else np.arange(0)
+    return station_codes, stations, year_values - first_year, years
+
+class SeasonCube:
+    def __init__(self, values, stations, years):
+        # values has shape (stations, years, seasons, metrics) with NaN for no data
+        self.values = values
+        self.stations = np.asarray(stations, dtype='int64')
+        self.years = np.asarray(years, dtype='int64')
+        self._station_index = None
+
+    @classmethod
+    def empty(cls, stations, years):
+        values = np.full((len(stations), len(years), len(SEASONS), len(METRICS)), np.nan)
+        return cls(values, stations, years)
+
+    @classmethod
+    def from_long(cls, df):
+        """
+        Build from seasonal_temperatures rows (StationID, Year, Season, metrics).
+        Season may be names or codes. Repeated keys are averaged, as the
+        pivot_table this replaced did.
+        """
+        seasons = df['Season']
+        if not pd.api.types.is_integer_dtype(seasons):
+            seasons = seasons.map(SEASON_CODES)
+        df = df[['StationID', 'Year'] + METRICS].assign(Season=seasons.to_numpy(dtype='int64'))
+        if df.duplicated(['StationID', 'Year', 'Season']).any():
+            # Mean per key, skipping NaN; the scatter below would keep only the last row
+            df = df.groupby(['StationID', 'Year', 'Season'], sort=False)[METRICS].mean().reset_index()
+        station_codes, stations, year_codes, years = category_codes(df)
+
+        cube = cls.empty(stations, years)
+        cube.values[station_codes, year_codes, df['Season'].to_numpy(dtype='int64')] = \
+            df[METRICS].to_numpy(dtype='float64')
+        return cube
+
+    @classmethod
+    def from_wide(cls, df):
+        # Build from the processed_data layout (StationID, Year, Metric_Season columns)
+        station_codes, stations, year_codes, years = category_codes(df)
+
+        cube = cls.empty(stations, years)
+        for m, metric in enumerate(METRICS):
+            for season, code in SEASON_CODES.items():
+                column = f'{metric}_{season}'
+                if column in df.columns:
+                    cube.values[station_codes, year_codes, code, m] = df[column].to_numpy(dtype='float64')
+        return cube
+
+    def column_names(self):
+        # Metric_Season names in cube order (metric major, season code minor)
+        return [f'{metric}_{season}' for metric in METRICS for season in SEASONS]
+
+    def present_rows(self):
+        # (stations, years) mask of station-years with any data
+        return ~np.isnan(self.values).all(axis=(2, 3))
+
+    def to_wide(self, rows=None):
+        """
+        The processed_data layout: one row per station-year with any data (or
+        per True cell of a rows mask), ordered by station and year, columns
+        sorted by metric then season name.
+        """
+        if rows is None:
+            rows = self.present_rows()
+        station_idx, year_idx = np.nonzero(rows)
+        data = self.values[station_idx, year_idx].transpose(0, 2, 1).reshape(len(station_idx), -1)
+
+        columns = self.column_names()
+        df = pd.DataFrame(data, columns=columns)
+        df.insert(0, 'StationID', self.stations[station_idx])
+        df.insert(1, 'Year', self.years[year_idx])
+        return df[['StationID', 'Year'] + sorted(columns)]
+
+    def station_index(self, station):
+        if self._station_index is None:
+            self._station_index = {int(s): i for i, s in enumerate(self.stations)}
+        return self._station_index[int(station)]
+
+    def index(self, station, year, season, metric):
+        # Array position of one cell; season and metric may be names or codes
+        if isinstance(season, str):
+            season = SEASON_CODES[season]
+        if isinstance(metric, str):
+            metric = METRICS.index(metric)
+        year_idx = int(year) - int(self.years[0])
+        if not 0 <= year_idx < len(self.years):
+            raise KeyError(year)
+        return self.station_index(station), year_idx, season, metric
+
+    def get(self, station, year, season, metric):
+        return float(self.values[self.index(station, year, season, metric)])
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'values.npy'), self.values)
+        np.save(os.path.join(path, 'stations.npy'), self.stations)
+        np.save(os.path.join(path, 'years.npy'), self.years)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        # With mmap the values are paged in from disk only as they are indexed
+        values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r' if mmap else None)
+        stations = np.load(os.path.join(path, 'stations.npy'))
+        years = np.load(os.path.join(path, 'years.npy'))
+        return cls(values, stations, years)
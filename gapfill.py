@@ -0,0 +1,122 @@
+# Gap filling for the season cube, one station at a time but vectorized
+# over all stations.
+#
+# Missing values are interpolated linearly along the year axis of each
+# (station, season, metric) series, so values never leak between stations.
+# Gaps longer than `limit` years are left alone, and `extend` also fills
+# years before the first / after the last observation with the nearest value.
+# Whatever is still missing afterwards goes through the fallback strategies
+# in order:
+#   'station'  the station's mean for that season and metric over all years
+#   'spatial'  a distance-weighted mean of the nearest stations with data for
+#              that year and season (needs station coordinates, see spatial.py)
+#   'global'   the mean for that season and metric over all stations
+#
+# The steps only ever write into cells that are NaN, so observed values stay
+# in place and can still be told apart with an `observed` mask taken before
+# filling. That lets every step work in place on the cube (or on a block of
+# its stations), which is what plan.py relies on.
+import numpy as np
+from spatial import spatial_fill
+
+FALLBACKS = ['station', 'spatial', 'global']
+
+def interpolate_years(values, limit=None, extend=False, inplace=False):
+    """
+    Fill NaNs in a (stations, years, ...) array along the year axis.
+    Returns a new array unless inplace is set.
+    """
+    if not inplace:
+        values = values.copy()
+    num_years = values.shape[1]
+
+    # Year positions broadcast against the other axes; int16 keeps the
+    # index arrays at a quarter of the size of the values
+    year_idx = np.arange(num_years, dtype='int16').reshape((1, -1) + (1,) * (values.ndim - 2))
+    valid = ~np.isnan(values)
+
+    # Index of the previous and next observed year for every cell
+    prev_idx = np.where(valid, year_idx, np.int16(-1))
+    np.maximum.accumulate(prev_idx, axis=1, out=prev_idx)
+    next_idx = np.where(valid, year_idx, np.int16(num_years))
+    next_idx = np.flip(np.minimum.accumulate(np.flip(next_idx, axis=1), axis=1), axis=1)
+
+    missing = ~valid
+    has_prev = prev_idx >= 0
+    has_next = next_idx < num_years
+
+    inner = missing & has_prev & has_next
+    if limit is not None:
+        inner &= (next_idx - prev_idx - 1) <= limit
+    cells = np.nonzero(inner)
+    station, year, rest = cells[0], cells[1], cells[2:]
+    lo = prev_idx[cells]
+    hi = next_idx[cells]
+    start = values[(station, lo) + rest]
+    values[cells] = start + (values[(station, hi) + rest] - start) * (year - lo) / (hi - lo)
+
+    if extend:
+        # Leading and trailing gaps take the nearest observed value
+        leading = missing & ~has_prev & has_next
+        trailing = missing & has_prev & ~has_next
+        if limit is not None:
+            leading &= (next_idx - year_idx) <= limit
+            trailing &= (year_idx - prev_idx) <= limit
+        cells = np.nonzero(leading)
+        values[cells] = values[(cells[0], next_idx[cells]) + cells[2:]]
+        cells = np.nonzero(trailing)
+        values[cells] = values[(cells[0], prev_idx[cells]) + cells[2:]]
+
+    return values
+
+def masked_mean(values, mask, axis):
+    # Mean of the cells selected by mask, NaN where nothing is selected
+    counts = mask.sum(axis=axis)
+    sums = np.where(mask, values, 0.0).sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def observed_cells(values, present):
+    # Observed values of the station-years that exist in the output
+    return ~np.isnan(values) & present[:, :, None, None]
+
+def season_means(values, observed, decimals=2):
+    # (seasons, metrics) means over all stations and years
+    return np.round(masked_mean(values, observed, axis=(0, 1)), decimals)
+
+def fill_with_means(values, means):
+    # Write means (broadcast against values) into the NaN cells, in place
+    np.copyto(values, np.broadcast_to(means, values.shape), where=np.isnan(values))
+
+def fill_station_means(values, observed, decimals=2):
+    fill_with_means(values, np.round(masked_mean(values, observed, axis=1), decimals)[:, None])
+
+def fill_gaps(values, present, limit=None, extend=False, fallback=('station', 'global'),
+              decimals=2, coords=None, neighbours=5, global_means=None, inplace=False):
+    """
+    Interpolate and then apply the fallbacks to a (stations, years, seasons,
+    metrics) array. `present` marks the station-years that exist in the
+    output; only their observed values feed the fallback means, which are
+    rounded to `decimals` places. `coords` is a (stations, 2) latitude/longitude
+    array for the 'spatial' fallback. `global_means` (seasons, metrics)
+    replaces the 'global' means when the array only holds part of the stations.
+    """
+    observed = observed_cells(values, present)
+    if global_means is None and 'global' in fallback:
+        global_means = season_means(values, observed, decimals)
+
+    filled = interpolate_years(values, limit=limit, extend=extend, inplace=inplace)
+
+    for strategy in fallback:
+        if strategy == 'spatial':
+            if coords is None:
+                raise ValueError("The 'spatial' fallback needs station coordinates")
+            spatial_fill(filled, filled, observed, present, coords, k=neighbours, inplace=True)
+        elif strategy == 'station':
+            fill_station_means(filled, observed, decimals)
+        elif strategy == 'global':
+            fill_with_means(filled, np.asarray(global_means)[None, None])
+        else:
+            raise ValueError(f"Unknown fallback strategy: {strategy}")
+
+    return filled
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# Tiled, multi-resolution station x year heatmap for the whole network.
+#
+# The full matrix (one row per station, one column per year) is the deepest
+# zoom level. Each coarser level halves every axis that is still wider than a
+# tile by adding 2 cells into 1 (with NumPy reshapes), until the whole matrix
+# fits in one tile at level 0. Levels carry the sum and the count of the
+# original values under each cell and are only divided when a tile is
+# rendered, so a coarse cell is the mean of all its stations and years, not a
+# mean of means skewed by blocks with more missing values. Every level is cut
+# into tiles of tile_cells x tile_cells cells and written as fixed-size PNGs
+# to <output>/<level>/<row>_<col>.png. Coarse tiles are colour-mapped arrays
+# written straight with imsave; only the deepest level goes through a
+# matplotlib figure, to annotate each cell with its value.
+# <output>/tiles.json describes the levels for a viewer.
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
+from profiling import Profiler
+
+def station_year_matrix(df, column):
+    # (stations, years) matrix of column, NaN where missing; stations and years sorted
+    stations = np.sort(df['StationID'].unique())
+    years = np.sort(df['Year'].unique())
+    matrix = np.full((len(stations), len(years)), np.nan)
+    rows = df.drop_duplicates(['StationID', 'Year'])
+    matrix[pd.Index(stations).get_indexer(rows['StationID']),
+           pd.Index(years).get_indexer(rows['Year'])] = rows[column].to_numpy(dtype='float64')
+    return matrix, stations, years
+
+def halve(values, axis):
+    # Sum of neighbouring pairs along axis, padding odd lengths with 0
+    if values.shape[axis] % 2:
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (0, 1)
+        values = np.pad(values, pad)
+    shape = list(values.shape)
+    shape[axis:axis + 1] = [shape[axis] // 2, 2]
+    return values.reshape(shape).sum(axis=axis + 1)
+
+def cell_means(sums, counts):
+    # Mean of each cell, NaN where no original value falls under it
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def build_pyramid(matrix, tile_cells=16):
+    """
+    List of (sums, counts, (row_factor, col_factor)) from level 0 (fits one
+    tile) to the full-resolution matrix. sums and counts add up the non-NaN
+    values under each cell; the factors are how many original stations/years
+    each cell covers.
+    """
+    sums = np.nan_to_num(matrix, nan=0.0)
+    counts = (~np.isnan(matrix)).astype(np.int64)
+    levels = [(sums, counts, (1, 1))]
+    while max(levels[0][0].shape) > tile_cells:
+        sums, counts, (row_factor, col_factor) = levels[0]
+        if sums.shape[0] > tile_cells:
+            sums, counts, row_factor = halve(sums, 0), halve(counts, 0), row_factor * 2
+        if sums.shape[1] > tile_cells:
+            sums, counts, col_factor = halve(sums, 1), halve(counts, 1), col_factor * 2
+        levels.insert(0, (sums, counts, (row_factor, col_factor)))
+    return levels
+
+def tile_cells_of(matrix, row, col, tile_cells):
+    # One tile's cells, padded with NaN to tile_cells x tile_cells
+    block = matrix[row * tile_cells:(row + 1) * tile_cells, col * tile_cells:(col + 1) * tile_cells]
+    padded = np.full((tile_cells, tile_cells), np.nan)
+    padded[:block.shape[0], :block.shape[1]] = block
+    return padded
+
+def colour(cells, cmap, norm):
+    # RGBA image of the cells, transparent where NaN
+    rgba = cmap(norm(np.ma.masked_invalid(cells)))
+    rgba[np.isnan(cells)] = 0.0
+    return rgba
+
+def write_plain_tile(path, cells, cmap, norm, tile_px):
+    scale = tile_px // cells.shape[0]
+    rgba = colour(cells, cmap, norm)
+    plt.imsave(path, np.repeat(np.repeat(rgba, scale, axis=0), scale, axis=1))
+
+class AnnotatedTile:
+    # One reusable figure with a text artist per cell; building a figure
+    # costs about as much as drawing the text, so it is only built once
+    def __init__(self, tile_cells, tile_px, dpi=100):
+        self.dpi = dpi
+        self.fig = plt.figure(figsize=(tile_px / dpi, tile_px / dpi), dpi=dpi)
+        ax = self.fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        self.image = ax.imshow(np.zeros((tile_cells, tile_cells, 4)), interpolation='nearest')
+        fontsize = max(4, tile_px / tile_cells / 5)
+        self.texts = [[ax.text(j, i, '', ha='center', va='center', fontsize=fontsize)
+                       for j in range(tile_cells)] for i in range(tile_cells)]
+
+    def write(self, path, cells, cmap, norm):
+        self.image.set_data(colour(cells, cmap, norm))
+        for i, row in enumerate(self.texts):
+            for j, text in enumerate(row):
+                value = cells[i, j]
+                text.set_visible(not np.isnan(value))
+                text.set_text(f'{value:.1f}')
+                text.set_color('black' if value < 70 else 'white')
+        self.fig.savefig(path, dpi=self.dpi, transparent=True)
+
+    def close(self):
+        plt.close(self.fig)
+
+def tile_grid(matrix, tile_cells):
+    # Number of tile rows and columns of a level
+    return -(-matrix.shape[0] // tile_cells), -(-matrix.shape[1] // tile_cells)
+
+# Profiler of a worker process, created on its first task so it sees --profile
+_profiler = None
+
+def worker_profiler():
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler.from_env('heatmap_tiles')
+    return _profiler
+
+def render_rows(output_dir, level, sums, counts, first_row, tile_cells, tile_px, vmin, vmax, annotate,
+                cmap_name='YlOrRd'):
+    # Render the tiles of a block of a level's rows, starting at tile row
+    # first_row; empty tiles are skipped
+    block = cell_means(sums, counts)
+    cmap = plt.get_cmap(cmap_name)
+    norm = Normalize(vmin=vmin, vmax=vmax)
+    level_dir = os.path.join(output_dir, str(level))
+    os.makedirs(level_dir, exist_ok=True)
+    annotated = AnnotatedTile(tile_cells, tile_px) if annotate else None
+    written = 0
+    num_rows, num_cols = tile_grid(block, tile_cells)
+    with worker_profiler().section(f'level{level}'):
+        for row in range(num_rows):
+            for col in range(num_cols):
+                cells = tile_cells_of(block, row, col, tile_cells)
+                if np.isnan(cells).all():
+                    continue
+                path = os.path.join(level_dir, f'{first_row + row}_{col}.png')
+                if annotate:
+                    annotated.write(path, cells, cmap, norm)
+                else:
+                    write_plain_tile(path, cells, cmap, norm, tile_px)
+                written += 1
+    if annotated is not None:
+        annotated.close()
+    return written
+
+def render_tiles(df, output_dir, column='AverageTemp_Summer', tile_cells=16, tile_px=512, levels=None,
+                 workers=None, rows_per_task=16):
+    """
+    Write the tile pyramid of column to output_dir and return the metadata
+    saved as tiles.json. levels limits rendering to some zoom levels.
+    Tiles are rendered in parallel worker processes, rows_per_task tile rows
+    at a time, so the annotated deepest level is spread over all workers.
+    """
+    if tile_px % tile_cells:
+        raise ValueError("tile_px must be a multiple of tile_cells")
+    matrix, stations, years = station_year_matrix(df, column)
+    pyramid = build_pyramid(matrix, tile_cells)
+    deepest = len(pyramid) - 1
+    vmin, vmax = float(np.nanmin(matrix)), float(np.nanmax(matrix))
+
+    selected = range(len(pyramid)) if levels is None else levels
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for level in selected:
+            sums, counts, _ = pyramid[level]
+            num_rows = tile_grid(sums, tile_cells)[0]
+            for first in range(0, num_rows, rows_per_task):
+                # Only the rows of this task are sent to the worker
+                rows = slice(first * tile_cells, (first + rows_per_task) * tile_cells)
+                futures.append(pool.submit(render_rows, output_dir, level, sums[rows], counts[rows], first,
+                                           tile_cells, tile_px, vmin, vmax, level == deepest))
+        tiles = sum(future.result() for future in futures)
+
+    metadata = {
+        'column': column,
+        'tile_cells': tile_cells,
+        'tile_px': tile_px,
+        'vmin': vmin,
+        'vmax': vmax,
+        'annotated_level': deepest,
+        'tiles': tiles,
+        'levels': [{'level': level, 'shape': list(sums.shape), 'stations_per_cell': factors[0],
+                    'years_per_cell': factors[1]} for level, (sums, _, factors) in enumerate(pyramid)],
+        'stations': [int(s) for s in stations],
+        'years': [int(y) for y in years],
+    }
+    with open(os.path.join(output_dir, 'tiles.json'), 'w') as f:
+        json.dump(metadata, f)
+    return metadata
+
+if __name__ == "__main__":
+    from visualization import load_data
+
+    parser = argparse.ArgumentParser(description="Render a tiled station x year heatmap pyramid")
+    parser.add_argument('--output', default=os.path.join('graphs', 'heatmap_tiles'))
+    parser.add_argument('--column', default='AverageTemp_Summer')
+    parser.add_argument('--tile-cells', type=int, default=16, help="cells per tile side")
+    parser.add_argument('--tile-px', type=int, default=512, help="tile size in pixels")
+    parser.add_argument('--levels', default=None, help="comma-separated zoom levels to render (default: all)")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--profile', default=None,
+                        help="write cProfile and sampled-stack output of the tile loops to this directory")
+    args = parser.parse_args()
+    Profiler.configure('heatmap_tiles', args.profile)
+
+    levels = [int(level) for level in args.levels.split(',')] if args.levels else None
+    start = time.perf_counter()
+    metadata = render_tiles(load_data(), args.output, args.column, args.tile_cells, args.tile_px, levels,
+                            args.workers)
+    for level in metadata['levels']:
+        print(f"  level {level['level']}: {level['shape'][0]} x {level['shape'][1]} cells "
+              f"({level['stations_per_cell']} stations x {level['years_per_cell']} years per cell)")
+    print(f"Saved {metadata['tiles']} tiles to {args.output} in {time.perf_counter() - start:.2f}s")
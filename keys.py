@@ -0,0 +1,75 @@
+# Compact key encoding shared by the mapper, reducer and post-processing.
+#
+# A (station, year, season) key is packed into one 64-bit integer:
+#   bits 16..63  station id (GSOD ids have 11 digits, which fits in 37 bits)
+#   bits  2..15  year offset from YEAR_BASE
+#   bits  0..1   season code
+# Sorting the packed integers therefore sorts by station, then year, then
+# season. Between the mapper and the reducer the key travels as a fixed-width
+# hex string so Hadoop's text sort gives the same order.
+# Readable labels are only produced when results are written out.
+#
+# In secondary-sort mode the mapper adds the date as a second key field
+# (YYYYMMDD), so values reach the reducer in date order within each key.
+
+SEASONS = ['Winter', 'Spring', 'Summer', 'Fall']
+SEASON_CODES = {name: code for code, name in enumerate(SEASONS)}
+
+# Season code for each month (index 0 unused)
+MONTH_SEASONS = [None, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0]
+
+YEAR_BASE = 1900
+STATION_SHIFT = 16
+YEAR_SHIFT = 2
+YEAR_MASK = 0x3FFF
+SEASON_MASK = 0x3
+
+# Hex digits in an encoded key, and how many of them hold the station id
+KEY_WIDTH = 16
+STATION_WIDTH = 12
+
+
+def station_to_int(station):
+    # GSOD files quote the id ("01001099999"); pandas output drops the quotes
+    return int(station.strip().strip('"'))
+
+
+def season_of_month(month):
+    return MONTH_SEASONS[month]
+
+
+def pack_key(station_id, year, season_code):
+    offset = year - YEAR_BASE
+    if not 0 <= offset <= YEAR_MASK:
+        raise ValueError(f"Year out of range for key encoding: {year}")
+    return (station_id << STATION_SHIFT) | (offset << YEAR_SHIFT) | season_code
+
+
+def unpack_key(key):
+    station_id = key >> STATION_SHIFT
+    year = ((key >> YEAR_SHIFT) & YEAR_MASK) + YEAR_BASE
+    season_code = key & SEASON_MASK
+    return station_id, year, season_code
+
+
+def encode_key(key):
+    return format(key, '016x')
+
+
+def decode_key(text):
+    return int(text, 16)
+
+
+def key_labels(key):
+    # Readable (station, year, season) strings for output
+    station_id, year, season_code = unpack_key(key)
+    return str(station_id), str(year), SEASONS[season_code]
+
+
+def encode_date(year, month, day):
+    return f"{year:04d}{month:02d}{day:02d}"
+
+
+def decode_date(text):
+    # YYYYMMDD -> YYYY-MM-DD
+    return f"{text[0:4]}-{text[4:6]}-{text[6:8]}"
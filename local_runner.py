@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# Runs the streaming mapper/reducer scripts locally the way Hadoop Streaming
+# would: split the input, run the mapper on each split, partition and sort
+# the map output, then run one reducer per partition into part-NNNNN files.
+#
+# Like stream.num.map.output.key.fields, key_fields says how many leading
+# tab-separated fields make up the sort key (2 for mapper.py --secondary-sort).
+# Partitioning always uses the first field only.
+#
+# An optional combiner runs on each map task's sorted partition output
+# before it is written, as Hadoop does with -combiner.
+#
+# Map tasks, hot tasks and reduce partitions are committed to a manifest in
+# _temporary (see checkpoint.py) together with their counters. A job that
+# is started again over the same inputs and options skips the tasks that
+# had finished.
+#
+# Map tasks are handed out by scheduler.py: largest splits first, with work
+# stealing between workers and speculative attempts for stragglers. Each
+# attempt writes into its own directory under _temporary/_attempts, and
+# only the first attempt to finish is moved into place.
+import os
+import sys
+import glob
+import shlex
+import random
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from counters import JobCounters
+from scheduler import Scheduler
+from checkpoint import MANIFEST, Checkpoint, file_identity, write_atomic, local_modules
+from metrics import Metrics
+from profiling import Profiler
+from partitioner import (PARTITION_MODES, get_partition, partition_unit, count_units,
+                         skew_report, find_hot_units, print_skew_report)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MAPPER = f"{shlex.quote(sys.executable)} {shlex.quote(os.path.join(SCRIPT_DIR, 'mapper.py'))}"
+DEFAULT_REDUCER = f"{shlex.quote(sys.executable)} {shlex.quote(os.path.join(SCRIPT_DIR, 'reducer.py'))}"
+DEFAULT_SPLIT_SIZE = 64 * 1024 * 1024
+
+def command_scripts(*commands):
+    """
+    The Python scripts the commands run (found in the working directory or
+    next to this file) and the local modules they import. An edited one must
+    not resume from tasks the old code produced.
+    """
+    names = [word for command in commands if command for word in shlex.split(command) if word.endswith('.py')]
+    paths = [os.path.abspath(name) if os.path.exists(name) else os.path.join(SCRIPT_DIR, name) for name in names]
+    return local_modules(*(path for path in paths if os.path.exists(path)))
+
+def input_splits(paths, split_size=DEFAULT_SPLIT_SIZE):
+    # Byte ranges of roughly split_size; lines are assigned to the split they start in
+    splits = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), split_size):
+            splits.append((path, start, min(start + split_size, size)))
+    return splits
+
+def read_split(split):
+    path, start, end = split
+    lines = []
+    with open(path, 'rb') as f:
+        if start > 0:
+            # Skip the line that started in the previous split
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+    return b''.join(lines)
+
+def sample_input(splits, num_samples=200, lines_per_sample=50, seed=0):
+    """
+    Read short runs of lines from random offsets across the input.
+    Station files are concatenated, so a single contiguous block would be biased.
+    """
+    rng = random.Random(seed)
+    splits = [s for s in splits if s[2] > s[1]]
+    if not splits:
+        return b''
+    weights = [end - start for _, start, end in splits]
+    lines = []
+    for path, start, end in rng.choices(splits, weights=weights, k=num_samples):
+        with open(path, 'rb') as f:
+            f.seek(rng.randrange(start, end))
+            f.readline()
+            for _ in range(lines_per_sample):
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line)
+    return b''.join(lines)
+
+def run_command(command, data, counters=None, attempt=None):
+    # With counters, the task's reporter: lines are added to them instead of printed.
+    # With a scheduler attempt, the process is killed if the attempt is cancelled.
+    stderr = subprocess.PIPE if counters is not None else None
+    process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+                               start_new_session=attempt is not None and os.name == 'posix')
+    if attempt is not None:
+        attempt.track(process)
+    stdout, stderr = process.communicate(data)
+    if counters is not None:
+        counters.parse(stderr, passthrough=sys.stderr)
+    if process.returncode != 0:
+        raise RuntimeError(f"Command failed with exit code {process.returncode}: {command}")
+    return stdout
+
+def map_key(line):
+    return line.split(b'\t', 1)[0].decode()
+
+def sort_lines(lines, key_fields=1):
+    # Sort on the key fields only, like the Hadoop shuffle
+    return sorted(lines, key=lambda line: line.split(b'\t', key_fields)[:key_fields])
+
+def read_partition(work_dir, pattern):
+    lines = []
+    for path in sorted(glob.glob(os.path.join(work_dir, pattern))):
+        with open(path, 'rb') as f:
+            lines.extend(f.readlines())
+    return lines
+
+def write_lines(path, lines):
+    write_atomic(path, lambda f: f.writelines(lines))
+
+def remove_files(work_dir, pattern):
+    # Output of an earlier attempt at a task that did not commit
+    for path in glob.glob(os.path.join(work_dir, pattern)):
+        os.remove(path)
+
+def run_map_task(task_id, split, mapper, work_dir, num_reducers, mode,
+                 hot_units=frozenset(), hot_splits=0, combiner=None, key_fields=1, counters=None, attempt=None):
+    # Returns (input lines, input bytes, output lines, output bytes) for the job metrics
+    data = read_split(split)
+    output = run_command(mapper, data, counters, attempt)
+
+    partitions = {}
+    hot_count = 0
+    for line in output.splitlines(keepends=True):
+        key = map_key(line)
+        if partition_unit(key, mode) in hot_units:
+            # Spread hot units round-robin over the extra hot partitions
+            p = num_reducers + hot_count % hot_splits
+            hot_count += 1
+        else:
+            p = get_partition(key, num_reducers, mode)
+        partitions.setdefault(p, []).append(line)
+
+    for p, lines in partitions.items():
+        if combiner:
+            lines = [run_command(combiner, b''.join(sort_lines(lines, key_fields)), counters, attempt)]
+        write_lines(os.path.join(work_dir, f"map-{task_id:05d}.part-{p:05d}"), lines)
+    return data.count(b'\n'), len(data), output.count(b'\n'), len(output)
+
+def run_hot_task(hot_id, partial_reducer, work_dir, num_reducers, mode, key_fields=1, counters=None):
+    # Reduce one share of the hot records into partials, routed to their home partition
+    remove_files(work_dir, f"hot-{hot_id:05d}.part-*")
+    lines = sort_lines(read_partition(work_dir, f"map-*.part-{hot_id:05d}"), key_fields)
+    output = run_command(partial_reducer, b''.join(lines), counters)
+
+    partitions = {}
+    for line in output.splitlines(keepends=True):
+        partitions.setdefault(get_partition(map_key(line), num_reducers, mode), []).append(line)
+    for p, part_lines in partitions.items():
+        write_lines(os.path.join(work_dir, f"hot-{hot_id:05d}.part-{p:05d}"), part_lines)
+
+def run_reduce_task(p, reducer, work_dir, output_dir, key_fields=1, counters=None):
+    lines = read_partition(work_dir, f"map-*.part-{p:05d}")
+    lines += read_partition(work_dir, f"hot-*.part-{p:05d}")
+    data = b''.join(sort_lines(lines, key_fields))
+    output = run_command(reducer, data, counters)
+    write_lines(os.path.join(output_dir, f"part-{p:05d}"), [output])
+    return len(lines), len(data), output.count(b'\n'), len(output)
+
+def commit_unit(checkpoint, unit, counters, sizes, task_counters):
+    entry = {'sizes': sizes, 'counters': task_counters.as_dict()}
+    checkpoint.commit(unit, entry)
+    counters.add(entry['counters'])
+    return sizes
+
+def run_unit(checkpoint, unit, counters, task):
+    """
+    Run task(task_counters) unless the manifest already holds the unit, and
+    add its counters to the job's. Returns the sizes the task returned.
+    """
+    entry = checkpoint.get(unit)
+    if entry is not None:
+        counters.add(entry['counters'])
+        return entry['sizes']
+    task_counters = JobCounters()
+    return commit_unit(checkpoint, unit, counters, task(task_counters), task_counters)
+
+def attempt_dir(work_dir, task_id, attempt):
+    return os.path.join(work_dir, '_attempts', f"map-{task_id:05d}-{attempt.number}")
+
+def commit_map_attempt(work_dir, task_id, attempt):
+    # Move the winning attempt's files into place, over any left by an uncommitted earlier run
+    task_dir = attempt_dir(work_dir, task_id, attempt)
+    remove_files(work_dir, f"map-{task_id:05d}.part-*")
+    for name in os.listdir(task_dir):
+        os.replace(os.path.join(task_dir, name), os.path.join(work_dir, name))
+    os.rmdir(task_dir)
+
+def run_job(inputs, output_dir, mapper=DEFAULT_MAPPER, reducer=DEFAULT_REDUCER,
+            num_reducers=1, mode='key', key_fields=1, split_size=DEFAULT_SPLIT_SIZE, workers=None,
+            report_skew=False, split_hot_keys=False, hot_factor=0.5, hot_splits=None,
+            partial_reducer=None, combiner=None, metrics=None, resume=True, speculate=True):
+    """
+    Run one map/reduce job over the input files and write part files to output_dir.
+    The tasks' counters are printed at the end and saved to _counters.json.
+    With resume, the tasks an interrupted run of the same job finished are skipped.
+    With speculate, straggling map tasks get a second attempt near the end of the map phase.
+    Returns the skew report when sampling was requested, otherwise None.
+    """
+    metrics = metrics or Metrics.disabled()
+    splits = input_splits(inputs, split_size)
+    print(f"Running {len(splits)} map tasks and {num_reducers} reduce tasks")
+
+    work_dir = os.path.join(output_dir, '_temporary')
+    fingerprint = {
+        'inputs': [file_identity(path) for path in inputs], 'split_size': split_size,
+        'mapper': mapper, 'reducer': reducer, 'combiner': combiner, 'partial_reducer': partial_reducer,
+        'num_reducers': num_reducers, 'mode': mode, 'key_fields': key_fields,
+        'hot': [split_hot_keys, hot_factor, hot_splits],
+        'scripts': [file_identity(path) for path in command_scripts(mapper, reducer, combiner, partial_reducer)],
+    }
+    checkpoint = Checkpoint(os.path.join(work_dir, MANIFEST), fingerprint, resume)
+    if checkpoint.resumed:
+        print(f"Resuming: {len(checkpoint.units)} tasks already done")
+    else:
+        # Files of another job, or of a run that is not being resumed
+        shutil.rmtree(work_dir, ignore_errors=True)
+        remove_files(output_dir, 'part-*')
+    remove_files(output_dir, '_SUCCESS')
+    shutil.rmtree(os.path.join(work_dir, '_attempts'), ignore_errors=True)
+    os.makedirs(work_dir, exist_ok=True)
+
+    report = None
+    hot_units = set()
+    if report_skew or split_hot_keys:
+        sample = run_command(mapper, sample_input(splits))
+        unit_counts = count_units((map_key(line) for line in sample.splitlines()), mode)
+        report = skew_report(unit_counts, num_reducers, mode)
+        if report_skew:
+            print_skew_report(report)
+        if split_hot_keys:
+            hot_units = find_hot_units(unit_counts, num_reducers, hot_factor)
+            print(f"Splitting {len(hot_units)} hot units across reduce tasks")
+
+    hot_splits = (hot_splits or num_reducers) if hot_units else 0
+    partial_reducer = partial_reducer or f"{reducer} --partial"
+
+    counters = JobCounters()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        with metrics.stage('map') as stage:
+            all_sizes = []
+            pending = []
+            for task_id in range(len(splits)):
+                entry = checkpoint.get(f"map-{task_id:05d}")
+                if entry is None:
+                    pending.append(task_id)
+                else:
+                    counters.add(entry['counters'])
+                    all_sizes.append(entry['sizes'])
+
+            def map_attempt(task_id, attempt):
+                os.makedirs(attempt_dir(work_dir, task_id, attempt))
+                task_counters = JobCounters()
+                sizes = run_map_task(task_id, splits[task_id], mapper, attempt_dir(work_dir, task_id, attempt),
+                                     num_reducers, mode, hot_units, hot_splits, combiner, key_fields,
+                                     task_counters, attempt)
+                return sizes, task_counters
+
+            def commit_map(task_id, attempt, result):
+                commit_map_attempt(work_dir, task_id, attempt)
+                return commit_unit(checkpoint, f"map-{task_id:05d}", counters, *result)
+
+            scheduler = Scheduler(workers, speculate)
+            all_sizes += scheduler.run(
+                pending, map_attempt, commit_map,
+                discard=lambda task_id, attempt: shutil.rmtree(attempt_dir(work_dir, task_id, attempt),
+                                                               ignore_errors=True),
+                size=lambda task_id: splits[task_id][2] - splits[task_id][1])
+            for sizes in all_sizes:
+                stage.count(**dict(zip(['rows_in', 'bytes_in', 'rows_out', 'bytes_out'], sizes)))
+            stage.count(tasks=len(splits))
+            if pending:
+                scheduler.record(metrics)
+                print(f"Map tasks: {scheduler.summary()}")
+        if hot_splits:
+            with metrics.stage('hot_reduce') as stage:
+                hot_task = lambda h: run_unit(
+                    checkpoint, f"hot-{h:05d}", counters,
+                    lambda task_counters: run_hot_task(h, partial_reducer, work_dir, num_reducers,
+                                                       mode, key_fields, task_counters))
+                list(pool.map(hot_task, range(num_reducers, num_reducers + hot_splits)))
+                stage.count(tasks=hot_splits)
+        with metrics.stage('reduce') as stage:
+            reduce_task = lambda p: run_unit(
+                checkpoint, f"reduce-{p:05d}", counters,
+                lambda task_counters: run_reduce_task(p, reducer, work_dir, output_dir, key_fields,
+                                                      task_counters))
+            for sizes in pool.map(reduce_task, range(num_reducers)):
+                stage.count(**dict(zip(['rows_in', 'bytes_in', 'rows_out', 'bytes_out'], sizes)))
+            stage.count(tasks=num_reducers)
+
+    shutil.rmtree(work_dir)
+    counters.save(os.path.join(output_dir, '_counters.json'))
+    open(os.path.join(output_dir, '_SUCCESS'), 'w').close()
+    counters.print()
+    print(f"Job output written to {output_dir}")
+    return report
+
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        paths += sorted(glob.glob(pattern)) or [pattern]
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the MapReduce job locally")
+    parser.add_argument('--input', nargs='+', required=True, help="input files or glob patterns")
+    parser.add_argument('--output', required=True, help="output directory for part files")
+    parser.add_argument('--mapper', default=DEFAULT_MAPPER)
+    parser.add_argument('--reducer', default=DEFAULT_REDUCER)
+    parser.add_argument('--combiner', default=None,
+                        help="command run on each map task's sorted output, e.g. \"python reducer.py --partial\"")
+    parser.add_argument('--reducers', type=int, default=1)
+    parser.add_argument('--partition-by', choices=PARTITION_MODES, default='key',
+                        help="partition on the whole key or on the station prefix")
+    parser.add_argument('--key-fields', type=int, default=1,
+                        help="leading tab-separated fields in the sort key (2 for secondary sort)")
+    parser.add_argument('--split-size', type=int, default=DEFAULT_SPLIT_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--skew-report', action='store_true',
+                        help="sample the input and print the expected reducer loads")
+    parser.add_argument('--split-hot-keys', action='store_true',
+                        help="spread hot partition units over several reduce tasks")
+    parser.add_argument('--hot-factor', type=float, default=0.5,
+                        help="a unit is hot above this fraction of an even partition share")
+    parser.add_argument('--hot-splits', type=int, default=None)
+    parser.add_argument('--partial-reducer', default=None,
+                        help="reducer command that emits mergeable partials (default: REDUCER --partial)")
+    parser.add_argument('--metrics', default=None, help="write a JSON metrics document for the run to this file")
+    parser.add_argument('--no-speculation', action='store_true',
+                        help="do not start second attempts of straggling map tasks")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="start over instead of skipping the tasks an interrupted run finished")
+    parser.add_argument('--profile', default=None,
+                        help="profile the mapper and reducer tasks into this directory (see profiling.py)")
+    args = parser.parse_args()
+    metrics = Metrics('local_runner', enabled=bool(args.metrics))
+    # The tasks inherit the setting through the environment
+    Profiler.configure('local_runner', args.profile)
+
+    run_job(expand_inputs(args.input), args.output, mapper=args.mapper, reducer=args.reducer,
+            num_reducers=args.reducers, mode=args.partition_by, key_fields=args.key_fields,
+            split_size=args.split_size,
+            workers=args.workers, report_skew=args.skew_report, split_hot_keys=args.split_hot_keys,
+            hot_factor=args.hot_factor, hot_splits=args.hot_splits,
+            partial_reducer=args.partial_reducer, combiner=args.combiner, metrics=metrics,
+            resume=not args.no_resume, speculate=not args.no_speculation)
+    metrics.save(args.metrics)
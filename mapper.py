@@ -1,48 +1,115 @@
 #!/usr/bin/env python3
 import sys
-import pandas as pd
+import csv
+import argparse
+from keys import (SEASONS, YEAR_BASE, YEAR_MASK, season_of_month, station_to_int, pack_key,
+                  encode_key, encode_date)
+from counters import TaskReporter
+from profiling import Profiler
+
+# GSOD marks missing TEMP with 9999.9; '*' and '9999' appear in older files
+MISSING_VALUES = {'', '*', '9999', '9999.9'}
 
 # Helper function to get season from month
 def get_season(month):
-    if month in [12, 1, 2]:
-        return 'Winter'
-    elif month in [3, 4, 5]:
-        return 'Spring'
-    elif month in [6, 7, 8]:
-        return 'Summer'
+    return SEASONS[season_of_month(month)]
+
+def classify_line(line):
+    """
+    Parse one combined GSOD row into ((station_id, year, month, day, temp), None),
+    or (None, reason) for rows that are skipped; reason names a counter.
+    """
+    if '"' in line:
+        # Quoted fields, e.g. NAME "JAN MAYEN NOR NAVY, NO", can hold commas
+        columns = next(csv.reader([line]))
     else:
-        return 'Fall'
+        columns = line.strip().split(",")
 
-# Read input from standard input
-for line in sys.stdin:
-    line = line.strip()
-    columns = line.split(",")
-    
     try:
         # Extract necessary columns
         station = columns[0]
-        date = columns[1]
-        
+        date = columns[1].strip('"')
+
         # Skip rows with missing or invalid temperature
-        temp = columns[6]  # TEMP column
-        
-        if temp == '*' or temp == '' or temp == '9999':
-            continue
-        
-        # Convert to numeric
-        temp = pd.to_numeric(temp, errors='coerce')
-        
-        # Skip invalid temperature values
-        if pd.isna(temp):
-            continue
-        
-        # Parse the date to extract month and year
-        date_obj = pd.to_datetime(date)
-        month = date_obj.month
-        year = date_obj.year
-        season = get_season(month)
-        
-        # Output key-value pairs for further processing
-        print(f"{station},{year},{season}\t{temp}")
+        temp = columns[6].strip('"')  # TEMP column
     except IndexError:
-        continue
\ No newline at end of file
+        return None, 'skipped_short_row'
+
+    if station == 'STATION':
+        return None, 'skipped_header'
+    if temp.strip() in MISSING_VALUES:
+        return None, 'skipped_missing_temp'
+
+    try:
+        # Convert to numeric and parse the date (YYYY-MM-DD)
+        temp = float(temp)
+        station_id = station_to_int(station)
+        year = int(date[0:4])
+        month = int(date[5:7])
+        day = int(date[8:10])
+    except ValueError:
+        return None, 'parse_errors'
+
+    # Skip invalid temperature values and dates
+    if temp != temp:
+        return None, 'skipped_missing_temp'
+    if not 1 <= month <= 12:
+        return None, 'skipped_bad_date'
+    # Years the packed key can't hold would make pack_key raise mid-task
+    if not YEAR_BASE <= year <= YEAR_BASE + YEAR_MASK:
+        return None, 'skipped_bad_date'
+
+    return (station_id, year, month, day, temp), None
+
+def parse_line(line):
+    """
+    Parse one combined GSOD row into (station_id, year, month, day, temp).
+    Returns None for rows that should be skipped (header, missing TEMP, bad date).
+    """
+    return classify_line(line)[0]
+
+def main(secondary_sort=False, degree_days=False, reporter=None, profiler=None):
+    # Counters and status go to stderr in the Hadoop Streaming format (see counters.py)
+    reporter = reporter or TaskReporter('mapper')
+    profiler = profiler or Profiler.from_env('mapper')
+
+    # Read input from standard input
+    with profiler.section('map_lines'):
+        for line in sys.stdin:
+            reporter.count('records_in')
+            reporter.tick()
+            record, reason = classify_line(line)
+            if record is None:
+                reporter.count(reason)
+                continue
+
+            station_id, year, month, day, temp = record
+            key = pack_key(station_id, year, season_of_month(month))
+
+            # Tag the temperature with its month for per-month degree-days
+            value = f"{temp}@{month}" if degree_days else temp
+
+            if secondary_sort:
+                # Composite key: group key, then the date so values arrive in date order
+                print(f"{encode_key(key)}\t{encode_date(year, month, day)}\t{value}")
+            else:
+                # Output the packed key and temperature for further processing
+                print(f"{encode_key(key)}\t{value}")
+            reporter.count('records_emitted')
+
+    reporter.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seasonal temperature mapper")
+    parser.add_argument('--secondary-sort', action='store_true',
+                        help="add the date as a second key field (run with 2 key fields)")
+    parser.add_argument('--degree-days', action='store_true',
+                        help="tag values with their month for reducer.py --degree-days")
+    parser.add_argument('--status-interval', type=float, default=30.0,
+                        help="seconds between counter flushes and status lines")
+    parser.add_argument('--profile', default=None,
+                        help="write cProfile and sampled-stack output of the line loop to this directory")
+    args = parser.parse_args()
+    main(secondary_sort=args.secondary_sort, degree_days=args.degree_days,
+         reporter=TaskReporter('mapper', status_interval=args.status_interval),
+         profiler=Profiler.configure('mapper', args.profile))
@@ -0,0 +1,131 @@
+# Run metrics shared by the pipeline scripts.
+#
+# A Metrics collector records a tree of stages: each `with metrics.stage(name)`
+# block gets its start time, wall and CPU seconds (this process plus any child
+# processes it waited for), the process's peak RSS when it ended, and the
+# row/byte counts the caller sets on it. Stages opened inside another stage
+# become its steps. Timings measured elsewhere (a Plan report, a worker
+# process) are attached with record(). At the end of a run, save() writes one
+# JSON document.
+#
+# A disabled collector (the default when a script runs without --metrics)
+# hands out a shared no-op stage, so instrumented code costs next to nothing.
+import os
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from plan import peak_rss
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+def cpu_seconds():
+    # User + system CPU time of this process and its waited-for children
+    if resource is None:
+        return time.process_time()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+        self.steps = []
+        self.info = {}
+
+    def count(self, **counts):
+        # Add to rows_in / rows_out / bytes_in / bytes_out (or any other count)
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_dict(self):
+        entry = {'stage': self.name}
+        entry.update(self.info)
+        entry.update(self.counts)
+        if self.steps:
+            entry['steps'] = [step.to_dict() for step in self.steps]
+        return entry
+
+class _NullStage(Stage):
+    def count(self, **counts):
+        pass
+
+_NULL_STAGE = _NullStage('disabled')
+
+class Metrics:
+    def __init__(self, run, enabled=True):
+        self.run = run
+        self.enabled = enabled
+        self.root = Stage(run)
+        self._stack = [self.root]
+        self.started_at = now()
+        self._start = time.perf_counter()
+        self._cpu_start = cpu_seconds()
+
+    @classmethod
+    def disabled(cls):
+        return cls(None, enabled=False)
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield _NULL_STAGE
+            return
+        stage = Stage(name)
+        self._stack[-1].steps.append(stage)
+        self._stack.append(stage)
+        started_at = now()
+        start = time.perf_counter()
+        cpu_start = cpu_seconds()
+        try:
+            yield stage
+        finally:
+            self._stack.pop()
+            stage.info = {
+                'started_at': started_at,
+                'ended_at': now(),
+                'seconds': time.perf_counter() - start,
+                'cpu_seconds': cpu_seconds() - cpu_start,
+                'peak_rss_bytes': peak_rss(),
+            }
+
+    def record(self, name, seconds, **values):
+        # Attach a step timed elsewhere to the current stage
+        if not self.enabled:
+            return
+        stage = Stage(name)
+        stage.info = dict(seconds=seconds, **values)
+        self._stack[-1].steps.append(stage)
+        return stage
+
+    def document(self):
+        return {
+            'run': self.run,
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'ended_at': now(),
+            'seconds': time.perf_counter() - self._start,
+            'cpu_seconds': cpu_seconds() - self._cpu_start,
+            'peak_rss_bytes': peak_rss(),
+            'stages': [stage.to_dict() for stage in self.root.steps],
+        }
+
+    def save(self, path):
+        if not self.enabled or not path:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.document(), f, indent=2)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# Incremental updates from stored partial aggregates.
+#
+# The store (data/partials by default) keeps, for every yearly archive, the
+# sum, count, max and min of each (station, year, season) key as written by
+# `reducer.py --partial`. manifest.json records each archive's hash, the
+# years it covers and the global seasonal means of the last refresh.
+#
+# `update` hashes the archives and runs the MapReduce job (local_runner.py
+# with the partial reducer) on the new or changed ones only. Their members
+# are fed to the mapper as they are, without going through combine_data.py.
+# The affected keys are those of the archive's old and new partials. They
+# are merged over the archives whose years overlap, and then:
+#   - their rows in seasonal_temperatures.csv are replaced; the other rows
+#     are kept byte for byte
+#   - the processed rows of their stations are gap-filled again and replaced
+#     in processed_data.csv (and the cube). Filling looks at all years of a
+#     station, so whole stations are redone. If the global seasonal means
+#     moved, the stations that take values from them (a season or metric
+#     never observed) are redone as well.
+# Refilling uses process.py's fill options, which must match those the
+# processed file was made with. They are kept in the manifest. When they
+# change, or with the 'spatial' fallback (where a station's values depend on
+# its neighbours), every station is processed again.
+# December belongs to the Winter of its own year (see keys.py), so a new
+# year only touches that year's keys.
+import os
+import glob
+import json
+import shutil
+import tarfile
+import hashlib
+import argparse
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import process
+from cube import SeasonCube, METRICS
+from keys import SEASONS, decode_key, encode_key, unpack_key
+from reducer import parse_value
+from local_runner import run_job, DEFAULT_REDUCER
+
+STORE_DIR = os.path.join('data', 'partials')
+MANIFEST = 'manifest.json'
+BUFFER_SIZE = 1024 * 1024
+
+def archive_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_map_input(archive, path):
+    # All CSV members of an archive in one file; the mapper skips their header rows
+    with tarfile.open(archive, 'r:*') as tar, open(path, 'wb') as output:
+        for member in tar:
+            if not member.isfile() or not member.name.lower().endswith('.csv'):
+                continue
+            data = tar.extractfile(member).read()
+            output.write(data)
+            if data and not data.endswith(b'\n'):
+                output.write(b'\n')
+
+def read_partials(path):
+    # {packed key: (sum, count, max, min)} from reducer --partial output
+    partials = {}
+    if not os.path.exists(path):
+        return partials
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.rstrip('\n').partition('\t')
+            if value:
+                partials[decode_key(key)] = parse_value(value)[:4]
+    return partials
+
+def write_partials(path, partials):
+    with open(path + '.tmp', 'w') as f:
+        for key in sorted(partials):
+            temp_sum, count, max_temp, min_temp = partials[key]
+            f.write(f"{encode_key(key)}\t{temp_sum!r},{count},{max_temp!r},{min_temp!r}\n")
+    os.replace(path + '.tmp', path)
+
+def merge_partials(total, partials, keys=None):
+    for key, (temp_sum, count, max_temp, min_temp) in partials.items():
+        if keys is not None and key not in keys:
+            continue
+        if key in total:
+            old_sum, old_count, old_max, old_min = total[key]
+            total[key] = (old_sum + temp_sum, old_count + count, max(old_max, max_temp), min(old_min, min_temp))
+        else:
+            total[key] = (temp_sum, count, max_temp, min_temp)
+    return total
+
+def map_reduce_archive(archive, work_dir, reducers=1, workers=None):
+    # The archive's partial aggregates from a local MapReduce job
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    map_input = os.path.join(work_dir, 'input.csv')
+    write_map_input(archive, map_input)
+    job_output = os.path.join(work_dir, 'output')
+    run_job([map_input], job_output, reducer=f"{DEFAULT_REDUCER} --partial", num_reducers=reducers,
+            workers=workers, combiner=f"{DEFAULT_REDUCER} --partial --counter-group combiner")
+    partials = {}
+    for part in sorted(glob.glob(os.path.join(job_output, 'part-*'))):
+        merge_partials(partials, read_partials(part))
+    shutil.rmtree(work_dir)
+    return partials
+
+class PartialStore:
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        self.manifest = {'archives': {}, 'global_means': None, 'fill_options': None, 'pending': []}
+        path = os.path.join(store_dir, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+
+    def partials_path(self, name):
+        return os.path.join(self.store_dir, f'{name}.partials')
+
+    def save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        path = os.path.join(self.store_dir, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def changed(self, archives):
+        # (archive path, digest) for every new or modified archive
+        result = []
+        for path in archives:
+            entry = self.manifest['archives'].get(os.path.basename(path))
+            stat = os.stat(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            digest = archive_digest(path)
+            if entry and entry['digest'] == digest:
+                entry['mtime_ns'] = stat.st_mtime_ns
+                continue
+            result.append((path, digest))
+        return result
+
+    def update(self, archives, prune=False, reducers=1, workers=None):
+        """
+        Bring the store up to date with archives and return the set of
+        affected keys. With prune, archives missing from the list are dropped.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        # Keys of an earlier update whose results were not refreshed (e.g. it crashed)
+        affected = {decode_key(key) for key in self.manifest.get('pending', [])}
+        for path, digest in self.changed(archives):
+            name = os.path.basename(path)
+            print(f"Running the partial job on {name}")
+            partials = map_reduce_archive(path, os.path.join(self.store_dir, '_work'), reducers, workers)
+            affected.update(read_partials(self.partials_path(name)))
+            affected.update(partials)
+            self.mark_pending(affected)
+            write_partials(self.partials_path(name), partials)
+            stat = os.stat(path)
+            years = [unpack_key(key)[1] for key in partials]
+            self.manifest['archives'][name] = {
+                'digest': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'keys': len(partials), 'years': [min(years), max(years)] if years else None,
+                'updated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            }
+            self.save()
+
+        if prune:
+            current = {os.path.basename(path) for path in archives}
+            for name in [n for n in self.manifest['archives'] if n not in current]:
+                print(f"Dropping {name}")
+                affected.update(read_partials(self.partials_path(name)))
+                self.mark_pending(affected)
+                os.remove(self.partials_path(name))
+                del self.manifest['archives'][name]
+                self.save()
+        return affected
+
+    def mark_pending(self, keys):
+        # Saved before the partials change, so a crash cannot lose affected keys
+        self.manifest['pending'] = sorted(encode_key(key) for key in keys)
+        self.save()
+
+    def merged(self, keys):
+        # Merged (sum, count, max, min) of keys over the archives that can hold them
+        years = {unpack_key(key)[1] for key in keys}
+        total = {}
+        for name, entry in self.manifest['archives'].items():
+            if entry['years'] and any(entry['years'][0] <= year <= entry['years'][1] for year in years):
+                merge_partials(total, read_partials(self.partials_path(name)), keys)
+        return total
+
+def seasonal_rows(merged):
+    # seasonal_temperatures rows as strings, formatted like the reducer output
+    rows = []
+    for key, (temp_sum, count, max_temp, min_temp) in merged.items():
+        station, year, season = unpack_key(key)
+        rows.append((str(station), str(year), SEASONS[season],
+                     f"{temp_sum / count:.2f}", f"{max_temp:.2f}", f"{min_temp:.2f}"))
+    return pd.DataFrame(rows, columns=['StationID', 'Year', 'Season', 'AverageTemp', 'MaxTemp', 'MinTemp'])
+
+def write_csv(df, path):
+    df.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+def refresh_seasonal(path, affected, merged):
+    """
+    Replace the rows of the affected keys in the seasonal CSV with the merged
+    values (keys that no longer have data are removed). Other lines are copied
+    as they are, and new ones use the file's line ending (CRLF, as written by
+    csv saver.py, for a new file). Rows stay grouped by station, in key order.
+    Returns the number of rows written for the keys.
+    """
+    new = seasonal_rows(merged)
+    header = ','.join(new.columns)
+    newline = '\r\n'
+    rows = []
+    if os.path.exists(path):
+        labels = {(str(s), str(y), SEASONS[c]) for s, y, c in map(unpack_key, affected)}
+        # newline='' keeps each line's ending as it is in the file
+        with open(path, newline='') as f:
+            first = f.readline()
+            if first.strip():
+                header = first.rstrip('\r\n')
+                newline = first[len(header):] or newline
+            for line in f:
+                if not line.strip():
+                    continue
+                if not line.endswith('\n'):
+                    line += newline
+                station, year, season = line.split(',', 3)[:3]
+                if (station, year, season) not in labels:
+                    rows.append(((int(station), int(year), SEASONS.index(season)), line))
+    for row in new.itertuples(index=False):
+        rows.append(((int(row.StationID), int(row.Year), SEASONS.index(row.Season)), ','.join(row) + newline))
+    rows.sort(key=lambda row: row[0])
+    with open(path + '.tmp', 'w', newline='') as f:
+        f.write(header + newline)
+        f.writelines(line for _, line in rows)
+    os.replace(path + '.tmp', path)
+    return len(merged)
+
+def global_filled_stations(df):
+    # Stations with a season and metric never observed, which the 'global' fallback fills
+    counts = df.groupby(['StationID', 'Season'])[METRICS].count().unstack('Season', fill_value=0)
+    counts = counts.reindex(columns=pd.MultiIndex.from_product([METRICS, range(len(SEASONS))]), fill_value=0)
+    return set(counts.index[(counts == 0).any(axis=1)])
+
+def refresh_processed(seasonal_path, processed_path, cube_dir, stations, previous_means, fill_options=None):
+    """
+    Refill the processed rows of the given stations, and of the stations
+    filled from the global means if those differ from previous_means, with
+    process.py's fill_options (limit, extend, fallback, stations_file,
+    neighbours). Without previous means or a processed file, or with the
+    'spatial' fallback, everything is processed. Returns the new global
+    seasonal means.
+    """
+    fill_options = fill_options or {}
+    fallback = fill_options.get('fallback', ('station', 'global'))
+    means = process.global_season_means(seasonal_path)
+    if previous_means is None or not os.path.exists(processed_path) or 'spatial' in fallback:
+        print("Processing every station")
+        process.build_plan(seasonal_path, processed_path, cube_dir, **fill_options).run()
+        return means
+
+    df = process.load_seasonal(seasonal_path)
+    stations = set(stations)
+    if 'global' in fallback and not np.array_equal(np.asarray(previous_means, dtype='float64'), means,
+                                                    equal_nan=True):
+        extra = global_filled_stations(df) - stations
+        print(f"Global seasonal means changed, also refilling {len(extra)} stations that use them")
+        stations |= extra
+    subset = df[df['StationID'].isin(stations)]
+    rows = process.fill_gaps(SeasonCube.from_long(subset), global_means=means, **fill_options).to_wide() \
+        if len(subset) else None
+    old = pd.read_csv(processed_path)
+    new = pd.concat([old[~old['StationID'].isin(stations)], rows], ignore_index=True)
+    new = new.sort_values(['StationID', 'Year'], kind='stable').reset_index(drop=True)
+    write_csv(new, processed_path)
+    if cube_dir:
+        SeasonCube.from_wide(new).save(cube_dir)
+    print(f"Refilled {len(stations)} stations")
+    return means
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update seasonal results from new or changed archives only")
+    parser.add_argument('archives', nargs='+', help="yearly .tar/.tar.gz archives or glob patterns")
+    parser.add_argument('--store', default=STORE_DIR)
+    parser.add_argument('--prune', action='store_true', help="drop stored archives that are not listed")
+    parser.add_argument('--reducers', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seasonal', default=process.SEASONAL_CSV)
+    parser.add_argument('--processed', default=process.PROCESSED_CSV)
+    parser.add_argument('--cube-dir', default=process.CUBE_DIR, help="'' to skip the cube")
+    # process.py's fill options, as used for the processed file
+    parser.add_argument('--limit', type=int, default=None,
+                        help="longest gap in years to interpolate (default: any)")
+    parser.add_argument('--extend', action='store_true',
+                        help="also fill years before the first / after the last observation")
+    parser.add_argument('--fallback', default='station,global',
+                        help="comma-separated fallback strategies, as for process.py")
+    parser.add_argument('--stations', default=process.STATIONS_FILE,
+                        help="station coordinates for the 'spatial' fallback")
+    parser.add_argument('--neighbours', type=int, default=5,
+                        help="nearest stations used by the 'spatial' fallback")
+    args = parser.parse_args()
+    fill_options = {'limit': args.limit, 'extend': args.extend,
+                    'fallback': [f for f in args.fallback.split(',') if f],
+                    'stations_file': args.stations, 'neighbours': args.neighbours}
+
+    archives = []
+    for pattern in args.archives:
+        archives += sorted(glob.glob(pattern)) or [pattern]
+    store = PartialStore(args.store)
+    affected = store.update(archives, args.prune, args.reducers, args.workers)
+    # Processed with other (or unknown) fill options: refill every station with these
+    options_changed = store.manifest.get('fill_options') != fill_options
+    if not affected and not options_changed:
+        print("No new or changed archives")
+        raise SystemExit
+
+    if affected:
+        rows = refresh_seasonal(args.seasonal, affected, store.merged(affected))
+        print(f"Updated {rows} of {len(affected)} affected keys in {args.seasonal}")
+    if options_changed:
+        print("Fill options differ from those of the processed file")
+    stations = sorted({unpack_key(key)[0] for key in affected})
+    means = refresh_processed(args.seasonal, args.processed, args.cube_dir or None, stations,
+                              None if options_changed else store.manifest['global_means'], fill_options)
+    store.manifest['global_means'] = np.where(np.isnan(means), None, means).tolist()
+    store.manifest['fill_options'] = fill_options
+    store.manifest['pending'] = []
+    store.save()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Partitioning for the map/reduce shuffle, used by local_runner.py and
+# mirrored for Hadoop Streaming through KeyFieldBasedPartitioner options.
+#
+# Keys are the 16 hex digit packed keys from keys.py. The first
+# STATION_WIDTH digits hold the station id, so partitioning on that prefix
+# sends every year and season of a station to the same reducer, while the
+# normal text sort on the whole key still orders them by year and season.
+#
+# With mapper.py --secondary-sort the map output key has two fields
+# (key<TAB>date). Partitioning only looks at the first field, and the text
+# sort on both fields hands each reducer its values in date order.
+import sys
+import zlib
+import argparse
+from collections import Counter
+from keys import STATION_WIDTH
+
+PARTITION_MODES = ['key', 'station']
+
+def partition_unit(key, mode='key'):
+    # The part of the key that decides the partition
+    if mode == 'station':
+        return key[:STATION_WIDTH]
+    return key
+
+def get_partition(key, num_partitions, mode='key'):
+    # crc32 rather than hash() so the result is the same in every process
+    return zlib.crc32(partition_unit(key, mode).encode()) % num_partitions
+
+def hadoop_options(mode='key', key_fields=1):
+    """
+    Hadoop Streaming arguments that reproduce a partition mode.
+    The keys already sort correctly as text, so only the partitioner changes.
+    """
+    options = ['-D', f'stream.num.map.output.key.fields={key_fields}']
+    if mode == 'station':
+        fields = f'-k1.1,1.{STATION_WIDTH}'
+    elif key_fields > 1:
+        fields = '-k1,1'
+    else:
+        return options
+    return options + [
+        '-D', f'mapreduce.partition.keypartitioner.options={fields}',
+        '-partitioner', 'org.apache.hadoop.mapred.lib.KeyFieldBasedPartitioner',
+    ]
+
+def count_units(keys, mode='key'):
+    # Count records per partition unit from an iterable of map output keys
+    return Counter(partition_unit(key, mode) for key in keys)
+
+def skew_report(unit_counts, num_partitions, mode='key', top=10):
+    """
+    Estimate reducer load from sampled partition unit counts.
+    Returns a dict with the records per partition, the max/mean ratio and the
+    heaviest units with their share of all records.
+    """
+    loads = [0] * num_partitions
+    for unit, count in unit_counts.items():
+        loads[get_partition(unit, num_partitions, mode)] += count
+
+    total = sum(loads)
+    mean_load = total / num_partitions if num_partitions else 0
+    return {
+        'mode': mode,
+        'partitions': num_partitions,
+        'sampled_records': total,
+        'partition_loads': loads,
+        'max_mean_ratio': round(max(loads) / mean_load, 3) if mean_load else 0.0,
+        'top_units': [
+            {'unit': unit, 'records': count, 'share': round(count / total, 4)}
+            for unit, count in unit_counts.most_common(top)
+        ],
+    }
+
+def find_hot_units(unit_counts, num_partitions, hot_factor=0.5):
+    """
+    Units whose sampled count exceeds hot_factor times an even partition share.
+    Their records are worth splitting across several reduce tasks.
+    """
+    total = sum(unit_counts.values())
+    if not total:
+        return set()
+    limit = hot_factor * total / num_partitions
+    return {unit for unit, count in unit_counts.items() if count > limit}
+
+def print_skew_report(report):
+    print(f"Skew report ({report['mode']} partitioning, {report['partitions']} reducers, "
+          f"{report['sampled_records']} sampled records)")
+    print(f"  Max/mean reducer load: {report['max_mean_ratio']}")
+    for i, load in enumerate(report['partition_loads']):
+        print(f"  Partition {i}: {load}")
+    print("  Heaviest units:")
+    for entry in report['top_units']:
+        print(f"    {entry['unit']}: {entry['records']} ({entry['share']:.1%})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partitioning helpers for the MapReduce job")
+    parser.add_argument('--mode', choices=PARTITION_MODES, default='station')
+    parser.add_argument('--reducers', type=int, default=4)
+    parser.add_argument('--key-fields', type=int, default=1,
+                        help="2 for mapper.py --secondary-sort output")
+    parser.add_argument('--hadoop-options', action='store_true',
+                        help="print the Hadoop Streaming arguments for --mode")
+    args = parser.parse_args()
+
+    if args.hadoop_options:
+        print(' '.join(hadoop_options(args.mode, args.key_fields)))
+    else:
+        # Skew report from map output (key<TAB>value lines) on stdin
+        keys = (line.split('\t', 1)[0] for line in sys.stdin if line.strip())
+        print_skew_report(skew_report(count_units(keys, args.mode), args.reducers, args.mode))
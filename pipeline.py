@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# One entry point for the whole pipeline, run as a DAG of stages:
+#
+#   combine -> mapreduce -> seasonal -> process -> summary -> visualize
+#                                               \-> tiles
+#
+# Each stage is a command with declared input and output files. Just before
+# a stage would run, its fingerprint is computed from the content of its
+# inputs (including the scripts it runs) and its command line. If that
+# matches the stage's last successful run, kept in .pipeline/state.json,
+# and all its outputs exist, the stage is skipped. File hashes are cached by
+# size and mtime, so unchanged inputs are not read again. Stages whose
+# dependencies are done run concurrently (--workers); each one's output goes
+# to .pipeline/logs/<stage>.log.
+#
+# The MapReduce stage runs local_runner.py (--engine local) or a shell
+# command template (--engine hadoop) with these placeholders, all quoted:
+#   {input} {output}      the combined CSV and the local job output directory
+#   {files}               the scripts to ship with -files
+#   {hdfs_dir} {reducers}
+# The template must leave part files and _SUCCESS in {output}.
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import shutil
+import hashlib
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import Metrics
+from checkpoint import local_modules
+from spatial import STATIONS_FILE
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = '.pipeline'
+DATA_DIR = 'data'
+COMBINED_DIR = 'combined_data'
+COMBINED_CSV = os.path.join(COMBINED_DIR, 'all_years_combined.csv')
+JOB_OUTPUT = os.path.join('output', 'seasonal_analysis')
+SEASONAL_CSV = os.path.join(DATA_DIR, 'seasonal_temperatures.csv')
+PROCESSED_CSV = os.path.join(DATA_DIR, 'processed_data.csv')
+CUBE_DIR = os.path.join(DATA_DIR, 'processed_cube')
+GRAPHS_DIR = 'graphs'
+JOB_SCRIPTS = ['mapper.py', 'reducer.py', 'keys.py', 'counters.py', 'profiling.py']
+HADOOP_TEMPLATE = (
+    "hdfs dfs -mkdir -p {hdfs_dir} && hdfs dfs -put -f {input} {hdfs_dir}/input.csv && "
+    "hdfs dfs -rm -r -f {hdfs_dir}/output && "
+    "hadoop jar $HADOOP_HOME/share/hadoop/tools/lib/hadoop-streaming-*.jar "
+    "-D mapreduce.job.reduces={reducers} -files {files} "
+    "-input {hdfs_dir}/input.csv -output {hdfs_dir}/output -mapper mapper.py -reducer reducer.py && "
+    "mkdir -p {output} && hdfs dfs -getmerge {hdfs_dir}/output {output}/part-00000 && touch {output}/_SUCCESS"
+)
+BUFFER_SIZE = 1024 * 1024
+
+def script(name):
+    return os.path.join(SCRIPT_DIR, name)
+
+def python(name, *args):
+    return [sys.executable, script(name)] + list(args)
+
+def scripts(*names):
+    # Paths of the scripts and the local modules they import, as stage inputs
+    return local_modules(*(script(name) for name in names))
+
+class Stage:
+    def __init__(self, name, command, inputs, outputs, deps=(), clean=()):
+        self.name = name
+        # A list is run directly, a string through the shell
+        self.command = command
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        # Removed before the stage runs, so no stale files are left behind
+        self.clean = list(clean)
+
+class Pipeline:
+    def __init__(self, state_dir=STATE_DIR):
+        self.stages = {}
+        self.state_dir = state_dir
+        self.state_path = os.path.join(state_dir, 'state.json')
+        self.state = {'stages': {}, 'files': {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    def add(self, name, command, inputs, outputs, deps=(), clean=()):
+        unknown = [dep for dep in deps if dep not in self.stages]
+        if unknown:
+            raise ValueError(f"Stage {name} depends on unknown stages {unknown}")
+        self.stages[name] = Stage(name, command, inputs, outputs, deps, clean)
+        return self
+
+    def needed(self, targets):
+        # The targets and everything they depend on, in dependency order
+        order = []
+        def visit(name):
+            if name in order:
+                return
+            for dep in self.stages[name].deps:
+                visit(dep)
+            order.append(name)
+        for name in targets:
+            visit(name)
+        return [self.stages[name] for name in order]
+
+    def file_digest(self, path):
+        # sha256 of a file, reused while its size and mtime are unchanged
+        stat = os.stat(path)
+        cached = self.state['files'].get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+                digest.update(block)
+        self.state['files'][path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, stage):
+        inputs = []
+        for pattern in stage.inputs:
+            paths = sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+            inputs += [(path, self.file_digest(path)) for path in paths] or [(pattern, None)]
+        document = {'command': stage.command, 'inputs': inputs}
+        return hashlib.sha256(json.dumps(document, sort_keys=True).encode()).hexdigest()
+
+    def is_fresh(self, stage, digest):
+        entry = self.state['stages'].get(stage.name)
+        return (entry is not None and entry['fingerprint'] == digest
+                and all(os.path.exists(path) for path in stage.outputs))
+
+    def save_state(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def execute(self, stage):
+        # Returns (seconds, error message or None); runs in a worker thread
+        for path in stage.clean:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        log_path = os.path.join(self.state_dir, 'logs', f'{stage.name}.log')
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        env = dict(os.environ, MPLBACKEND='Agg')
+        start = time.perf_counter()
+        with open(log_path, 'w') as log:
+            result = subprocess.run(stage.command, shell=isinstance(stage.command, str),
+                                    stdout=log, stderr=subprocess.STDOUT, env=env)
+        seconds = time.perf_counter() - start
+        if result.returncode != 0:
+            return seconds, f"exit code {result.returncode}, see {log_path}"
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if missing:
+            return seconds, f"did not write {missing}, see {log_path}"
+        return seconds, None
+
+    def explain(self, targets, force=()):
+        """
+        (stage name, status) without running anything, by the rule run() uses:
+          stale    forced, or its fingerprint differs now: it will run
+          recheck  fresh now, but a stage it depends on will or may run; run()
+                   fingerprints it again afterwards and runs it only if that
+                   stage's outputs changed
+          fresh    will be cached
+        """
+        may_change = set()
+        lines = []
+        for stage in self.needed(targets):
+            if stage.name in force or not self.is_fresh(stage, self.fingerprint(stage)):
+                status = 'stale'
+            elif any(dep in may_change for dep in stage.deps):
+                status = 'recheck'
+            else:
+                status = 'fresh'
+            if status != 'fresh':
+                may_change.add(stage.name)
+            lines.append((stage.name, status))
+        return lines
+
+    def run(self, targets, workers=2, force=(), metrics=None):
+        """
+        Run the stale stages needed for targets, up to workers at a time.
+        Returns {stage: 'ran' | 'cached' | 'failed' | 'skipped'}.
+        """
+        metrics = metrics or Metrics.disabled()
+        pending = self.needed(targets)
+        status = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                # Start (or skip) every stage whose dependencies are done
+                progress = True
+                while progress and 'failed' not in status.values():
+                    progress = False
+                    for stage in [s for s in pending if all(status.get(d) in ('ran', 'cached') for d in s.deps)]:
+                        pending.remove(stage)
+                        digest = self.fingerprint(stage)
+                        if stage.name not in force and self.is_fresh(stage, digest):
+                            status[stage.name] = 'cached'
+                            print(f"  {stage.name:<12}cached")
+                            progress = True
+                        else:
+                            print(f"  {stage.name:<12}started")
+                            running[pool.submit(self.execute, stage)] = (stage, digest)
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, digest = running.pop(future)
+                    seconds, error = future.result()
+                    metrics.record(stage.name, seconds, status='failed' if error else 'ran')
+                    if error:
+                        status[stage.name] = 'failed'
+                        print(f"  {stage.name:<12}FAILED after {seconds:.1f}s: {error}")
+                        continue
+                    status[stage.name] = 'ran'
+                    self.state['stages'][stage.name] = {
+                        'fingerprint': digest,
+                        'finished_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                        'seconds': seconds,
+                    }
+                    self.save_state()
+                    print(f"  {stage.name:<12}done in {seconds:.1f}s")
+        for stage in pending:
+            status[stage.name] = 'skipped'
+        return status
+
+def mapreduce_command(engine, reducers, template=HADOOP_TEMPLATE, hdfs_dir='/pipeline'):
+    if engine == 'local':
+        return python('local_runner.py', '--input', COMBINED_CSV, '--output', JOB_OUTPUT,
+                      '--reducers', str(reducers))
+    return template.format(input=shlex.quote(COMBINED_CSV), output=shlex.quote(JOB_OUTPUT),
+                           files=shlex.quote(','.join(script(name) for name in JOB_SCRIPTS)),
+                           hdfs_dir=shlex.quote(hdfs_dir), reducers=reducers)
+
+def build_pipeline(engine='local', reducers=1, hadoop_template=HADOOP_TEMPLATE, hdfs_dir='/pipeline',
+                   dpi=300, process_args=(), state_dir=STATE_DIR):
+    cube_files = os.path.join(CUBE_DIR, '*.npy')
+    summary_files = [os.path.join(DATA_DIR, 'summary_stats.csv'), os.path.join(DATA_DIR, 'summary_stats.json')]
+    # Each stage's inputs include its scripts and every local module they import
+    job_scripts = scripts(*(JOB_SCRIPTS + (['local_runner.py'] if engine == 'local' else [])))
+    pipeline = Pipeline(state_dir)
+    pipeline.add('combine', python('combine_data.py', '--data-dir', DATA_DIR, '--output-dir', COMBINED_DIR),
+                 [os.path.join(DATA_DIR, '*.tar'), os.path.join(DATA_DIR, '*.tar.gz'),
+                  os.path.join(DATA_DIR, '*', '*.csv')] + scripts('combine_data.py'),
+                 [COMBINED_CSV])
+    pipeline.add('mapreduce', mapreduce_command(engine, reducers, hadoop_template, hdfs_dir),
+                 [COMBINED_CSV] + job_scripts,
+                 [os.path.join(JOB_OUTPUT, '_SUCCESS')], deps=['combine'],
+                 # The local runner resumes from the manifest in its output directory
+                 clean=[JOB_OUTPUT] if engine != 'local' else [])
+    pipeline.add('seasonal', python('csv saver.py', '--input', os.path.join(JOB_OUTPUT, 'part-*'),
+                                    '--output', SEASONAL_CSV),
+                 [os.path.join(JOB_OUTPUT, 'part-*')] + scripts('csv saver.py'),
+                 [SEASONAL_CSV], deps=['mapreduce'])
+    pipeline.add('process', python('process.py', '--input', SEASONAL_CSV, '--output', PROCESSED_CSV,
+                                   '--cube-dir', CUBE_DIR, *process_args),
+                 # stations.csv (built by stations.py) feeds the spatial fallback
+                 [SEASONAL_CSV, STATIONS_FILE] + scripts('process.py', 'stations.py'),
+                 [PROCESSED_CSV, CUBE_DIR], deps=['seasonal'], clean=[CUBE_DIR])
+    pipeline.add('summary', python('summary_stats.py'),
+                 [PROCESSED_CSV, cube_files] + scripts('summary_stats.py'),
+                 summary_files, deps=['process'])
+    pipeline.add('visualize', python('visualization.py', '--batch', '--no-summary', '--output-dir', GRAPHS_DIR,
+                                     '--dpi', str(dpi), '--input', PROCESSED_CSV, '--cube-dir', CUBE_DIR),
+                 [PROCESSED_CSV, cube_files] + summary_files + scripts('visualization.py'),
+                 [os.path.join(GRAPHS_DIR, 'manifest.json')], deps=['process', 'summary'])
+    pipeline.add('tiles', python('heatmap_tiles.py', '--output', os.path.join(GRAPHS_DIR, 'heatmap_tiles')),
+                 [PROCESSED_CSV, cube_files] + scripts('heatmap_tiles.py'),
+                 [os.path.join(GRAPHS_DIR, 'heatmap_tiles', 'tiles.json')], deps=['process'])
+    return pipeline
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline stages that are out of date")
+    parser.add_argument('targets', nargs='*', default=['visualize'],
+                        help="stages to bring up to date, with everything they depend on (default: visualize)")
+    parser.add_argument('--engine', choices=['local', 'hadoop'], default='local')
+    parser.add_argument('--reducers', type=int, default=1)
+    parser.add_argument('--hadoop-template', default=HADOOP_TEMPLATE,
+                        help="shell command for --engine hadoop, see the top of pipeline.py")
+    parser.add_argument('--hdfs-dir', default='/pipeline', help="HDFS working directory for the template")
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--process-args', default='', help="extra process.py options, e.g. \"--limit 3\"")
+    parser.add_argument('--workers', type=int, default=2, help="stages run at the same time")
+    parser.add_argument('--force', default='', help="comma-separated stages to rerun even if fresh, or 'all'")
+    parser.add_argument('--dry-run', action='store_true', help="only show which stages would run")
+    parser.add_argument('--metrics', default=None, help="write a JSON metrics document for the run to this file")
+    args = parser.parse_args()
+
+    pipeline = build_pipeline(args.engine, args.reducers, args.hadoop_template, args.hdfs_dir, args.dpi,
+                              shlex.split(args.process_args))
+    targets = list(pipeline.stages) if args.targets == ['all'] else args.targets
+    unknown = [name for name in targets if name not in pipeline.stages]
+    if unknown:
+        parser.error(f"Unknown stages {unknown}; choose from {list(pipeline.stages)} or 'all'")
+    force = set(pipeline.stages) if args.force == 'all' else {name for name in args.force.split(',') if name}
+
+    if args.dry_run:
+        for name, status in pipeline.explain(targets, force):
+            print(f"  {name:<12}{status}")
+        pipeline.save_state()
+        raise SystemExit
+
+    metrics = Metrics('pipeline', enabled=bool(args.metrics))
+    start = time.perf_counter()
+    status = pipeline.run(targets, args.workers, force, metrics)
+    pipeline.save_state()
+    metrics.save(args.metrics)
+    counts = {s: list(status.values()).count(s) for s in ('ran', 'cached', 'failed', 'skipped')}
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f}s: "
+          + ", ".join(f"{n} {s}" for s, n in counts.items() if n))
+    sys.exit(1 if counts['failed'] else 0)
@@ -0,0 +1,144 @@
+# Planned execution of the post-processing steps in process.py.
+#
+# A Plan is a list of named steps that is only run when asked. Steps are
+# either whole-data steps (reading the file, building the cube, anything
+# that needs every station) or blockwise steps that only look at one block
+# of stations at a time. Consecutive blockwise steps are fused into one
+# stage: the stage walks the cube once, block by block, and runs all of its
+# steps in place on each block's view while it is still in cache, so the
+# fill/mask/write chain needs no full-size intermediate arrays.
+#
+# Every step is timed and the process's peak RSS after it is recorded, which
+# is nearly free and shows which step raised the high-water mark. With
+# trace_memory on, tracemalloc (which also sees NumPy buffers) additionally
+# records the peak memory each step allocated on top of what was already
+# live; that is exact but slows down steps that create many Python objects.
+import sys
+import json
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+def peak_rss():
+    # Peak resident set size of this process in bytes, or None
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class Step:
+    def __init__(self, name, fn, blockwise=False):
+        self.name = name
+        self.fn = fn
+        self.blockwise = blockwise
+
+class Plan:
+    def __init__(self, block_size=4096, trace_memory=False):
+        self.steps = []
+        self.block_size = block_size
+        self.trace_memory = trace_memory
+
+    def add(self, name, fn, blockwise=False):
+        """
+        Whole-data steps are called as fn(ctx); blockwise steps as
+        fn(ctx, block) where block is a slice of the station axis.
+        """
+        self.steps.append(Step(name, fn, blockwise))
+        return self
+
+    def stages(self):
+        # Group consecutive blockwise steps into fused stages
+        stages = []
+        for step in self.steps:
+            if step.blockwise and stages and isinstance(stages[-1], list):
+                stages[-1].append(step)
+            elif step.blockwise:
+                stages.append([step])
+            else:
+                stages.append(step)
+        return stages
+
+    def explain(self):
+        lines = []
+        for stage in self.stages():
+            if isinstance(stage, list):
+                lines.append(f"fused pass over station blocks of {self.block_size}: "
+                             + " -> ".join(step.name for step in stage))
+            else:
+                lines.append(stage.name)
+        return lines
+
+    def _measure(self, stats, name, call):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        call()
+        entry = stats.setdefault(name, {'step': name, 'seconds': 0.0, 'peak_bytes': None,
+                                        'peak_rss_bytes': None})
+        entry['seconds'] += time.perf_counter() - start
+        entry['peak_rss_bytes'] = peak_rss()
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            entry['peak_bytes'] = max(entry['peak_bytes'] or 0, peak - before)
+            self._peak = max(self._peak, peak)
+
+    def run(self, ctx=None):
+        """
+        Run the plan and return (ctx, report). The context dict must hold the
+        number of stations under 'num_stations' before the first fused stage.
+        """
+        ctx = {} if ctx is None else ctx
+        stats = {}
+        self._peak = 0
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        start = time.perf_counter()
+
+        try:
+            for stage in self.stages():
+                if not isinstance(stage, list):
+                    self._measure(stats, stage.name, lambda: stage.fn(ctx))
+                    continue
+                for first in range(0, ctx['num_stations'], self.block_size):
+                    block = slice(first, min(first + self.block_size, ctx['num_stations']))
+                    for step in stage:
+                        self._measure(stats, step.name, lambda: step.fn(ctx, block))
+            total = time.perf_counter() - start
+            peak = self._peak if self.trace_memory else None
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+        report = {
+            'plan': self.explain(),
+            'steps': [stats[step.name] for step in self.steps if step.name in stats],
+            'total_seconds': total,
+            'peak_bytes': peak,
+            'peak_rss_bytes': peak_rss(),
+        }
+        return ctx, report
+
+def megabytes(value):
+    return value / 1e6 if value is not None else float('nan')
+
+def print_report(report):
+    print("Plan:")
+    for line in report['plan']:
+        print(f"  {line}")
+    print(f"{'Step':<16}{'Time (s)':>10}{'Alloc peak (MB)':>17}{'Peak RSS (MB)':>15}")
+    for entry in report['steps']:
+        print(f"{entry['step']:<16}{entry['seconds']:>10.3f}{megabytes(entry['peak_bytes']):>17.1f}"
+              f"{megabytes(entry['peak_rss_bytes']):>15.1f}")
+    print(f"{'total':<16}{report['total_seconds']:>10.3f}{megabytes(report['peak_bytes']):>17.1f}"
+          f"{megabytes(report['peak_rss_bytes']):>15.1f}")
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Data preparation for the plots in visualization.py.
+#
+# Every selection here is one groupby or one indexed scatter over the whole
+# frame instead of a boolean mask per station (and per year), so the cost
+# grows with the number of rows rather than stations x years x rows.
+# Run `python plot_data.py --benchmark` to time them on synthetic data.
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+def top_stations_by_mean(df, column, n):
+    # Stations with the highest mean of column, ignoring stations with no data
+    means = df.groupby('StationID', sort=False)[column].mean().dropna()
+    return means.sort_values(ascending=False, kind='stable').index[:n].to_numpy()
+
+def top_stations_by_count(df, columns, n):
+    # Stations with the most non-missing values across columns
+    columns = [c for c in columns if c in df.columns]
+    counts = df[columns].notna().sum(axis=1).groupby(df['StationID'], sort=False).sum()
+    return counts.sort_values(ascending=False, kind='stable').index[:n].to_numpy()
+
+def heatmap_matrix(df, stations, years, column):
+    """
+    (stations, years) matrix of column, 0 where a station has no row for a
+    year or the value is missing. The first row of a station-year wins.
+    """
+    matrix = np.zeros((len(stations), len(years)))
+    rows = df.drop_duplicates(['StationID', 'Year'])
+    station_idx = pd.Index(stations).get_indexer(rows['StationID'])
+    year_idx = pd.Index(years).get_indexer(rows['Year'])
+    values = rows[column].to_numpy(dtype='float64')
+
+    keep = (station_idx >= 0) & (year_idx >= 0) & ~np.isnan(values)
+    matrix[station_idx[keep], year_idx[keep]] = values[keep]
+    return matrix
+
+def station_means(df, stations, columns):
+    # Mean of each column per station, in the given station order (NaN if absent)
+    columns = [c for c in columns if c in df.columns]
+    return df.groupby('StationID')[columns].mean().reindex(stations)
+
+def synthetic_frame(num_stations=10_000, num_years=30, missing=0.2, seed=0):
+    # processed_data-shaped frame for benchmarking
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'StationID': np.repeat(np.arange(num_stations, dtype='int64') + 10_000_000, num_years),
+        'Year': np.tile(np.arange(1995, 1995 + num_years), num_stations),
+    })
+    for metric in ['AverageTemp', 'MaxTemp', 'MinTemp']:
+        for season in ['Fall', 'Spring', 'Summer', 'Winter']:
+            values = rng.uniform(0, 100, len(df))
+            values[rng.random(len(df)) < missing] = np.nan
+            df[f'{metric}_{season}'] = values
+    return df
+
+def benchmark(num_stations=10_000, num_years=30):
+    df = synthetic_frame(num_stations, num_years)
+    seasons = ['Winter', 'Spring', 'Summer', 'Fall']
+    average_columns = [f'AverageTemp_{season}' for season in seasons]
+    stations = df['StationID'].unique()
+    years = df['Year'].unique()
+
+    timings = {}
+    def timed(name, fn):
+        start = time.perf_counter()
+        result = fn()
+        timings[name] = time.perf_counter() - start
+        return result
+
+    timed('top_by_mean', lambda: top_stations_by_mean(df, 'AverageTemp_Summer', 8))
+    timed('top_by_count', lambda: top_stations_by_count(df, average_columns, 10))
+    timed('heatmap_all_stations', lambda: heatmap_matrix(df, stations, years, 'AverageTemp_Summer'))
+    timed('station_means', lambda: station_means(df, stations, average_columns))
+
+    print(f"Plot data preparation for {num_stations} stations x {num_years} years ({len(df)} rows):")
+    for name, seconds in timings.items():
+        print(f"  {name:<22}{seconds:.3f}s")
+    print(f"  {'total':<22}{sum(timings.values()):.3f}s")
+    return timings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot data preparation helpers")
+    parser.add_argument('--benchmark', action='store_true')
+    parser.add_argument('--stations', type=int, default=10_000)
+    parser.add_argument('--years', type=int, default=30)
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.stations, args.years)
+    else:
+        parser.print_help()
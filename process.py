@@ -1,30 +1,255 @@
+import os
+import argparse
+import numpy as np
 import pandas as pd
+import gapfill
+from keys import SEASONS, SEASON_CODES
+from cube import SeasonCube, METRICS
+from spatial import STATIONS_FILE, load_station_coords, spatial_fill
+from plan import Plan, print_report, save_report
+from metrics import Metrics, file_size
+from profiling import Profiler
 
-df = pd.read_csv("data\seasonal_temperatures.csv")
+# Filled cube shared with visualization.py
+CUBE_DIR = os.path.join('data', 'processed_cube')
+SEASONAL_CSV = os.path.join('data', 'seasonal_temperatures.csv')
+PROCESSED_CSV = os.path.join('data', 'processed_data.csv')
 
-print(df.head())
-print(df.columns)
+def compact_keys(df):
+    # Work on compact keys: 64-bit station ids and 2-bit season codes
+    df['StationID'] = df['StationID'].astype('int64')
+    df['Year'] = df['Year'].astype('int16')
+    df['Season'] = df['Season'].map(SEASON_CODES).astype('int8')
+    return df
 
-# Create a pivot table with seasons as columns
-pivoted_df = df.pivot_table(
-    index=['StationID', 'Year'],
-    columns='Season',
-    values=['AverageTemp', 'MaxTemp', 'MinTemp']
-)
+def load_seasonal(path):
+    return compact_keys(pd.read_csv(path))
 
-# Flatten the column multi-index
-pivoted_df.columns = [f'{val}_{season}' for val, season in pivoted_df.columns]
+def fill_gaps(cube, limit=None, extend=False, fallback=('station', 'global'),
+              stations_file=None, neighbours=5, global_means=None):
+    # Interpolate along each station's years, then apply the fallbacks in
+    # order: station, spatial neighbours and global seasonal means (see gapfill.py)
+    present = cube.present_rows()
+    coords = None
+    if 'spatial' in fallback:
+        coords = load_station_coords(stations_file or STATIONS_FILE, cube.stations)
+    values = gapfill.fill_gaps(cube.values, present, limit=limit, extend=extend,
+                               fallback=fallback, coords=coords, neighbours=neighbours,
+                               global_means=global_means)
 
-# Reset the index to make StationID and Year regular columns
-pivoted_df = pivoted_df.reset_index()
+    # Only station-years that had data stay in the output
+    values[~present] = float('nan')
+    return SeasonCube(values, cube.stations, cube.years)
 
-pivoted_df = pivoted_df.interpolate()
+def global_season_means(path, chunksize=1_000_000, decimals=2):
+    """
+    First pass of the chunked mode: the (season, metric) means over all rows,
+    read a chunk at a time. Only running sums and counts are kept.
+    """
+    sums = np.zeros((len(SEASONS), len(METRICS)))
+    counts = np.zeros((len(SEASONS), len(METRICS)))
+    for chunk in pd.read_csv(path, usecols=['Season'] + METRICS, chunksize=chunksize):
+        codes = chunk['Season'].map(SEASON_CODES).to_numpy()
+        values = chunk[METRICS].to_numpy(dtype='float64')
+        observed = ~np.isnan(values)
+        np.add.at(sums, codes, np.where(observed, values, 0.0))
+        np.add.at(counts, codes, observed)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.round(sums / counts, decimals)
 
-# Calculate average for each season column across all stations
-season_avgs = pivoted_df.mean()
-season_avgs = round(season_avgs, 2)
-pivoted_df = pivoted_df.fillna(season_avgs)
-# Display the result
-print(pivoted_df.head())
+def station_chunks(path, chunksize=1_000_000):
+    """
+    Read the seasonal file in chunks of whole stations. The rows of a station
+    must be contiguous (as in reducer output partitioned by station); the last
+    station of each chunk is held back until its rows are complete.
+    """
+    seen = set()
+    carry = None
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        chunk = compact_keys(chunk)
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
 
-pivoted_df.to_csv('processed_data.csv', index=False)
\ No newline at end of file
+        stations = chunk['StationID'].to_numpy()
+        last = stations[-1]
+        complete = chunk[stations != last]
+        carry = chunk[stations == last]
+
+        starts = complete['StationID'][complete['StationID'] != complete['StationID'].shift()]
+        if seen.intersection(starts) or len(set(starts)) != len(starts):
+            raise ValueError(f"{path} is not grouped by station; sort it by StationID "
+                             "or run the MapReduce job with --partition-by station")
+        seen.update(starts)
+        if len(complete):
+            yield complete
+
+    if carry is not None and len(carry):
+        if carry['StationID'].iloc[0] in seen:
+            raise ValueError(f"{path} is not grouped by station")
+        yield carry
+
+def process_chunked(path, output_path, chunksize=1_000_000, **fill_options):
+    """
+    Out-of-core mode: fill each chunk of stations on its own and append it to
+    output_path, so memory is bounded by the chunk size. Interpolation and the
+    station fallback only look at one station; the global means come from a
+    cheap first pass over the file.
+    """
+    if 'spatial' in fill_options.get('fallback', ()):
+        raise ValueError("The 'spatial' fallback needs all stations and cannot run chunked")
+
+    global_means = global_season_means(path, chunksize)
+    rows = 0
+    header = True
+    with open(output_path, 'w', newline='') as output:
+        for chunk in station_chunks(path, chunksize):
+            cube = fill_gaps(SeasonCube.from_long(chunk), global_means=global_means, **fill_options)
+            wide = cube.to_wide()
+            wide.to_csv(output, index=False, header=header)
+            header = False
+            rows += len(wide)
+            print(f"  Wrote {rows} station-years")
+    return rows
+
+def build_plan(input_path, output_path, cube_dir=None, limit=None, extend=False,
+               fallback=('station', 'global'), stations_file=None, neighbours=5,
+               block_size=4096, trace_memory=False):
+    """
+    The in-memory post-processing as a Plan (see plan.py). The cube is the
+    only full-size buffer: interpolation, the station/global fallbacks, the
+    row mask and the CSV write run fused over blocks of stations, in place.
+    """
+    plan = Plan(block_size=block_size, trace_memory=trace_memory)
+
+    def read(ctx):
+        ctx['df'] = load_seasonal(input_path)
+        ctx['rows_in'] = len(ctx['df'])
+
+    def scatter(ctx):
+        # The DataFrame is dropped as soon as the cube holds its values
+        cube = SeasonCube.from_long(ctx.pop('df'))
+        ctx['cube'] = cube
+        ctx['num_stations'] = len(cube.stations)
+        ctx['present'] = cube.present_rows()
+        ctx['observed'] = gapfill.observed_cells(cube.values, ctx['present'])
+
+    def global_stats(ctx):
+        ctx['global_means'] = gapfill.season_means(ctx['cube'].values, ctx['observed'])
+
+    def interpolate(ctx, block):
+        gapfill.interpolate_years(ctx['cube'].values[block], limit=limit, extend=extend,
+                                  inplace=True)
+
+    def station_fallback(ctx, block):
+        gapfill.fill_station_means(ctx['cube'].values[block], ctx['observed'][block])
+
+    def spatial_fallback(ctx):
+        cube = ctx['cube']
+        coords = load_station_coords(stations_file or STATIONS_FILE, cube.stations)
+        spatial_fill(cube.values, cube.values, ctx['observed'], ctx['present'], coords,
+                     k=neighbours, inplace=True)
+
+    def global_fallback(ctx, block):
+        gapfill.fill_with_means(ctx['cube'].values[block], ctx['global_means'][None, None])
+
+    def mask(ctx, block):
+        # Only station-years that had data stay in the output
+        ctx['cube'].values[block][~ctx['present'][block]] = float('nan')
+
+    def write(ctx, block):
+        cube = ctx['cube']
+        if 'output' not in ctx:
+            ctx['output'] = open(output_path, 'w', newline='')
+            ctx['rows'] = 0
+        rows = SeasonCube(cube.values[block], cube.stations[block], cube.years).to_wide()
+        rows.to_csv(ctx['output'], index=False, header=ctx['rows'] == 0)
+        ctx['rows'] += len(rows)
+
+    def close(ctx):
+        if 'output' in ctx:
+            ctx.pop('output').close()
+
+    def save_cube(ctx):
+        ctx['cube'].save(cube_dir)
+
+    plan.add('read', read).add('scatter', scatter)
+    if 'global' in fallback:
+        plan.add('global_means', global_stats)
+    plan.add('interpolate', interpolate, blockwise=True)
+    for strategy in fallback:
+        if strategy == 'station':
+            plan.add('station_fill', station_fallback, blockwise=True)
+        elif strategy == 'spatial':
+            plan.add('spatial_fill', spatial_fallback)
+        elif strategy == 'global':
+            plan.add('global_fill', global_fallback, blockwise=True)
+        else:
+            raise ValueError(f"Unknown fallback strategy: {strategy}")
+    plan.add('mask', mask, blockwise=True).add('write', write, blockwise=True).add('close', close)
+    if cube_dir:
+        plan.add('save_cube', save_cube)
+    return plan
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reshape and gap-fill the seasonal statistics")
+    parser.add_argument('--input', default=SEASONAL_CSV, help="seasonal statistics from `csv saver.py`")
+    parser.add_argument('--output', default=PROCESSED_CSV)
+    parser.add_argument('--cube-dir', default=CUBE_DIR, help="where to save the filled cube ('' to skip)")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="longest gap in years to interpolate (default: any)")
+    parser.add_argument('--extend', action='store_true',
+                        help="also fill years before the first / after the last observation")
+    parser.add_argument('--fallback', default='station,global',
+                        help=f"comma-separated fallback strategies from {gapfill.FALLBACKS}, or ''")
+    parser.add_argument('--stations', default=STATIONS_FILE,
+                        help="station coordinates for the 'spatial' fallback (see stations.py)")
+    parser.add_argument('--neighbours', type=int, default=5,
+                        help="nearest stations used by the 'spatial' fallback")
+    parser.add_argument('--chunked', action='store_true',
+                        help="process the file in station chunks with bounded memory")
+    parser.add_argument('--chunksize', type=int, default=1_000_000,
+                        help="rows per chunk in --chunked mode")
+    parser.add_argument('--block-size', type=int, default=4096,
+                        help="stations per block in the fused pass")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="also record exact per-step allocation peaks (slower)")
+    parser.add_argument('--report-json', default=None,
+                        help="write the per-step time/memory report to this file")
+    parser.add_argument('--metrics', default=None,
+                        help="write a JSON metrics document for the run to this file")
+    parser.add_argument('--profile', default=None,
+                        help="write cProfile and sampled-stack output of the run to this directory")
+    args = parser.parse_args()
+    fallback = [f for f in args.fallback.split(',') if f]
+    metrics = Metrics('process', enabled=bool(args.metrics))
+    profiler = Profiler.configure('process', args.profile)
+
+    if args.chunked:
+        with metrics.stage('process_chunked') as stage, profiler.section('chunks'):
+            rows = process_chunked(args.input, args.output,
+                                   chunksize=args.chunksize, limit=args.limit,
+                                   extend=args.extend, fallback=fallback)
+            stage.count(rows_out=rows, bytes_in=file_size(args.input),
+                        bytes_out=file_size(args.output))
+        print(f"Saved {rows} station-years to {args.output}")
+        metrics.save(args.metrics)
+        raise SystemExit
+
+    plan = build_plan(args.input, args.output, args.cube_dir or None,
+                      limit=args.limit, extend=args.extend, fallback=fallback,
+                      stations_file=args.stations, neighbours=args.neighbours,
+                      block_size=args.block_size, trace_memory=args.trace_memory)
+    with metrics.stage('process') as stage:
+        with profiler.section('plan'):
+            ctx, report = plan.run()
+        # The plan times its own steps (scatter is the long-to-cube pivot)
+        for entry in report['steps']:
+            metrics.record(entry['step'], entry['seconds'], peak_rss_bytes=entry['peak_rss_bytes'])
+        stage.count(rows_in=ctx['rows_in'], rows_out=ctx['rows'],
+                    bytes_in=file_size(args.input),
+                    bytes_out=file_size(args.output))
+    print(f"Saved {ctx['rows']} station-years to {args.output}")
+    print_report(report)
+    if args.report_json:
+        save_report(report, args.report_json)
+    metrics.save(args.metrics)
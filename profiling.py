@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# Opt-in profiling of the pipeline's hot loops.
+#
+# Code wraps a hot loop in `with profiler.section(name):`. When profiling is
+# off, section() returns a shared no-op context manager, so the cost is one
+# call per loop and not per record. When it is on, each section gets:
+#   <dir>/<run>.<section>.<pid>.pstats     cProfile data (python -m pstats, snakeviz)
+#   <dir>/<run>.<section>.<pid>.collapsed  sampled stacks, one "a;b;c count"
+#                                          line per stack (flamegraph.pl, speedscope)
+# A section that runs several times (one per archive, one per figure) adds up
+# into the same files. cProfile and the sampler only see the thread they
+# run in, so a section entered on a worker thread gets its own files,
+# <run>.<section>.<pid>-t<n>.*; merge() adds them up with the rest. From
+# Python 3.12, cProfile is built on sys.monitoring and only one profile can
+# be active per process. A section entered while another thread is being
+# profiled then gets sampled stacks only, and no .pstats file.
+#
+# Profiling is switched on by the PIPELINE_PROFILE environment variable
+# (the output directory), which scripts set from their --profile option.
+# Child processes inherit it, so mapper and reducer tasks started by
+# local_runner.py and batch render workers are profiled too; on Hadoop, pass
+# it with -cmdenv PIPELINE_PROFILE=<dir>.
+#
+#   python profiling.py <dir>   merges the files per section and prints the top functions
+import os
+import sys
+import glob
+import pstats
+import cProfile
+import argparse
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+PROFILE_ENV = 'PIPELINE_PROFILE'
+SAMPLE_INTERVAL = 0.005
+
+_NULL_SECTION = nullcontext()
+
+class StackSampler(threading.Thread):
+    # Samples another thread's Python stack every interval seconds
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL, counts=None):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter() if counts is None else counts
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+class Profiler:
+    def __init__(self, run, output_dir=None, interval=SAMPLE_INTERVAL):
+        self.run = run
+        self.output_dir = output_dir
+        self.enabled = bool(output_dir)
+        self.interval = interval
+        self._profiles = {}
+        self._stacks = {}
+        # Keys whose cProfile was ever enabled; others only have sampled stacks
+        self._traced = set()
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, run):
+        return cls(run, os.environ.get(PROFILE_ENV))
+
+    @classmethod
+    def configure(cls, run, output_dir=None):
+        # Turn profiling on for this process and its children when output_dir is given
+        if output_dir:
+            os.environ[PROFILE_ENV] = os.path.abspath(output_dir)
+        return cls.from_env(run)
+
+    def section(self, name):
+        if not self.enabled:
+            return _NULL_SECTION
+        return self._profile(name)
+
+    def _file_id(self):
+        # The pid, plus a thread number for threads other than the main one
+        if threading.current_thread() is threading.main_thread():
+            return str(os.getpid())
+        with self._lock:
+            number = self._threads.setdefault(threading.get_ident(), len(self._threads) + 1)
+        return f"{os.getpid()}-t{number}"
+
+    @contextmanager
+    def _profile(self, name):
+        key = (name, self._file_id())
+        with self._lock:
+            profile = self._profiles.setdefault(key, cProfile.Profile())
+            stacks = self._stacks.setdefault(key, Counter())
+        sampler = StackSampler(threading.get_ident(), self.interval, stacks)
+        sampler.start()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another thread's profile is active (Python 3.12+): the sampler covers this one
+            profile = None
+        else:
+            with self._lock:
+                self._traced.add(key)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            sampler.stop()
+            self.save(key)
+
+    def save(self, key):
+        name, file_id = key
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{self.run}.{name}.{file_id}")
+        if key in self._traced:
+            self._profiles[key].dump_stats(base + '.pstats')
+        write_collapsed(base + '.collapsed', self._stacks[key])
+
+def write_collapsed(path, counts):
+    with open(path, 'w') as f:
+        for stack, count in sorted(counts.items()):
+            f.write(f"{stack} {count}\n")
+
+def read_collapsed(path, counts):
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            counts[stack] += int(count)
+
+def merge(profile_dir):
+    """
+    Combine the files of every <run>.<section> over all processes and threads
+    into <run>.<section>.collapsed and, where any were traced,
+    <run>.<section>.pstats. Returns the names.
+    """
+    groups = {}
+    for path in glob.glob(os.path.join(profile_dir, '*.*.*.collapsed')):
+        name = os.path.basename(path).rsplit('.', 2)[0]
+        groups.setdefault(name, []).append(path[:-len('.collapsed')])
+    for name, bases in sorted(groups.items()):
+        traced = [base + '.pstats' for base in bases if os.path.exists(base + '.pstats')]
+        if traced:
+            pstats.Stats(*traced).dump_stats(os.path.join(profile_dir, f'{name}.pstats'))
+        counts = Counter()
+        for base in bases:
+            read_collapsed(base + '.collapsed', counts)
+        write_collapsed(os.path.join(profile_dir, f'{name}.collapsed'), counts)
+    return sorted(groups)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge and summarize --profile output")
+    parser.add_argument('profile_dir')
+    parser.add_argument('--top', type=int, default=15, help="functions to show per section")
+    parser.add_argument('--sort', default='cumulative', help="pstats sort key")
+    args = parser.parse_args()
+
+    for name in merge(args.profile_dir):
+        print(f"== {name} ==")
+        path = os.path.join(args.profile_dir, f'{name}.pstats')
+        if os.path.exists(path):
+            pstats.Stats(path).sort_stats(args.sort).print_stats(args.top)
+        else:
+            print(f"  sampled stacks only: {name}.collapsed")
@@ -1,58 +1,200 @@
 #!/usr/bin/env python3
 import sys
+import argparse
+from keys import encode_key, decode_key, decode_date, key_labels
+from counters import TaskReporter
+from profiling import Profiler
 
-current_key = None
-temp_sum = 0
-count = 0
-max_temp = -float('inf')
-min_temp = float('inf')
-
-# Process the key-value pairs
-for line in sys.stdin:
-    try:
-        line = line.strip()
-        key, value = line.split("\t")
-
-        # Parse the key - expecting station,year,season
-        key_parts = key.split(",")
-        if len(key_parts) != 3:
-            # If not 3 parts, log warning and try to handle it
-            sys.stderr.write(f"WARNING: Key has {len(key_parts)} parts instead of 3: {key}\n")
-            continue
-        else:
-            station, year, season = key_parts
+# Values are either a single temperature from the mapper or a partial
+# aggregate "sum,count,max,min" written by an earlier reducer run with
+# --partial (used as a combiner, or when one key is split across several
+# reduce tasks).
+#
+# In secondary-sort mode lines are key<TAB>date<TAB>value and the values of
+# each key arrive in date order, so the first and last observation can be
+# tracked without buffering the group. Partials made from dated values carry
+# them as "sum,count,max,min,first date,first temp,last date,last temp", and
+# merging keeps the earliest first and the latest last, so --first-last also
+# works behind a combiner or with split hot keys, whatever the partials' order.
+#
+# With --degree-days the mapper tags each temperature with its month
+# ("temp@month") and heating/cooling degree-days against --base are summed
+# per month next to the usual statistics. Partials then carry the month sums
+# as well: "sum,count,max,min;month:hdd:cdd:days;...". A season key covers
+# at most three months, so this stays constant memory per key.
+
+def split_line(line):
+    # Returns (key, date, value); date is None without secondary sort
+    fields = line.split("\t")
+    if len(fields) == 2:
+        return fields[0], None, fields[1]
+    if len(fields) == 3:
+        return fields[0], fields[1], fields[2]
+    raise ValueError(f"expected 2 or 3 fields, got {len(fields)}")
+
+def degree_days(temp, base):
+    # (HDD, CDD) for one daily mean temperature
+    return max(base - temp, 0.0), max(temp - base, 0.0)
 
-        # Parse the temperature value
-        temp = float(value)
+def parse_value(value, base=None, date=None):
+    """
+    Parse a raw or partial value into (sum, count, max, min, months, span), where
+    months maps month -> (hdd, cdd, days) and is only filled when base is set,
+    and span is ((date, temp) first, (date, temp) last) or None without dates.
+    """
+    months = {}
+    if ',' in value:
+        parts = value.split(';')
+        fields = parts[0].split(',')
+        temp_sum, count, max_temp, min_temp = fields[:4]
+        span = None
+        if len(fields) == 8:
+            span = ((fields[4], float(fields[5])), (fields[6], float(fields[7])))
+        if base is not None:
+            for part in parts[1:]:
+                month, hdd, cdd, days = part.split(':')
+                months[int(month)] = (float(hdd), float(cdd), int(days))
+        return float(temp_sum), int(count), float(max_temp), float(min_temp), months, span
 
-        # Create a tuple key that includes year
-        full_key = (station, year, season)
+    temp, _, month = value.partition('@')
+    temp = float(temp)
+    if base is not None:
+        if not month:
+            raise ValueError("no month on value, run the mapper with --degree-days")
+        months[int(month)] = degree_days(temp, base) + (1,)
+    span = ((date, temp), (date, temp)) if date is not None else None
+    return temp, 1, temp, temp, months, span
 
-        # Aggregate sum of temperatures, count occurrences, and track max/min temperatures
-        if current_key == full_key:
-            temp_sum += temp
-            count += 1
-            max_temp = max(max_temp, temp)
-            min_temp = min(min_temp, temp)
+def add_months(months, other):
+    for month, (hdd, cdd, days) in other.items():
+        if month in months:
+            old_hdd, old_cdd, old_days = months[month]
+            months[month] = (old_hdd + hdd, old_cdd + cdd, old_days + days)
         else:
-            if current_key:
-                # Output average, max, and min temperatures for the previous key
-                avg_temp = temp_sum / count
-                print(f"{current_key[0]},{current_key[1]},{current_key[2]}\tAverage: {avg_temp:.2f}, Max: {max_temp:.2f}, Min: {min_temp:.2f}")
-            
-            # Reset the variables for the new key
-            current_key = full_key
-            temp_sum = temp
-            count = 1
-            max_temp = temp
-            min_temp = temp
-
-    except Exception as e:
-        # For debugging - log problematic lines
-        sys.stderr.write(f"ERROR processing line: {line} - {str(e)}\n")
-        continue
-
-# Output the last key-value pair
-if current_key:
+            months[month] = (hdd, cdd, days)
+
+def format_partial(key, temp_sum, count, max_temp, min_temp, months=None, first=None, last=None):
+    result = f"{encode_key(key)}\t{temp_sum!r},{count},{max_temp!r},{min_temp!r}"
+    if first is not None:
+        result += f",{first[0]},{first[1]!r},{last[0]},{last[1]!r}"
+    for month, (hdd, cdd, days) in sorted((months or {}).items()):
+        result += f";{month}:{hdd!r}:{cdd!r}:{days}"
+    return result
+
+def format_result(key, temp_sum, count, max_temp, min_temp, months=None, first=None, last=None):
+    # Map the packed key back to readable labels only here, at output
+    station, year, season = key_labels(key)
     avg_temp = temp_sum / count
-    print(f"{current_key[0]},{current_key[1]},{current_key[2]}\tAverage: {avg_temp:.2f}, Max: {max_temp:.2f}, Min: {min_temp:.2f}")
\ No newline at end of file
+    result = f"{station},{year},{season}\tAverage: {avg_temp:.2f}, Max: {max_temp:.2f}, Min: {min_temp:.2f}"
+    if months:
+        # Season totals on the main line, then one line per month
+        total_hdd = sum(hdd for hdd, _, _ in months.values())
+        total_cdd = sum(cdd for _, cdd, _ in months.values())
+        result += f", HDD: {total_hdd:.2f}, CDD: {total_cdd:.2f}"
+        for month, (hdd, cdd, days) in sorted(months.items()):
+            result += f"\n{station},{year},{season},{month:02d}\tHDD: {hdd:.2f}, CDD: {cdd:.2f}, Days: {days}"
+    return result
+
+def format_first_last(first, last):
+    return (f", First: {decode_date(first[0])} ({first[1]:.2f}),"
+            f" Last: {decode_date(last[0])} ({last[1]:.2f})")
+
+def main(partial=False, first_last=False, base=None, reporter=None, profiler=None):
+    output = format_partial if partial else format_result
+    # Counters and status go to stderr in the Hadoop Streaming format (see counters.py)
+    reporter = reporter or TaskReporter('reducer')
+    profiler = profiler or Profiler.from_env(reporter.group)
+
+    current_key = None
+    temp_sum = 0
+    count = 0
+    max_temp = -float('inf')
+    min_temp = float('inf')
+    months = {}
+    first = last = None
+
+    def emit():
+        result = output(current_key, temp_sum, count, max_temp, min_temp, months, first, last)
+        if first_last and not partial and first is not None:
+            # Goes on the key's main line, ahead of any month lines
+            main_line, newline, rest = result.partition('\n')
+            result = main_line + format_first_last(first, last) + newline + rest
+        print(result)
+        reporter.count('keys_emitted')
+        reporter.count('records_emitted', result.count('\n') + 1)
+
+    # Process the key-value pairs
+    with profiler.section('reduce_lines'):
+        for line in sys.stdin:
+            reporter.count('records_in')
+            reporter.tick()
+            try:
+                line = line.strip()
+                key, date, value = split_line(line)
+
+                # The key is the packed station/year/season integer in hex; groups
+                # compare the integer, so a malformed key is a parse error here
+                key = decode_key(key)
+
+                # Parse the temperature value (or partial aggregate)
+                value_sum, value_count, value_max, value_min, value_months, span = parse_value(value, base, date)
+
+                # Aggregate sum of temperatures, count occurrences, and track max/min temperatures
+                if current_key == key:
+                    temp_sum += value_sum
+                    count += value_count
+                    max_temp = max(max_temp, value_max)
+                    min_temp = min(min_temp, value_min)
+                    add_months(months, value_months)
+                    if span is not None:
+                        # Earliest first and latest last; a tie keeps the first and takes the later line as last
+                        if first is None or span[0][0] < first[0]:
+                            first = span[0]
+                        if last is None or span[1][0] >= last[0]:
+                            last = span[1]
+                else:
+                    if current_key is not None:
+                        # Output average, max, and min temperatures for the previous key
+                        emit()
+
+                    # Reset the variables for the new key
+                    current_key = key
+                    temp_sum = value_sum
+                    count = value_count
+                    max_temp = value_max
+                    min_temp = value_min
+                    months = dict(value_months)
+                    first, last = span or (None, None)
+
+            except Exception as e:
+                # Log problematic lines, rate-limited so bad input cannot flood the task log
+                reporter.count('parse_errors')
+                reporter.error(f"processing line: {line} - {str(e)}")
+                continue
+
+    # Output the last key-value pair
+    if current_key is not None:
+        emit()
+    reporter.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seasonal temperature reducer")
+    parser.add_argument('--partial', action='store_true',
+                        help="emit mergeable sum,count,max,min partials instead of final results")
+    parser.add_argument('--first-last', action='store_true',
+                        help="append the first and last observation (needs mapper.py --secondary-sort)")
+    parser.add_argument('--degree-days', action='store_true',
+                        help="also sum heating/cooling degree-days (needs mapper.py --degree-days)")
+    parser.add_argument('--base', type=float, default=65.0,
+                        help="base temperature for degree-days (°F)")
+    parser.add_argument('--status-interval', type=float, default=30.0,
+                        help="seconds between counter flushes and status lines")
+    parser.add_argument('--counter-group', default='reducer',
+                        help="counter group name, e.g. 'combiner' when run as a combiner")
+    parser.add_argument('--profile', default=None,
+                        help="write cProfile and sampled-stack output of the line loop to this directory")
+    args = parser.parse_args()
+    main(partial=args.partial, first_last=args.first_last,
+         base=args.base if args.degree_days else None,
+         reporter=TaskReporter(args.counter_group, status_interval=args.status_interval),
+         profiler=Profiler.configure(args.counter_group, args.profile))
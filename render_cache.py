@@ -0,0 +1,57 @@
+# Render cache for the figures written by visualization.py.
+#
+# A figure is fingerprinted from the exact columns it reads and the
+# parameters it is drawn with (dpi, output file, the plot function's source
+# and digests of the modules holding its helpers).
+# The fingerprints of the last render are kept in a small manifest.json next
+# to the PNGs, so an unchanged figure is skipped and dashboards can read the
+# manifest to see when each graph was rendered and from which data.
+import os
+import json
+import hashlib
+from datetime import datetime, timezone
+import pandas as pd
+
+MANIFEST = 'manifest.json'
+
+def fingerprint(frame, params):
+    """
+    sha256 over the values of frame (row order matters, the index does not)
+    and the JSON-serializable params.
+    """
+    digest = hashlib.sha256()
+    digest.update(','.join(map(str, frame.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {'figures': {}}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(output_dir, manifest):
+    # Write to a temporary file first so readers never see a partial manifest
+    path = os.path.join(output_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def is_fresh(manifest, name, path, digest):
+    entry = manifest['figures'].get(name)
+    return entry is not None and entry['fingerprint'] == digest and os.path.exists(path)
+
+def record(manifest, name, path, digest, seconds, rows):
+    manifest['figures'][name] = {
+        'file': os.path.basename(path),
+        'fingerprint': digest,
+        'rendered_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'seconds': round(seconds, 3),
+        'rows': rows,
+    }
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Heatwave and cold-spell detection per (station, year, season).
+#
+# Runs on the output of `mapper.py --secondary-sort`, whose values arrive in
+# date order within each key, so every run of consecutive days beyond a
+# threshold is found in one pass while keeping only a few counters per key.
+# A run counts as an event when it lasts at least --min-length days; its
+# degree-days are the summed distance beyond the threshold over those days.
+import sys
+import argparse
+from datetime import date
+from keys import decode_key, key_labels
+from reducer import split_line
+
+def new_runs():
+    return {'events': 0, 'longest': 0, 'degree_days': 0.0,
+            'length': 0, 'excess': 0.0, 'last_day': None}
+
+def close_run(runs, min_length):
+    # Count the current run if it was long enough, then reset it
+    if runs['length'] >= min_length:
+        runs['events'] += 1
+        runs['longest'] = max(runs['longest'], runs['length'])
+        runs['degree_days'] += runs['excess']
+    runs['length'] = 0
+    runs['excess'] = 0.0
+
+def update_runs(runs, day, excess, min_length):
+    # excess > 0 means the day is beyond the threshold
+    if excess > 0:
+        if runs['length'] and day - runs['last_day'] != 1:
+            # A missing day ends the run
+            close_run(runs, min_length)
+        runs['length'] += 1
+        runs['excess'] += excess
+        runs['last_day'] = day
+    elif runs['length']:
+        close_run(runs, min_length)
+
+def day_number(text):
+    # YYYYMMDD -> ordinal day, so consecutive dates differ by one
+    return date(int(text[0:4]), int(text[4:6]), int(text[6:8])).toordinal()
+
+def format_runs(key, hot, cold):
+    station, year, season = key_labels(decode_key(key))
+    return (f"{station},{year},{season}\t"
+            f"Heatwaves: {hot['events']}, Longest: {hot['longest']}, Degree-days: {hot['degree_days']:.2f}, "
+            f"Cold spells: {cold['events']}, Longest: {cold['longest']}, Degree-days: {cold['degree_days']:.2f}")
+
+def main(hot_threshold=90.0, cold_threshold=32.0, min_length=3):
+    current_key = None
+    previous_day = None
+    hot = cold = None
+
+    def emit():
+        close_run(hot, min_length)
+        close_run(cold, min_length)
+        print(format_runs(current_key, hot, cold))
+
+    for line in sys.stdin:
+        try:
+            line = line.strip()
+            key, day, value = split_line(line)
+            if day is None:
+                raise ValueError("no date field, run the mapper with --secondary-sort")
+            day = day_number(day)
+            temp = float(value)
+
+            if key != current_key:
+                if current_key is not None:
+                    emit()
+                current_key = key
+                previous_day = None
+                hot = new_runs()
+                cold = new_runs()
+
+            # Ignore repeated observations of the same day
+            if day == previous_day:
+                continue
+            previous_day = day
+
+            update_runs(hot, day, temp - hot_threshold, min_length)
+            update_runs(cold, day, cold_threshold - temp, min_length)
+
+        except Exception as e:
+            sys.stderr.write(f"ERROR processing line: {line} - {str(e)}\n")
+            continue
+
+    if current_key is not None:
+        emit()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Heatwave and cold-spell run detection")
+    parser.add_argument('--hot', type=float, default=90.0, help="heatwave threshold (°F)")
+    parser.add_argument('--cold', type=float, default=32.0, help="cold-spell threshold (°F)")
+    parser.add_argument('--min-length', type=int, default=3,
+                        help="consecutive days needed for a run to count")
+    args = parser.parse_args()
+    main(hot_threshold=args.hot, cold_threshold=args.cold, min_length=args.min_length)
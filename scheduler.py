@@ -0,0 +1,243 @@
+# Dynamic scheduling of small work units over a pool of worker threads.
+#
+# Units are dealt out largest first, each to the worker with the least work
+# so far. Every worker gets its own deque, and units that share an affinity
+# (e.g. the member batches of one archive) go to the same deque in order.
+# A worker takes units from the front of its own deque. When that is empty,
+# it steals the back half of the fullest other deque, so no core sits idle
+# while work remains.
+#
+# Speculation handles the end of a job. Once nothing is left to hand out,
+# an idle worker starts a second attempt of a straggler: a unit that has
+# run speculation_factor times longer than the median unit so far. The first
+# attempt to finish is committed. The other is cancelled (its subprocesses
+# are killed) and discarded. So a task must keep each attempt's output
+# apart and only move it into place in commit, which runs once per unit
+# under the scheduler's lock.
+#
+# For each worker, busy and idle time, units run, units stolen, speculative
+# attempts and time spent on attempts that lost are kept for the metrics.
+import os
+import time
+import signal
+import threading
+import statistics
+from collections import deque
+
+class Cancelled(Exception):
+    """Raised in an attempt whose unit another attempt has finished."""
+
+def kill(process):
+    # The whole process group where there is one (see run_command), so a shell's children go too
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        process.kill()
+
+class Attempt:
+    def __init__(self, unit, number, worker, speculative=False):
+        self.unit = unit
+        self.number = number
+        self.worker = worker
+        self.speculative = speculative
+        self.started = time.perf_counter()
+        self.cancelled = False
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def check(self):
+        # For tasks that loop in Python: stop early once cancelled
+        if self.cancelled:
+            raise Cancelled(self.unit)
+
+    def track(self, process):
+        # A subprocess of this attempt, killed if the attempt is cancelled
+        with self._lock:
+            self._processes.append(process)
+            if self.cancelled:
+                kill(process)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                if process.poll() is None:
+                    kill(process)
+
+class WorkerStats:
+    def __init__(self):
+        self.busy_seconds = 0.0
+        self.wasted_seconds = 0.0
+        self.units = 0
+        self.stolen = 0
+        self.speculative = 0
+
+class Scheduler:
+    def __init__(self, workers=None, speculate=True, speculation_factor=2.0, min_straggler_seconds=1.0,
+                 poll_interval=0.05):
+        self.workers = workers or os.cpu_count() or 1
+        self.speculate = speculate
+        self.speculation_factor = speculation_factor
+        self.min_straggler_seconds = min_straggler_seconds
+        self.poll_interval = poll_interval
+        self.stats = []
+        self.seconds = 0.0
+
+    def run(self, units, task, commit=None, discard=None, size=None, affinity=None):
+        """
+        Run task(unit, attempt) for every unit and return the results in unit
+        order. With commit, a unit's result is commit(unit, attempt, result)
+        for the winning attempt. discard(unit, attempt) cleans up after an
+        attempt that lost or was cancelled. size(unit) orders the units;
+        units with the same affinity(unit) are dealt to one worker, in order.
+        """
+        units = list(units)
+        self._setup(units, size or (lambda unit: 1), affinity or (lambda unit: unit))
+        self._task, self._commit, self._discard = task, commit, discard
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._work, args=(i,), daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.seconds = time.perf_counter() - start
+        if self._error is not None:
+            raise self._error
+        return [self._results[unit] for unit in units]
+
+    def _setup(self, units, size, affinity):
+        groups = {}
+        for unit in units:
+            groups.setdefault(affinity(unit), []).append(unit)
+        self._queues = [deque() for _ in range(self.workers)]
+        loads = [0] * self.workers
+        for group in sorted(groups.values(), key=lambda g: -sum(map(size, g))):
+            i = loads.index(min(loads))
+            self._queues[i].extend(group)
+            loads[i] += sum(map(size, group))
+        self.stats = [WorkerStats() for _ in range(self.workers)]
+        self._total = len(units)
+        self._results = {}
+        self._running = {}
+        self._attempt_numbers = {}
+        self._durations = []
+        self._error = None
+        self._cond = threading.Condition()
+
+    def _next(self, worker):
+        # The next attempt for worker: own deque, then stealing, then a straggler
+        own = self._queues[worker]
+        if not own:
+            victim = max(self._queues, key=len)
+            if victim:
+                block = [victim.pop() for _ in range(max(len(victim) // 2, 1))]
+                own.extend(reversed(block))
+                self.stats[worker].stolen += len(block)
+        if own:
+            return self._start(own.popleft(), worker)
+        if self.speculate and self._durations:
+            threshold = max(self.speculation_factor * statistics.median(self._durations),
+                            self.min_straggler_seconds)
+            now = time.perf_counter()
+            stragglers = [attempts[0] for unit, attempts in self._running.items()
+                          if len(attempts) == 1 and unit not in self._results
+                          and now - attempts[0].started > threshold]
+            if stragglers:
+                straggler = min(stragglers, key=lambda attempt: attempt.started)
+                self.stats[worker].speculative += 1
+                return self._start(straggler.unit, worker, speculative=True)
+        return None
+
+    def _start(self, unit, worker, speculative=False):
+        number = self._attempt_numbers[unit] = self._attempt_numbers.get(unit, 0) + 1
+        attempt = Attempt(unit, number, worker, speculative)
+        self._running.setdefault(unit, []).append(attempt)
+        return attempt
+
+    def _work(self, worker):
+        stats = self.stats[worker]
+        while True:
+            with self._cond:
+                attempt = None
+                while attempt is None:
+                    if self._error is not None or len(self._results) == self._total:
+                        return
+                    attempt = self._next(worker)
+                    if attempt is None:
+                        self._cond.wait(self.poll_interval)
+
+            unit = attempt.unit
+            error = result = None
+            try:
+                result = self._task(unit, attempt)
+            except Exception as e:
+                error = e
+            seconds = time.perf_counter() - attempt.started
+
+            lost = False
+            with self._cond:
+                stats.busy_seconds += seconds
+                others = self._running[unit]
+                others.remove(attempt)
+                if not others:
+                    del self._running[unit]
+                if unit in self._results or attempt.cancelled:
+                    lost = True
+                elif error is not None:
+                    # Another attempt of the unit may still succeed
+                    lost = True
+                    if not others:
+                        self._fail(error)
+                else:
+                    try:
+                        self._results[unit] = self._commit(unit, attempt, result) if self._commit else result
+                    except Exception as e:
+                        self._fail(e)
+                    else:
+                        stats.units += 1
+                        self._durations.append(seconds)
+                        for other in others:
+                            other.cancel()
+                        if len(self._results) == self._total:
+                            self._cancel_all()
+                if lost:
+                    stats.wasted_seconds += seconds
+                self._cond.notify_all()
+            if lost and self._discard:
+                self._discard(unit, attempt)
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._cancel_all()
+
+    def _cancel_all(self):
+        for attempts in self._running.values():
+            for attempt in attempts:
+                attempt.cancel()
+
+    def worker_stats(self):
+        # One dict per worker for the metrics; utilization is busy time over the run's wall time
+        return [{
+            'worker': i,
+            'busy_seconds': s.busy_seconds,
+            'idle_seconds': max(self.seconds - s.busy_seconds, 0.0),
+            'utilization': s.busy_seconds / self.seconds if self.seconds else None,
+            'units': s.units,
+            'stolen': s.stolen,
+            'speculative': s.speculative,
+            'wasted_seconds': s.wasted_seconds,
+        } for i, s in enumerate(self.stats)]
+
+    def record(self, metrics, prefix='worker'):
+        # Per-worker steps under the current metrics stage
+        for entry in self.worker_stats():
+            entry = dict(entry)
+            metrics.record(f"{prefix}-{entry.pop('worker')}", entry.pop('busy_seconds'), **entry)
+
+    def summary(self):
+        stats = self.worker_stats()
+        utilization = [s['utilization'] or 0 for s in stats]
+        return (f"{len(stats)} workers, utilization {min(utilization):.0%}-{max(utilization):.0%}, "
+                f"{sum(s['stolen'] for s in stats)} units stolen, "
+                f"{sum(s['speculative'] for s in stats)} speculative attempts")
@@ -0,0 +1,101 @@
+# Nearest-neighbour imputation from station coordinates.
+#
+# Stations are placed on the unit sphere as 3D vectors, so straight-line
+# (chord) distance orders neighbours exactly like great-circle distance and
+# a KD-tree works without any special handling of the date line or poles.
+# scipy's cKDTree is used when scipy is installed; otherwise queries fall
+# back to exact brute force in batches, which is fine for a few thousand
+# stations but slow for the full global network.
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+EARTH_RADIUS_KM = 6371.0
+STATIONS_FILE = os.path.join('data', 'stations.csv')
+
+def unit_vectors(latitude, longitude):
+    lat = np.radians(np.asarray(latitude, dtype='float64'))
+    lon = np.radians(np.asarray(longitude, dtype='float64'))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+def load_station_coords(path, stations):
+    """
+    (stations, 2) latitude/longitude array aligned with a cube's station ids,
+    NaN for stations missing from the station file.
+    """
+    table = pd.read_csv(path).drop_duplicates('StationID').set_index('StationID')
+    return table.reindex(np.asarray(stations))[['Latitude', 'Longitude']].to_numpy(dtype='float64')
+
+class StationIndex:
+    def __init__(self, points, batch_size=256):
+        self.points = points
+        self.batch_size = batch_size
+        self.tree = cKDTree(points) if cKDTree is not None else None
+
+    def query(self, targets, k):
+        # (distances, indices) of the k nearest points for each target, nearest first
+        k = min(k, len(self.points))
+        if self.tree is not None:
+            distances, indices = self.tree.query(targets, k=k)
+            return distances.reshape(len(targets), k), indices.reshape(len(targets), k)
+
+        distances = np.empty((len(targets), k))
+        indices = np.empty((len(targets), k), dtype='int64')
+        for start in range(0, len(targets), self.batch_size):
+            batch = targets[start:start + self.batch_size]
+            # Squared chord between unit vectors is 2 - 2 cos(angle)
+            squared = np.maximum(2 - 2 * batch @ self.points.T, 0)
+            nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            # Recompute the few selected distances exactly; the dot product loses
+            # precision for very close stations
+            nearest_dist = np.linalg.norm(batch[:, None, :] - self.points[nearest], axis=2)
+            order = np.argsort(nearest_dist, axis=1)
+            indices[start:start + len(batch)] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:start + len(batch)] = np.take_along_axis(nearest_dist, order, axis=1)
+        return distances, indices
+
+def spatial_fill(filled, values, observed, present, coords, k=5, power=2.0, max_distance_km=None,
+                 inplace=False):
+    """
+    Fill NaNs in `filled` (stations, years, seasons, metrics) with an
+    inverse-distance weighted mean of the k nearest stations that observed the
+    same year and season. Donors only use original observations (`values`
+    where `observed`), never filled values, so `values` may be `filled` itself.
+    Returns a new array unless inplace is set.
+    """
+    if not inplace:
+        filled = filled.copy()
+    has_coords = ~np.isnan(coords).any(axis=1)
+    vectors = np.zeros((len(coords), 3))
+    vectors[has_coords] = unit_vectors(coords[has_coords, 0], coords[has_coords, 1])
+
+    num_years, num_seasons = values.shape[1], values.shape[2]
+    for y in range(num_years):
+        for s in range(num_seasons):
+            donors = np.nonzero(observed[:, y, s].all(axis=1) & has_coords)[0]
+            targets = np.nonzero(np.isnan(filled[:, y, s]).any(axis=1) & has_coords & present[:, y])[0]
+            if not len(donors) or not len(targets):
+                continue
+
+            # One index per year and season over the stations that have data there
+            distances, neighbours = StationIndex(vectors[donors]).query(vectors[targets], k)
+            weights = 1.0 / np.maximum(chord_to_km(distances), 1e-3) ** power
+            if max_distance_km is not None:
+                weights[chord_to_km(distances) > max_distance_km] = 0.0
+            totals = weights.sum(axis=1)
+
+            donor_values = values[donors[neighbours], y, s]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                estimates = (weights[:, :, None] * donor_values).sum(axis=1) / totals[:, None]
+
+            current = filled[targets, y, s]
+            filled[targets, y, s] = np.where(np.isnan(current), estimates, current)
+    return filled
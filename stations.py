@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Builds data/stations.csv (StationID, Latitude, Longitude) from the combined
+# GSOD CSV files, for the spatial imputation in process.py.
+import sys
+import glob
+import argparse
+import pandas as pd
+from spatial import STATIONS_FILE
+
+def build_station_table(paths, chunksize=1_000_000):
+    # Only the id and coordinate columns are read, in chunks
+    frames = []
+    for path in paths:
+        for chunk in pd.read_csv(path, usecols=['STATION', 'LATITUDE', 'LONGITUDE'],
+                                 chunksize=chunksize):
+            chunk = chunk.dropna()
+            frames.append(chunk.groupby('STATION', as_index=False).median())
+
+    if not frames:
+        return pd.DataFrame(columns=['StationID', 'Latitude', 'Longitude'])
+
+    # A station can move slightly over the years; keep its median position
+    table = pd.concat(frames, ignore_index=True).groupby('STATION', as_index=False).median()
+    table.columns = ['StationID', 'Latitude', 'Longitude']
+    table['StationID'] = table['StationID'].astype('int64')
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract station coordinates from combined GSOD CSVs")
+    parser.add_argument('inputs', nargs='+', help="combined CSV files or glob patterns")
+    parser.add_argument('--output', default=STATIONS_FILE)
+    args = parser.parse_args()
+
+    paths = []
+    for pattern in args.inputs:
+        paths += sorted(glob.glob(pattern))
+    if not paths:
+        print("No input files found.")
+        sys.exit(1)
+
+    table = build_station_table(paths)
+    table.to_csv(args.output, index=False)
+    print(f"Saved {len(table)} stations to {args.output}")
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# Micro-batch streaming ingest of daily GSOD rows.
+#
+# A spool directory stands in for the queue. Producers drop new *.csv files
+# into it or append rows to existing ones. Files are append-only: a file
+# that shrinks or is replaced under the same name (another inode) has had
+# its rows counted already, so it is not read again but reported and
+# counted as rejected_files. Every --interval seconds the new, complete
+# lines of every file are read from its last offset as one micro-batch and
+# parsed with the mapper's classify_line. They are added to per-key
+# accumulators (sum, count, max, min) whose windows are the keys themselves:
+# one tumbling window per station, year and season.
+#
+# The watermark is the latest observation date seen. It never passes today
+# plus --max-future-days: rows dated later are dropped as
+# skipped_future_date, so one bad date cannot close every window. Once a
+# window's season ended more than --lateness-days before the watermark, it
+# is closed, and rows that still arrive for it are counted as late and
+# dropped. Open windows are indexed by end date, so closing only looks at
+# the end dates the watermark has passed. Closed windows are final: at the
+# next publish their rows are appended to <checkpoint>.closed.csv, and they
+# leave memory.
+#
+# Every --publish-interval seconds, the closed and open windows are written
+# as a seasonal_temperatures.csv (atomically, in the layout process.py
+# reads). The file offsets, the open accumulators and the length of the
+# closed-window file are then checkpointed together in one JSON file. A
+# batch is parsed aside and applied to the state, offsets included, in one
+# step. An interrupted batch or publish is never checkpointed. After a
+# restart, the closed-window file is cut back to its checkpointed length and
+# ingest resumes from the checkpoint, so every row is counted exactly once.
+#
+# Per batch, rows/s and the end-to-end latency (from the time a row's file
+# was written to the publish that included it) are printed. With --metrics,
+# they are also appended as JSON lines.
+import os
+import glob
+import json
+import time
+import shutil
+import argparse
+from datetime import date, datetime, timedelta, timezone
+from mapper import classify_line
+from keys import season_of_month, pack_key, unpack_key, encode_key, decode_key
+from partial_store import seasonal_rows, merge_partials
+
+STREAM_DIR = os.path.join('data', 'stream')
+# Last month of each season's window; Winter is Jan, Feb and Dec of its year
+SEASON_END = {0: (12, 31), 1: (5, 31), 2: (8, 31), 3: (11, 30)}
+
+def closed_windows_path(checkpoint):
+    return os.path.splitext(checkpoint)[0] + '.closed.csv'
+
+def window_end(key):
+    _, year, season = unpack_key(key)
+    month, day = SEASON_END[season]
+    return date(year, month, day)
+
+def read_new_lines(path, offset):
+    # Complete lines after offset, and the offset after them; a partly written last line waits
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    return data[:end].decode(errors='replace').splitlines(), offset + end
+
+class StreamState:
+    def __init__(self, lateness_days=30, max_future_days=1):
+        self.lateness_days = lateness_days
+        self.max_future_days = max_future_days
+        # name -> [offset, inode] of each spool file read so far
+        self.offsets = {}
+        self.rejected = set()
+        # Open windows, and their keys by window end date
+        self.windows = {}
+        self.ends = {}
+        # Windows closed since the last publish, which appends them to the closed-window file
+        self.closing = {}
+        self.closed_bytes = 0
+        self.watermark = None
+        self.counters = {}
+        # True while a batch or publish is half applied; such a state must not be checkpointed
+        self.applying = False
+
+    def is_late(self, key):
+        # The watermark only moves forward, so a window it has passed stays closed
+        return self.watermark is not None and (self.watermark - window_end(key)).days > self.lateness_days
+
+    def add_lines(self, lines, offsets, rejected=()):
+        """
+        Parse a batch and apply it together with the file offsets it was
+        read up to and the files poll rejected. Returns (rows, keys updated).
+        """
+        batch = {}
+        counts = {}
+        watermark = self.watermark
+        limit = date.today() + timedelta(days=self.max_future_days)
+        for line in lines:
+            record, reason = classify_line(line)
+            if record is None:
+                counts[reason] = counts.get(reason, 0) + 1
+                continue
+            station_id, year, month, day, temp = record
+            try:
+                observed = date(year, month, day)
+            except ValueError:
+                counts['skipped_bad_date'] = counts.get('skipped_bad_date', 0) + 1
+                continue
+            if observed > limit:
+                counts['skipped_future_date'] = counts.get('skipped_future_date', 0) + 1
+                continue
+            key = pack_key(station_id, year, season_of_month(month))
+            if self.is_late(key):
+                counts['late_rows'] = counts.get('late_rows', 0) + 1
+                continue
+            if key in batch:
+                temp_sum, count, max_temp, min_temp = batch[key]
+                batch[key] = (temp_sum + temp, count + 1, max(max_temp, temp), min(min_temp, temp))
+            else:
+                batch[key] = (temp, 1, temp, temp)
+            if watermark is None or observed > watermark:
+                watermark = observed
+            counts['rows'] = counts.get('rows', 0) + 1
+        if rejected:
+            counts['rejected_files'] = len(rejected)
+
+        self.applying = True
+        for key in batch:
+            if key not in self.windows:
+                self.ends.setdefault(window_end(key), set()).add(key)
+        merge_partials(self.windows, batch)
+        for name, value in counts.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.watermark = watermark
+        self.offsets.update(offsets)
+        self.rejected.update(rejected)
+        self.close_windows()
+        self.applying = False
+        return counts.get('rows', 0), len(batch)
+
+    def close_windows(self):
+        if self.watermark is None:
+            return
+        for end in sorted(self.ends):
+            if (self.watermark - end).days <= self.lateness_days:
+                break
+            for key in self.ends.pop(end):
+                self.closing[key] = self.windows.pop(key)
+
+    def to_dict(self):
+        return {
+            'offsets': self.offsets,
+            'rejected': sorted(self.rejected),
+            'windows': {encode_key(key): list(value) for key, value in self.windows.items()},
+            'closing': {encode_key(key): list(value) for key, value in self.closing.items()},
+            'closed_bytes': self.closed_bytes,
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+            'counters': self.counters,
+        }
+
+    @classmethod
+    def from_dict(cls, data, lateness_days=30, max_future_days=1):
+        state = cls(lateness_days, max_future_days)
+        # Checkpoints from before files were tracked by inode hold bare offsets
+        state.offsets = {name: entry if isinstance(entry, list) else [entry, None]
+                         for name, entry in data['offsets'].items()}
+        state.rejected = set(data.get('rejected', []))
+        state.windows = {decode_key(key): tuple(value) for key, value in data['windows'].items()}
+        state.closing = {decode_key(key): tuple(value) for key, value in data.get('closing', {}).items()}
+        # ... and kept closed windows among the open ones
+        for key in map(decode_key, data.get('closed', [])):
+            if key in state.windows:
+                state.closing[key] = state.windows.pop(key)
+        for key in state.windows:
+            state.ends.setdefault(window_end(key), set()).add(key)
+        state.closed_bytes = data.get('closed_bytes', 0)
+        state.watermark = date.fromisoformat(data['watermark']) if data['watermark'] else None
+        state.counters = data['counters']
+        return state
+
+def save_checkpoint(state, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state.to_dict(), f)
+    os.replace(path + '.tmp', path)
+
+def load_checkpoint(path, lateness_days=30, max_future_days=1):
+    if not os.path.exists(path):
+        return StreamState(lateness_days, max_future_days)
+    with open(path) as f:
+        return StreamState.from_dict(json.load(f), lateness_days, max_future_days)
+
+def poll(state, input_dir, pattern='*.csv', max_bytes=64 * 1024 * 1024):
+    """
+    Read one micro-batch: the new complete lines of every spool file, up to
+    about max_bytes. Returns (lines, new offsets, newly rejected files,
+    oldest write time among the files read). The offsets and rejections are
+    left to add_lines.
+    """
+    lines = []
+    offsets = {}
+    rejected = []
+    oldest = None
+    read = 0
+    for path in sorted(glob.glob(os.path.join(input_dir, pattern))):
+        name = os.path.basename(path)
+        if name in state.rejected:
+            continue
+        stat = os.stat(path)
+        offset, inode = state.offsets.get(name, [0, None])
+        if stat.st_size < offset or inode not in (None, stat.st_ino):
+            # Truncated or replaced: the rows read before are counted already
+            rejected.append(name)
+            continue
+        if stat.st_size == offset:
+            continue
+        new_lines, end = read_new_lines(path, offset)
+        offsets[name] = [end, stat.st_ino]
+        if new_lines:
+            lines += new_lines
+            oldest = stat.st_mtime if oldest is None else min(oldest, stat.st_mtime)
+            read += end - offset
+        if read >= max_bytes:
+            break
+    return lines, offsets, rejected, oldest
+
+def publish(state, output, closed_path):
+    # Windows closed since the last publish move to the closed-window file, then all rows are written
+    state.applying = True
+    if state.closing:
+        with open(closed_path, 'a', newline='') as f:
+            seasonal_rows(state.closing).to_csv(f, header=False, index=False)
+        state.closing = {}
+    state.closed_bytes = os.path.getsize(closed_path) if os.path.exists(closed_path) else 0
+    state.applying = False
+    rows = seasonal_rows(state.windows)
+    with open(output + '.tmp', 'w', newline='') as f:
+        rows.iloc[:0].to_csv(f, index=False)
+        if state.closed_bytes:
+            with open(closed_path, newline='') as closed:
+                shutil.copyfileobj(closed, f)
+        rows.to_csv(f, header=False, index=False)
+    os.replace(output + '.tmp', output)
+
+def run(input_dir, output, checkpoint, interval=5.0, publish_interval=60.0, lateness_days=30,
+        metrics_path=None, once=False, max_future_days=1):
+    state = load_checkpoint(checkpoint, lateness_days, max_future_days)
+    closed_path = closed_windows_path(checkpoint)
+    if os.path.exists(closed_path):
+        # Rows appended by a publish that was not checkpointed are written again
+        with open(closed_path, 'r+b') as f:
+            f.truncate(state.closed_bytes)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    metrics = open(metrics_path, 'a') if metrics_path else None
+    last_publish = time.time()
+    unpublished = None
+    print(f"Watching {input_dir}; {len(state.windows)} open windows restored")
+    try:
+        while True:
+            started = time.time()
+            lines, offsets, rejected, oldest = poll(state, input_dir)
+            for name in rejected:
+                print(f"  {name} shrank or was replaced; it is not read again (add new rows as a new file)")
+            rows, keys = state.add_lines(lines, offsets, rejected)
+            if oldest is not None:
+                unpublished = oldest if unpublished is None else min(unpublished, oldest)
+
+            published = False
+            drained = once and not lines
+            if unpublished is not None and (drained or time.time() - last_publish >= publish_interval):
+                publish(state, output, closed_path)
+                save_checkpoint(state, checkpoint)
+                last_publish = time.time()
+                published = True
+
+            seconds = time.time() - started
+            if lines or published:
+                record = {
+                    'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+                    'lines': len(lines), 'rows': rows, 'keys_updated': keys,
+                    'rows_per_sec': rows / seconds if seconds else None,
+                    'open_windows': len(state.windows),
+                    'watermark': state.watermark.isoformat() if state.watermark else None,
+                    'published': published,
+                    'latency_seconds': last_publish - unpublished if published else None,
+                }
+                latency = f", latency {record['latency_seconds']:.1f}s" if published else ""
+                print(f"  batch: {rows} rows, {keys} keys, {record['rows_per_sec'] or 0:.0f} rows/s, "
+                      f"watermark {record['watermark']}{latency}")
+                if metrics:
+                    metrics.write(json.dumps(record) + '\n')
+                    metrics.flush()
+            if published:
+                unpublished = None
+            if drained:
+                break
+            if not once:
+                time.sleep(max(interval - seconds, 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if metrics:
+            metrics.close()
+        if state.applying:
+            print("Interrupted while applying a batch; it is read again from the last checkpoint")
+        else:
+            if unpublished is not None or state.closing:
+                publish(state, output, closed_path)
+            save_checkpoint(state, checkpoint)
+            print(f"Checkpointed {len(state.windows)} open windows; counters: {state.counters}")
+    return state
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep seasonal aggregates up to date from a spool directory")
+    parser.add_argument('--input', default=os.path.join(STREAM_DIR, 'incoming'),
+                        help="spool directory of GSOD-format *.csv files")
+    parser.add_argument('--output', default=os.path.join(STREAM_DIR, 'seasonal_temperatures.csv'))
+    parser.add_argument('--checkpoint', default=os.path.join(STREAM_DIR, 'checkpoint.json'))
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between micro-batches")
+    parser.add_argument('--publish-interval', type=float, default=60.0,
+                        help="seconds between publishing the aggregates (and checkpointing)")
+    parser.add_argument('--lateness-days', type=int, default=30,
+                        help="days after a season ends before its window closes")
+    parser.add_argument('--max-future-days', type=int, default=1,
+                        help="rows dated more than this many days after today are dropped")
+    parser.add_argument('--metrics', default=None, help="append per-batch metrics as JSON lines to this file")
+    parser.add_argument('--once', action='store_true', help="ingest until the spool has no new rows, publish and exit")
+    args = parser.parse_args()
+    os.makedirs(args.input, exist_ok=True)
+    run(args.input, args.output, args.checkpoint, args.interval, args.publish_interval,
+        args.lateness_days, args.metrics, args.once, args.max_future_days)
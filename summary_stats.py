@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Summary statistics of the processed data in one vectorized pass.
+#
+# The processed rows are scattered into a season cube (stations x years x
+# seasons x metrics, NaN where there is no row), so every statistic is a
+# single NaN-aware NumPy reduction over all metric columns at once: over the
+# station axis for the per-year table and over stations and years for the
+# per-season table. The results are written as a tidy CSV and as JSON with a
+# fingerprint of the data they came from; visualization.py reads them instead
+# of recomputing, and recomputes only when the data has changed.
+import os
+import json
+import warnings
+import argparse
+import numpy as np
+import pandas as pd
+from cube import SeasonCube, METRICS
+from keys import SEASONS
+from render_cache import fingerprint
+
+SUMMARY_CSV = os.path.join('data', 'summary_stats.csv')
+SUMMARY_JSON = os.path.join('data', 'summary_stats.json')
+QUANTILES = [0.25, 0.5, 0.75]
+STATS = ['Count', 'Mean', 'Std', 'Min', 'Q25', 'Median', 'Q75', 'Max']
+
+def reduce_stats(values, axis):
+    # All STATS of values along axis, each shaped like the remaining axes
+    with warnings.catch_warnings():
+        # All-NaN slices (a season with no data in a year) just give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        quantiles = np.nanquantile(values, QUANTILES, axis=axis)
+        return {
+            'Count': (~np.isnan(values)).sum(axis=axis),
+            'Mean': np.nanmean(values, axis=axis),
+            'Std': np.nanstd(values, axis=axis, ddof=1),
+            'Min': np.nanmin(values, axis=axis),
+            'Q25': quantiles[0],
+            'Median': quantiles[1],
+            'Q75': quantiles[2],
+            'Max': np.nanmax(values, axis=axis),
+        }
+
+def stats_frame(stats, years=None):
+    # Tidy rows from reduce_stats output shaped (seasons, metrics) or (years, seasons, metrics)
+    shape = stats['Count'].shape
+    index = np.indices(shape).reshape(len(shape), -1)
+    frame = pd.DataFrame({
+        'Year': np.asarray(years)[index[0]] if years is not None else np.nan,
+        'Metric': np.asarray(METRICS)[index[-1]],
+        'Season': np.asarray(SEASONS)[index[-2]],
+    })
+    for name in STATS:
+        frame[name] = stats[name].reshape(-1)
+    return frame
+
+def summarize(cube):
+    """
+    Per-season (over all stations and years) and per-year (over all stations)
+    statistics of every metric as two tidy frames.
+    """
+    values = np.asarray(cube.values, dtype='float64')
+    flat = values.reshape((-1,) + values.shape[2:])
+    seasons = stats_frame(reduce_stats(flat, axis=0))
+    years = stats_frame(reduce_stats(values, axis=0), cube.years)
+    years = years[years['Count'] > 0].reset_index(drop=True)
+    return seasons.drop(columns='Year'), years
+
+def summary_paths(data_path):
+    # (csv, json) report paths next to the processed data they summarize
+    directory = os.path.dirname(data_path)
+    return os.path.join(directory, 'summary_stats.csv'), os.path.join(directory, 'summary_stats.json')
+
+def data_fingerprint(df):
+    return fingerprint(df, {'quantiles': QUANTILES})
+
+def save_summary(seasons, years, source, csv_path=SUMMARY_CSV, json_path=SUMMARY_JSON):
+    for path in (csv_path, json_path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    table = pd.concat([seasons.assign(Scope='season'), years.assign(Scope='year')], ignore_index=True)
+    table[['Scope', 'Year', 'Metric', 'Season'] + STATS].to_csv(csv_path, index=False)
+    report = {
+        'source_fingerprint': source,
+        'quantiles': QUANTILES,
+        # to_json writes NaN as null and NumPy numbers as plain JSON numbers
+        'seasons': json.loads(seasons.to_json(orient='records')),
+        'years': json.loads(years.astype({'Year': 'int64'}).to_json(orient='records')),
+    }
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+def load_summary(json_path=SUMMARY_JSON):
+    # (seasons, years, source fingerprint) from a saved report
+    with open(json_path) as f:
+        report = json.load(f)
+    return (pd.DataFrame(report['seasons'], columns=['Metric', 'Season'] + STATS),
+            pd.DataFrame(report['years'], columns=['Year', 'Metric', 'Season'] + STATS),
+            report['source_fingerprint'])
+
+def load_or_compute(df, csv_path=SUMMARY_CSV, json_path=SUMMARY_JSON):
+    # The saved report if it was made from exactly this data, else a fresh (and saved) one
+    source = data_fingerprint(df)
+    if os.path.exists(json_path):
+        seasons, years, saved_source = load_summary(json_path)
+        if saved_source == source:
+            return seasons, years
+    seasons, years = summarize(SeasonCube.from_wide(df))
+    save_summary(seasons, years, source, csv_path, json_path)
+    return seasons, years
+
+def season_table(seasons):
+    # One row per season (in SEASONS order), one column per Metric_Stat
+    table = seasons.pivot(index='Season', columns='Metric', values=STATS)
+    table.columns = [f'{metric}_{stat}' for stat, metric in table.columns]
+    return table.reindex(SEASONS)
+
+def yearly_table(years, stat='Mean'):
+    # One row per year, one column per Metric_Season (like processed_data)
+    table = years.pivot(index='Year', columns=['Metric', 'Season'], values=stat)
+    table.columns = [f'{metric}_{season}' for metric, season in table.columns]
+    return table.sort_index()
+
+if __name__ == "__main__":
+    from visualization import load_data
+
+    parser = argparse.ArgumentParser(description="Per-season and per-year summary statistics")
+    parser.add_argument('--csv', default=SUMMARY_CSV)
+    parser.add_argument('--json', default=SUMMARY_JSON)
+    args = parser.parse_args()
+
+    filled_df = load_data()
+    seasons, years = summarize(SeasonCube.from_wide(filled_df))
+    save_summary(seasons, years, data_fingerprint(filled_df), args.csv, args.json)
+    print(season_table(seasons)[['AverageTemp_Count', 'AverageTemp_Mean', 'AverageTemp_Std']].round(2))
+    print(f"Saved summary statistics to {args.csv} and {args.json}")
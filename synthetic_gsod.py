@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Generates GSOD-shaped yearly archives for scale testing.
+#
+# Each <year>.tar.gz holds one <station>.csv per station with the real GSOD
+# column layout: every field quoted, station names containing commas, and
+# 9999.9 / 999.9 for missing measurements. Output is a pure function of the
+# seed and the options (the same station gets the same data whatever the
+# number of years, and the archives are byte-for-byte reproducible), so
+# combine_data.py, the MapReduce scripts and process.py can be run on
+# repeatable inputs at any volume.
+#
+#   --stations   number of stations (production is about 12,000)
+#   --missing    fraction of reported days with TEMP = 9999.9
+#   --skew       how unevenly stations report: station k (in a random order)
+#                reports about (k + 1) ** -skew of the days, at least 2%;
+#                0 means every station reports every day
+import os
+import io
+import csv
+import gzip
+import time
+import tarfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['STATION', 'DATE', 'LATITUDE', 'LONGITUDE', 'ELEVATION', 'NAME',
+           'TEMP', 'TEMP_ATTRIBUTES', 'DEWP', 'DEWP_ATTRIBUTES', 'SLP', 'SLP_ATTRIBUTES',
+           'STP', 'STP_ATTRIBUTES', 'VISIB', 'VISIB_ATTRIBUTES', 'WDSP', 'WDSP_ATTRIBUTES',
+           'MXSPD', 'GUST', 'MAX', 'MAX_ATTRIBUTES', 'MIN', 'MIN_ATTRIBUTES',
+           'PRCP', 'PRCP_ATTRIBUTES', 'SNDP', 'FRSHTT']
+MISSING_TEMP = '9999.9'
+MISSING_SPEED = '999.9'
+# Stations are generated in fixed batches so the random streams (and the
+# output) do not depend on anything but the seed
+BATCH_SIZE = 1000
+MIN_REPORTING = 0.02
+COUNTRIES = ['US', 'CA', 'MX', 'UK', 'FR', 'NO', 'AS', 'BR', 'IN', 'CH']
+
+def station_table(num_stations, seed, skew=0.0):
+    """
+    Ids, coordinates, names and the fraction of days each station reports.
+    The ids are sorted 11-digit USAF+WBAN numbers.
+    """
+    rng = np.random.default_rng([seed, 0])
+    usaf = np.sort(rng.choice(900_000, num_stations, replace=False)) + 10_000
+    ids = np.char.add(np.char.zfill(usaf.astype(str), 6), '99999')
+
+    # Uniform on the sphere
+    latitude = np.degrees(np.arcsin(rng.uniform(-1, 1, num_stations)))
+    longitude = rng.uniform(-180, 180, num_stations)
+    elevation = np.round(np.abs(rng.normal(300, 500, num_stations)), 1)
+
+    # Real names are "PLACE, COUNTRY", which is why NAME has to be quoted
+    countries = np.asarray(COUNTRIES)[rng.integers(0, len(COUNTRIES), num_stations)]
+    names = np.char.add(np.char.add('SYNTH STATION ', np.arange(num_stations).astype(str)),
+                        np.char.add(', ', countries))
+
+    rank = rng.permutation(num_stations)
+    reporting = np.maximum((rank + 1.0) ** -skew, MIN_REPORTING)
+    return pd.DataFrame({'STATION': ids, 'LATITUDE': latitude, 'LONGITUDE': longitude,
+                         'ELEVATION': elevation, 'NAME': names, 'REPORTING': reporting})
+
+def fmt(values, spec):
+    return np.char.mod(spec, values)
+
+def batch_rows(stations, year, batch, seed, missing=0.05):
+    # All rows of one batch of stations for one year, as a frame of strings
+    rng = np.random.default_rng([seed, year, batch])
+    days = pd.date_range(f'{year}-01-01', f'{year}-12-31')
+    num_days = len(days)
+
+    reported = rng.random((len(stations), num_days)) < stations['REPORTING'].to_numpy()[:, None]
+    station_idx, day_idx = np.nonzero(reported)
+    n = len(station_idx)
+    latitude = stations['LATITUDE'].to_numpy()
+
+    # Colder towards the poles, seasons flipped in the southern hemisphere
+    mean = 80 - 0.8 * np.abs(latitude)
+    amplitude = 5 + 0.4 * np.abs(latitude)
+    phase = np.cos(2 * np.pi * (days.dayofyear.to_numpy() - 200) / 365.25)
+    temp = (mean[station_idx] + amplitude[station_idx] * phase[day_idx] * np.sign(latitude[station_idx])
+            + rng.normal(0, 6, n))
+    spread = np.abs(rng.normal(9, 3, n))
+
+    # np.where rather than item assignment, which would truncate the
+    # sentinel to the width of the formatted strings
+    temp_text = np.where(rng.random(n) < missing, MISSING_TEMP, fmt(np.round(temp, 1), '%.1f'))
+    max_text = np.where(rng.random(n) < missing, MISSING_TEMP, fmt(np.round(temp + spread, 1), '%.1f'))
+    min_text = np.where(rng.random(n) < missing, MISSING_TEMP, fmt(np.round(temp - spread, 1), '%.1f'))
+    attributes = rng.integers(4, 25, n).astype(str)
+
+    station = stations.iloc[station_idx]
+    return pd.DataFrame({
+        'STATION': station['STATION'].to_numpy(),
+        'DATE': days.strftime('%Y-%m-%d').to_numpy()[day_idx],
+        'LATITUDE': fmt(station['LATITUDE'].to_numpy(), '%.7f'),
+        'LONGITUDE': fmt(station['LONGITUDE'].to_numpy(), '%.7f'),
+        'ELEVATION': fmt(station['ELEVATION'].to_numpy(), '%.1f'),
+        'NAME': station['NAME'].to_numpy(),
+        'TEMP': temp_text,
+        'TEMP_ATTRIBUTES': attributes,
+        'DEWP': fmt(np.round(temp - spread / 2 - 5, 1), '%.1f'),
+        'DEWP_ATTRIBUTES': attributes,
+        'SLP': fmt(np.round(rng.normal(1013, 8, n), 1), '%.1f'),
+        'SLP_ATTRIBUTES': attributes,
+        'STP': MISSING_SPEED,
+        'STP_ATTRIBUTES': '0',
+        'VISIB': fmt(np.round(rng.uniform(1, 10, n), 1), '%.1f'),
+        'VISIB_ATTRIBUTES': attributes,
+        'WDSP': fmt(np.round(rng.gamma(2, 3, n), 1), '%.1f'),
+        'WDSP_ATTRIBUTES': attributes,
+        'MXSPD': fmt(np.round(rng.gamma(3, 4, n), 1), '%.1f'),
+        'GUST': MISSING_SPEED,
+        'MAX': max_text,
+        'MAX_ATTRIBUTES': '',
+        'MIN': min_text,
+        'MIN_ATTRIBUTES': '',
+        'PRCP': fmt(np.round(rng.exponential(0.05, n), 2), '%.2f'),
+        'PRCP_ATTRIBUTES': 'G',
+        'SNDP': MISSING_SPEED,
+        'FRSHTT': '000000',
+    }, columns=COLUMNS)
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    # Fixed metadata so the archive bytes only depend on the content
+    info.mtime = 0
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+def write_year(path, stations, year, seed, missing=0.05):
+    """
+    Write one yearly archive with a <station>.csv member per station that
+    reported at least one day. Returns (rows, members).
+    """
+    rows = members = 0
+    # gzip's default level; 9 is several times slower for a few percent
+    with open(path, 'wb') as raw, \
+            gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0, filename='') as gz, \
+            tarfile.open(fileobj=gz, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+        for batch, first in enumerate(range(0, len(stations), BATCH_SIZE)):
+            frame = batch_rows(stations.iloc[first:first + BATCH_SIZE], year, batch, seed, missing)
+            # One CSV text for the batch, then cut into per-station members;
+            # rows are already grouped by station
+            lines = frame.to_csv(index=False, quoting=csv.QUOTE_ALL, lineterminator='\n').split('\n')
+            header, body = lines[0], lines[1:-1]
+            ids, starts = np.unique(frame['STATION'].to_numpy(), return_index=True)
+            bounds = list(starts) + [len(body)]
+            for station, start, end in zip(ids, bounds[:-1], bounds[1:]):
+                text = header + '\n' + '\n'.join(body[start:end]) + '\n'
+                add_member(tar, f'{station}.csv', text.encode())
+                members += 1
+            rows += len(frame)
+    return rows, members
+
+def generate(output_dir, num_stations=100, start_year=2020, num_years=1, seed=0, missing=0.05, skew=0.0,
+             workers=None):
+    """
+    Write one archive per year, the years in parallel worker processes.
+    Returns [(path, rows, members)] in year order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stations = station_table(num_stations, seed, skew)
+    paths = [os.path.join(output_dir, f'{year}.tar.gz') for year in range(start_year, start_year + num_years)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(write_year, path, stations, start_year + i, seed, missing)
+                   for i, path in enumerate(paths)]
+        return [(path,) + future.result() for path, future in zip(paths, futures)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic GSOD yearly .tar.gz archives")
+    parser.add_argument('--output', default=os.path.join('data', 'synthetic'))
+    parser.add_argument('--stations', type=int, default=100)
+    parser.add_argument('--start-year', type=int, default=2020)
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--missing', type=float, default=0.05, help="fraction of TEMP/MAX/MIN set to 9999.9")
+    parser.add_argument('--skew', type=float, default=0.0, help="power-law exponent of reporting days")
+    parser.add_argument('--workers', type=int, default=None, help="years generated in parallel")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for path, rows, members in generate(args.output, args.stations, args.start_year, args.years,
+                                        args.seed, args.missing, args.skew, args.workers):
+        print(f"Saved {path}: {members} stations, {rows} rows, {os.path.getsize(path) / 1e6:.1f} MB")
+    print(f"Done in {time.perf_counter() - start:.1f}s")
@@ -1,224 +1,382 @@
+import os
+import time
+import inspect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-
-# Load the data
-filled_df = pd.read_csv('data\processed_data.csv')
+import render_cache
+import summary_stats
+import plot_data
+from metrics import Metrics, file_size
+from profiling import Profiler
+from cube import SeasonCube
+from plot_data import top_stations_by_mean, top_stations_by_count, heatmap_matrix, station_means
 
 # Define the seasons and other constants
 seasons = ['Winter', 'Spring', 'Summer', 'Fall']
 colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728']  # Different color for each season
-stations = filled_df['StationID'].unique()
-years = filled_df['Year'].unique()
-
-# Seasonal Temperature Comparison
-fig, axes = plt.subplots(3, 1, figsize=(12, 15))
-titles = ['Average Temperature', 'Maximum Temperature', 'Minimum Temperature']
-metrics = ['AverageTemp', 'MaxTemp', 'MinTemp']
-
-for i, (metric, title) in enumerate(zip(metrics, titles)):
-    ax = axes[i]
-    
-    # Collect data for each season
-    for j, season in enumerate(seasons):
-        col_name = f'{metric}_{season}'
-        if col_name in filled_df.columns:
-            data = filled_df[col_name].dropna()
-            
-            # Create box plot manually
-            bp = ax.boxplot(data, positions=[j+1], widths=0.6, patch_artist=True)
-            
-            # Set box color
-            for box in bp['boxes']:
-                box.set(color=colors[j], linewidth=2)
-                box.set(facecolor=colors[j], alpha=0.3)
-            
-            # Set whisker color
-            for whisker in bp['whiskers']:
-                whisker.set(color=colors[j], linewidth=2)
-            
-            # Set cap color
-            for cap in bp['caps']:
-                cap.set(color=colors[j], linewidth=2)
-            
-            # Set median color
-            for median in bp['medians']:
-                median.set(color='black', linewidth=2)
-    
-    ax.set_title(f'{title} by Season (All Stations)')
-    ax.set_ylabel('Temperature (°F)')
-    ax.set_xticks([1, 2, 3, 4])
-    ax.set_xticklabels(seasons)
-    ax.grid(True, linestyle='--', alpha=0.7)
-
-plt.tight_layout()
-plt.savefig('seasonal_temperatures.png', dpi=300)
-plt.show()
-
-# Year-over-Year Trends - Select top 8 stations to avoid overcrowding
-plt.figure(figsize=(12, 8))
-
-# Sort stations by average summer temperature to pick meaningful subset
-if 'AverageTemp_Summer' in filled_df.columns:
-    station_avg_temp = []
-    for station in stations:
-        avg = filled_df[filled_df['StationID'] == station]['AverageTemp_Summer'].mean()
-        station_avg_temp.append((station, avg))
-    
-    # Sort by temperature and take top 8
-    station_avg_temp.sort(key=lambda x: x[1] if not np.isnan(x[1]) else -999, reverse=True)
-    selected_stations = [x[0] for x in station_avg_temp[:8] if not np.isnan(x[1])]
-else:
-    # If no Summer data, just take first 8 stations
-    selected_stations = stations[:8]
-
-for station in selected_stations:
-    station_data = filled_df[filled_df['StationID'] == station]
+
+CUBE_DIR = os.path.join('data', 'processed_cube')
+PROCESSED_CSV = os.path.join('data', 'processed_data.csv')
+
+def load_data(cube_dir=CUBE_DIR, csv_path=PROCESSED_CSV):
+    # Load the data, preferring the memory-mapped cube written by process.py
+    if os.path.isdir(cube_dir):
+        return SeasonCube.load(cube_dir).to_wide()
+    return pd.read_csv(csv_path)
+
+def finish(path, dpi, show):
+    plt.tight_layout()
+    plt.savefig(path, dpi=dpi)
+    if show:
+        plt.show()
+    plt.close('all')
+
+def plot_seasonal_boxplots(filled_df, path, dpi=300, show=False):
+    # Seasonal Temperature Comparison
+    fig, axes = plt.subplots(3, 1, figsize=(12, 15))
+    titles = ['Average Temperature', 'Maximum Temperature', 'Minimum Temperature']
+    metrics = ['AverageTemp', 'MaxTemp', 'MinTemp']
+
+    for i, (metric, title) in enumerate(zip(metrics, titles)):
+        ax = axes[i]
+
+        # Collect data for each season
+        for j, season in enumerate(seasons):
+            col_name = f'{metric}_{season}'
+            if col_name in filled_df.columns:
+                data = filled_df[col_name].dropna()
+
+                # Create box plot manually
+                bp = ax.boxplot(data, positions=[j+1], widths=0.6, patch_artist=True)
+
+                # Set box color
+                for box in bp['boxes']:
+                    box.set(color=colors[j], linewidth=2)
+                    box.set(facecolor=colors[j], alpha=0.3)
+
+                # Set whisker color
+                for whisker in bp['whiskers']:
+                    whisker.set(color=colors[j], linewidth=2)
+
+                # Set cap color
+                for cap in bp['caps']:
+                    cap.set(color=colors[j], linewidth=2)
+
+                # Set median color
+                for median in bp['medians']:
+                    median.set(color='black', linewidth=2)
+
+        ax.set_title(f'{title} by Season (All Stations)')
+        ax.set_ylabel('Temperature (°F)')
+        ax.set_xticks([1, 2, 3, 4])
+        ax.set_xticklabels(seasons)
+        ax.grid(True, linestyle='--', alpha=0.7)
+
+    finish(path, dpi, show)
+
+def plot_yearly_trends(filled_df, path, dpi=300, show=False):
+    # Year-over-Year Trends - Select top 8 stations to avoid overcrowding
+    plt.figure(figsize=(12, 8))
+    stations = filled_df['StationID'].unique()
+
+    # Sort stations by average summer temperature to pick meaningful subset
     if 'AverageTemp_Summer' in filled_df.columns:
-        plt.plot(station_data['Year'], station_data['AverageTemp_Summer'], 
-                marker='o', linewidth=2, label=f'Station {station}')
-
-plt.title('Summer Average Temperature Trends by Station (Top 8 Stations)')
-plt.xlabel('Year')
-plt.ylabel('Temperature (°F)')
-plt.legend()
-plt.grid(True)
-plt.tight_layout()
-plt.savefig('yearly_trends_fixed.png', dpi=300)
-plt.show()
-
-# Heatmap of temperature data - display only top 15 stations for readability
-plt.figure(figsize=(12, 10))
-
-# Select top 15 stations by data availability
-if len(stations) > 15:
-    station_counts = []
-    for station in stations:
+        # Sort by temperature and take top 8
+        selected_stations = top_stations_by_mean(filled_df, 'AverageTemp_Summer', 8)
+    else:
+        # If no Summer data, just take first 8 stations
+        selected_stations = stations[:8]
+
+    selected_data = filled_df[filled_df['StationID'].isin(selected_stations)].groupby('StationID')
+    for station in selected_stations:
+        station_data = selected_data.get_group(station)
         if 'AverageTemp_Summer' in filled_df.columns:
-            count = filled_df[filled_df['StationID'] == station]['AverageTemp_Summer'].notna().sum()
-            station_counts.append((station, count))
-    
-    # Sort by data availability
-    station_counts.sort(key=lambda x: x[1], reverse=True)
-    display_stations = [x[0] for x in station_counts[:15]]
-else:
-    display_stations = stations
-
-# Create a data matrix for the heatmap
-heatmap_data = np.zeros((len(display_stations), len(years)))
-
-for i, station in enumerate(display_stations):
-    for j, year in enumerate(years):
-        mask = (filled_df['StationID'] == station) & (filled_df['Year'] == year)
-        if mask.any() and 'AverageTemp_Summer' in filled_df.columns:
-            temp = filled_df.loc[mask, 'AverageTemp_Summer'].values
-            if len(temp) > 0 and not np.isnan(temp[0]):
-                heatmap_data[i, j] = temp[0]
-
-im = plt.imshow(heatmap_data, cmap='YlOrRd')
-plt.colorbar(im, label='Temperature (°F)')
-plt.title('Summer Average Temperatures by Station and Year')
-plt.xlabel('Year')
-plt.ylabel('Station ID')
-
-# Add x and y tick labels with better formatting
-plt.xticks(range(len(years)), years, rotation=45)
-plt.yticks(range(len(display_stations)), [str(s)[-4:] for s in display_stations])  # Show last 4 digits only
-
-# Add annotations - only for non-zero values
-for i in range(len(display_stations)):
-    for j in range(len(years)):
-        if heatmap_data[i, j] > 0:  # Only annotate non-zero values
-            plt.text(j, i, f'{heatmap_data[i, j]:.1f}', 
-                     ha='center', va='center', 
-                     color='black' if heatmap_data[i, j] < 70 else 'white',
-                     fontsize=8)
-
-plt.tight_layout()
-plt.savefig('temperature_heatmap_fixed.png', dpi=300)
-plt.show()
-
-# Bar chart showing seasonal averages by station limit to 10 stations for readability
-plt.figure(figsize=(16, 8))
-bar_width = 0.2
-
-# Select top 10 stations with most complete data
-if len(stations) > 10:
-    data_counts = []
-    for station in stations:
-        count = 0
-        for season in seasons:
-            col_name = f'AverageTemp_{season}'
-            if col_name in filled_df.columns:
-                count += filled_df[filled_df['StationID'] == station][col_name].notna().sum()
-        data_counts.append((station, count))
-    
-    # Sort by data completeness
-    data_counts.sort(key=lambda x: x[1], reverse=True)
-    display_stations = [x[0] for x in data_counts[:10]]
-else:
-    display_stations = stations
-
-x = np.arange(len(display_stations))
-
-for i, season in enumerate(seasons):
-    col_name = f'AverageTemp_{season}'
-    if col_name in filled_df.columns:
-        season_avgs = [filled_df[filled_df['StationID'] == station][col_name].mean() 
-                     for station in display_stations]
-        plt.bar(x + i*bar_width, season_avgs, width=bar_width, 
-                label=season, alpha=0.7)
-
-plt.xlabel('Station ID')
-plt.ylabel('Average Temperature (°F)')
-plt.title('Average Temperature by Station and Season')
-# Show shortened station IDs for readability
-plt.xticks(x + bar_width*1.5, [str(s)[-4:] for s in display_stations], rotation=45)
-plt.legend()
-plt.grid(True, linestyle='--', alpha=0.3)
-plt.tight_layout()
-plt.savefig('station_season_averages_fixed.png', dpi=300)
-plt.show()
-
-# Summary statistics table for the report
-print("\nSummary Statistics by Season:")
-for season in seasons:
-    avg_col = f'AverageTemp_{season}'
-    max_col = f'MaxTemp_{season}'
-    min_col = f'MinTemp_{season}'
-    
-    if avg_col in filled_df.columns:
-        avg_temp = filled_df[avg_col].mean()
-        avg_std = filled_df[avg_col].std()
-        
-        max_temp = filled_df[max_col].mean() if max_col in filled_df.columns else np.nan
-        min_temp = filled_df[min_col].mean() if min_col in filled_df.columns else np.nan
-        
-        station_count = filled_df[avg_col].notna().sum()
-        
-        print(f"\n{season}:")
-        print(f"  Average Temperature: {avg_temp:.2f}°F (±{avg_std:.2f})")
-        print(f"  Average Maximum: {max_temp:.2f}°F")
-        print(f"  Average Minimum: {min_temp:.2f}°F")
-        print(f"  Data points: {station_count}")
-
-#  Average temperature over years for all stations
-plt.figure(figsize=(12, 6))
-
-yearly_avgs = {}
-for season in seasons:
-    col_name = f'AverageTemp_{season}'
-    if col_name in filled_df.columns:
-        yearly_avgs[season] = filled_df.groupby('Year')[col_name].mean()
-
-for season, avgs in yearly_avgs.items():
-    plt.plot(avgs.index, avgs.values, marker='o', linewidth=2, label=season)
-
-plt.title('Average Temperature Trends by Season (All Stations)')
-plt.xlabel('Year')
-plt.ylabel('Temperature (°F)')
-plt.legend()
-plt.grid(True)
-plt.tight_layout()
-plt.savefig('yearly_season_trends.png', dpi=300)
-plt.show()
\ No newline at end of file
+            plt.plot(station_data['Year'], station_data['AverageTemp_Summer'],
+                    marker='o', linewidth=2, label=f'Station {station}')
+
+    plt.title('Summer Average Temperature Trends by Station (Top 8 Stations)')
+    plt.xlabel('Year')
+    plt.ylabel('Temperature (°F)')
+    plt.legend()
+    plt.grid(True)
+    finish(path, dpi, show)
+
+def plot_heatmap(filled_df, path, dpi=300, show=False):
+    # Heatmap of temperature data - display only top 15 stations for readability
+    plt.figure(figsize=(12, 10))
+    stations = filled_df['StationID'].unique()
+    years = filled_df['Year'].unique()
+
+    # Select top 15 stations by data availability
+    if len(stations) > 15:
+        # Sort by data availability
+        display_stations = top_stations_by_count(filled_df, ['AverageTemp_Summer'], 15)
+    else:
+        display_stations = stations
+
+    # Create a data matrix for the heatmap
+    if 'AverageTemp_Summer' in filled_df.columns:
+        heatmap_data = heatmap_matrix(filled_df, display_stations, years, 'AverageTemp_Summer')
+    else:
+        heatmap_data = np.zeros((len(display_stations), len(years)))
+
+    im = plt.imshow(heatmap_data, cmap='YlOrRd')
+    plt.colorbar(im, label='Temperature (°F)')
+    plt.title('Summer Average Temperatures by Station and Year')
+    plt.xlabel('Year')
+    plt.ylabel('Station ID')
+
+    # Add x and y tick labels with better formatting
+    plt.xticks(range(len(years)), years, rotation=45)
+    plt.yticks(range(len(display_stations)), [str(s)[-4:] for s in display_stations])  # Show last 4 digits only
+
+    # Add annotations - only for non-zero values
+    for i in range(len(display_stations)):
+        for j in range(len(years)):
+            if heatmap_data[i, j] > 0:  # Only annotate non-zero values
+                plt.text(j, i, f'{heatmap_data[i, j]:.1f}',
+                         ha='center', va='center',
+                         color='black' if heatmap_data[i, j] < 70 else 'white',
+                         fontsize=8)
+
+    finish(path, dpi, show)
+
+def plot_station_averages(filled_df, path, dpi=300, show=False):
+    # Bar chart showing seasonal averages by station limit to 10 stations for readability
+    plt.figure(figsize=(16, 8))
+    bar_width = 0.2
+    stations = filled_df['StationID'].unique()
+
+    # Select top 10 stations with most complete data
+    if len(stations) > 10:
+        # Sort by data completeness
+        display_stations = top_stations_by_count(filled_df, [f'AverageTemp_{season}' for season in seasons], 10)
+    else:
+        display_stations = stations
+
+    x = np.arange(len(display_stations))
+    display_means = station_means(filled_df, display_stations, [f'AverageTemp_{season}' for season in seasons])
+
+    for i, season in enumerate(seasons):
+        col_name = f'AverageTemp_{season}'
+        if col_name in filled_df.columns:
+            season_avgs = display_means[col_name].to_numpy()
+            plt.bar(x + i*bar_width, season_avgs, width=bar_width,
+                    label=season, alpha=0.7)
+
+    plt.xlabel('Station ID')
+    plt.ylabel('Average Temperature (°F)')
+    plt.title('Average Temperature by Station and Season')
+    # Show shortened station IDs for readability
+    plt.xticks(x + bar_width*1.5, [str(s)[-4:] for s in display_stations], rotation=45)
+    plt.legend()
+    plt.grid(True, linestyle='--', alpha=0.3)
+    finish(path, dpi, show)
+
+def plot_season_trends(filled_df, path, dpi=300, show=False, summary=None):
+    #  Average temperature over years for all stations, from the summary report (seasons, years)
+    plt.figure(figsize=(12, 6))
+
+    yearly_avgs = {}
+    summary = summary or summary_stats.load_or_compute(filled_df)
+    season_yearly_means = summary_stats.yearly_table(summary[1])
+    for season in seasons:
+        col_name = f'AverageTemp_{season}'
+        if col_name in filled_df.columns:
+            yearly_avgs[season] = season_yearly_means[col_name]
+
+    for season, avgs in yearly_avgs.items():
+        plt.plot(avgs.index, avgs.values, marker='o', linewidth=2, label=season)
+
+    plt.title('Average Temperature Trends by Season (All Stations)')
+    plt.xlabel('Year')
+    plt.ylabel('Temperature (°F)')
+    plt.legend()
+    plt.grid(True)
+    finish(path, dpi, show)
+
+def print_summary(filled_df, summary=None):
+    # Summary statistics table for the report, read from summary_stats.py's output
+    summary = summary or summary_stats.load_or_compute(filled_df)
+    season_stats = summary_stats.season_table(summary[0])
+    print("\nSummary Statistics by Season:")
+    for season in seasons:
+        avg_col = f'AverageTemp_{season}'
+
+        if avg_col in filled_df.columns:
+            row = season_stats.loc[season]
+            max_temp = row['MaxTemp_Mean'] if f'MaxTemp_{season}' in filled_df.columns else np.nan
+            min_temp = row['MinTemp_Mean'] if f'MinTemp_{season}' in filled_df.columns else np.nan
+
+            print(f"\n{season}:")
+            print(f"  Average Temperature: {row['AverageTemp_Mean']:.2f}°F (±{row['AverageTemp_Std']:.2f})")
+            print(f"  Average Maximum: {max_temp:.2f}°F")
+            print(f"  Average Minimum: {min_temp:.2f}°F")
+            print(f"  Data points: {int(row['AverageTemp_Count'])}")
+
+# Figure name -> (plot function, output file), in the order they are shown
+FIGURES = {
+    'seasonal_boxplots': (plot_seasonal_boxplots, 'seasonal_temperatures.png'),
+    'yearly_trends': (plot_yearly_trends, 'yearly_trends_fixed.png'),
+    'heatmap': (plot_heatmap, 'temperature_heatmap_fixed.png'),
+    'station_averages': (plot_station_averages, 'station_season_averages_fixed.png'),
+    'season_trends': (plot_season_trends, 'yearly_season_trends.png'),
+}
+
+# Columns each figure reads; the render cache fingerprints only these
+FIGURE_COLUMNS = {
+    'seasonal_boxplots': [f'{metric}_{season}' for metric in ['AverageTemp', 'MaxTemp', 'MinTemp']
+                          for season in seasons],
+    'yearly_trends': ['StationID', 'Year', 'AverageTemp_Summer'],
+    'heatmap': ['StationID', 'Year', 'AverageTemp_Summer'],
+    'station_averages': ['StationID'] + [f'AverageTemp_{season}' for season in seasons],
+    'season_trends': ['Year'] + [f'AverageTemp_{season}' for season in seasons],
+}
+
+# Figures drawn from the summary report, which draw() passes in
+SUMMARY_FIGURES = {'season_trends'}
+
+def draw(name, filled_df, path, dpi=300, show=False, summary=None):
+    plot = FIGURES[name][0]
+    if name in SUMMARY_FIGURES:
+        return plot(filled_df, path, dpi, show, summary=summary)
+    return plot(filled_df, path, dpi, show)
+
+# Modules whose code the plot functions call (finish, plot_data's matrices, the summary report)
+HELPER_MODULES = [__file__, plot_data.__file__, summary_stats.__file__]
+
+def figure_fingerprint(filled_df, name, dpi):
+    plot, filename = FIGURES[name]
+    columns = [c for c in FIGURE_COLUMNS[name] if c in filled_df.columns]
+    helpers = {os.path.basename(path): render_cache.file_digest(path) for path in HELPER_MODULES}
+    params = {'figure': name, 'file': filename, 'dpi': dpi, 'code': inspect.getsource(plot), 'helpers': helpers}
+    return render_cache.fingerprint(filled_df[columns], params)
+
+# Data of a batch worker process, loaded once when the worker starts; the summary comes from the parent
+_worker_df = None
+_worker_summary = None
+_worker_profiler = Profiler(None)
+
+def _init_worker(cube_dir, csv_path, summary):
+    global _worker_df, _worker_summary, _worker_profiler
+    plt.switch_backend('Agg')
+    _worker_df = load_data(cube_dir, csv_path)
+    _worker_summary = summary
+    _worker_profiler = Profiler.from_env('visualization')
+
+def _render_in_worker(name, path, dpi):
+    start = time.perf_counter()
+    with _worker_profiler.section(name):
+        draw(name, _worker_df, path, dpi, summary=_worker_summary)
+    return name, path, time.perf_counter() - start
+
+def render_batch(names, output_dir, dpi=300, workers=None, cube_dir=CUBE_DIR, csv_path=PROCESSED_CSV,
+                 force=False, metrics=None, filled_df=None, summary=None):
+    """
+    Render the named figures concurrently, one per worker process, with the
+    non-interactive Agg backend. The figures are independent, so the wall time
+    is close to that of the slowest one. Figures whose data and parameters
+    match the manifest in output_dir are skipped unless force is set.
+    filled_df is loaded here unless the caller has it. The summary report,
+    written next to csv_path, is only loaded when a stale figure draws from it.
+    Returns {name: (path, seconds)}, with seconds None for cached figures.
+    """
+    metrics = metrics or Metrics.disabled()
+    os.makedirs(output_dir, exist_ok=True)
+    if filled_df is None:
+        with metrics.stage('load') as stage:
+            filled_df = load_data(cube_dir, csv_path)
+            stage.count(rows_out=len(filled_df))
+    manifest = render_cache.load_manifest(output_dir)
+    digests = {name: figure_fingerprint(filled_df, name, dpi) for name in names}
+    paths = {name: os.path.join(output_dir, FIGURES[name][1]) for name in names}
+
+    results = {}
+    stale = []
+    for name in names:
+        if not force and render_cache.is_fresh(manifest, name, paths[name], digests[name]):
+            results[name] = (paths[name], None)
+            print(f"  {name:<20}{'cached':>8}  {paths[name]}")
+        else:
+            stale.append(name)
+
+    if summary is None and SUMMARY_FIGURES.intersection(stale):
+        # Fingerprinted once here and handed to the workers
+        with metrics.stage('summary'):
+            summary = summary_stats.load_or_compute(filled_df, *summary_stats.summary_paths(csv_path))
+
+    if stale:
+        # The figures render in the workers, so each one is attached with its worker-side time
+        with metrics.stage('render') as stage, \
+                ProcessPoolExecutor(max_workers=workers or len(stale), initializer=_init_worker,
+                                    initargs=(cube_dir, csv_path, summary)) as pool:
+            futures = [pool.submit(_render_in_worker, name, paths[name], dpi) for name in stale]
+            for future in futures:
+                name, path, seconds = future.result()
+                results[name] = (path, seconds)
+                render_cache.record(manifest, name, path, digests[name], seconds, len(filled_df))
+                metrics.record(name, seconds, rows_in=len(filled_df), bytes_out=file_size(path))
+                stage.count(rows_in=len(filled_df), bytes_out=file_size(path), figures=1)
+                print(f"  {name:<20}{seconds:>7.2f}s  {path}")
+        manifest['source'] = cube_dir if os.path.isdir(cube_dir) else csv_path
+        render_cache.save_manifest(output_dir, manifest)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot seasonal temperature trends")
+    parser.add_argument('--input', default=PROCESSED_CSV, help="processed data, used when there is no cube")
+    parser.add_argument('--cube-dir', default=CUBE_DIR, help="filled cube written by process.py")
+    parser.add_argument('--batch', action='store_true',
+                        help="render headless in parallel worker processes without opening windows")
+    parser.add_argument('--output-dir', default='.', help="directory for the PNG files")
+    parser.add_argument('--figures', default=','.join(FIGURES),
+                        help=f"comma-separated subset of {','.join(FIGURES)}")
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=None, help="batch worker processes (default: one per figure)")
+    parser.add_argument('--no-summary', action='store_true', help="skip the summary statistics")
+    parser.add_argument('--force', action='store_true', help="re-render batch figures even if cached")
+    parser.add_argument('--metrics', default=None, help="write a JSON metrics document for the run to this file")
+    parser.add_argument('--profile', default=None,
+                        help="write cProfile and sampled-stack output of each figure to this directory")
+    args = parser.parse_args()
+    metrics = Metrics('visualization', enabled=bool(args.metrics))
+    profiler = Profiler.configure('visualization', args.profile)
+
+    names = [name for name in args.figures.split(',') if name]
+    unknown = [name for name in names if name not in FIGURES]
+    if unknown:
+        parser.error(f"Unknown figures: {unknown}")
+    if not names:
+        parser.error(f"--figures selects no figures; choose from {','.join(FIGURES)}")
+
+    start = time.perf_counter()
+    with metrics.stage('load') as stage:
+        filled_df = load_data(args.cube_dir, args.input)
+        stage.count(rows_out=len(filled_df))
+    # The report, next to the processed data, is fingerprinted once and passed to every figure and
+    # the printed summary; it is not touched unless one of them needs it
+    summary = None
+    if not args.no_summary or SUMMARY_FIGURES.intersection(names):
+        with metrics.stage('summary'):
+            summary = summary_stats.load_or_compute(filled_df, *summary_stats.summary_paths(args.input))
+
+    if args.batch:
+        plt.switch_backend('Agg')
+        results = render_batch(names, args.output_dir, dpi=args.dpi, workers=args.workers, force=args.force,
+                               cube_dir=args.cube_dir, csv_path=args.input, metrics=metrics,
+                               filled_df=filled_df, summary=summary)
+        rendered = sum(seconds is not None for _, seconds in results.values())
+        print(f"Rendered {rendered} of {len(names)} figures in {time.perf_counter() - start:.2f}s")
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for name in names:
+            # Includes the time the window stays open
+            with metrics.stage(name), profiler.section(name):
+                draw(name, filled_df, os.path.join(args.output_dir, FIGURES[name][1]), args.dpi, show=True,
+                     summary=summary)
+    if not args.no_summary:
+        print_summary(filled_df, summary)
+    metrics.save(args.metrics)